@@ -0,0 +1,66 @@
+"""
+Benchmark of the 'fused' and 'numba' expression engines against the default per-expression loop of ChoiceModel, on a
+synthetic destination choice model with many expressions. Only utility evaluation is timed, not the probability
+kernels.
+
+Usage: python benchmarks/bench_fused.py [n_rows] [n_cols] [n_expressions] [n_threads]
+"""
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from cheval import ChoiceModel
+
+
+def _build_model(n_rows: int, n_cols: int, n_expressions: int) -> ChoiceModel:
+    randomizer = np.random.RandomState(12345)
+
+    model = ChoiceModel()
+    model.add_choices([f"zone{i}" for i in range(n_cols)])
+    model.decision_units = pd.RangeIndex(n_rows)
+    model.declare_vector('income', 0)
+    model.declare_vector('employment', 1)
+    model.declare_matrix('distance')
+    model.declare_matrix('time')
+
+    # Mostly linear-in-parameters terms, as in typical specifications. These are bound by memory bandwidth rather than
+    # arithmetic, which is where fusing helps.
+    templates = ['{c} * distance', '{c} * time', '{c} * income * distance', '{c} * employment']
+    model.expressions = [templates[i % len(templates)].format(c=0.01 * (i + 1)) for i in range(n_expressions)]
+    model.expressions = [f"{0.1 * i} @ zone{i}" for i in range(min(n_cols, n_expressions // 10))]
+
+    model['income'].assign(randomizer.uniform(10, 100, n_rows))
+    model['employment'].assign(randomizer.uniform(0, 1000, n_cols))
+    for name in ['distance', 'time']:
+        model[name].assign(pd.DataFrame(randomizer.uniform(0, 50, (n_rows, n_cols)), index=model.decision_units,
+                                        columns=model.choices))
+    return model
+
+
+def _time(model: ChoiceModel, n_threads: int, repeats=3) -> float:
+    best = np.inf
+    for _ in range(repeats):
+        model._cached_utils = None  # Utilities accumulate into the cached table, so start from zeros each time
+        start = perf_counter()
+        model._evaluate_utilities(model.expressions, n_threads=n_threads)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main(n_rows: int = 5000, n_cols: int = 1000, n_expressions: int = 200, n_threads: int = 1):
+    model = _build_model(n_rows, n_cols, n_expressions)
+    print(f"{n_rows} rows x {n_cols} choices, {len(list(model.expressions))} expressions, {n_threads} thread(s)")
+
+    results = {}
+    for engine in ['numexpr', 'fused', 'numba']:
+        model.engine = engine
+        _time(model, n_threads, repeats=1)  # Compile the programs
+        results[engine] = _time(model, n_threads)
+        speedup = results['numexpr'] / results[engine]
+        print(f"{engine:>10} {results[engine]:>10.4f} s {speedup:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,68 @@
+"""
+Benchmark of the probability kernels used by ChoiceModel.run_stochastic() and run_discrete(), on wide tables typical of
+destination choice models. Compares the default row-at-a-time kernels with the batched kernels (kernel='batched') and
+their fast-math variants (kernel='fastmath').
+
+Note that the exponentials only get vectorized when Numba can use Intel's SVML library (see `numba -s`); without it the
+batched kernels run at about the same speed as the row kernels.
+
+Usage: python benchmarks/bench_kernels.py [n_rows]
+"""
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from cheval.core import (worker_multinomial_probabilities, worker_multinomial_probabilities_batched,
+                         worker_multinomial_probabilities_fastmath, worker_multinomial_sample_fused,
+                         worker_multinomial_sample_batched, worker_multinomial_sample_fastmath,
+                         worker_sequential_uniforms)
+
+N_COLS = [100, 1000, 2000, 4000]
+
+
+def _time(func, *args, repeats=3) -> float:
+    best = np.inf
+    for _ in range(repeats):
+        start = perf_counter()
+        func(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def _compare(label: str, kernels, make_args, n_rows: int):
+    randomizer = np.random.RandomState(12345)
+    for kernel in kernels: kernel(*make_args(-randomizer.uniform(size=(4, 4))))  # Warm up the JIT
+
+    print(label)
+    print(f"{'n_cols':>8} {'row (s)':>10} {'batched (s)':>12} {'fastmath (s)':>13} {'speedup':>8}")
+    for n_cols in N_COLS:
+        args = make_args(-randomizer.uniform(0, 5, size=(n_rows, n_cols)))
+        t_row, t_batched, t_fastmath = [_time(kernel, *args) for kernel in kernels]
+        speedup = t_row / min(t_batched, t_fastmath)
+        print(f"{n_cols:>8} {t_row:>10.4f} {t_batched:>12.4f} {t_fastmath:>13.4f} {speedup:>8.2f}")
+    print()
+
+
+def bench_probabilities(n_rows: int):
+    kernels = [worker_multinomial_probabilities, worker_multinomial_probabilities_batched,
+               worker_multinomial_probabilities_fastmath]
+    _compare("Probabilities (run_stochastic)", kernels, lambda utilities: (utilities,), n_rows)
+
+
+def bench_sampling(n_rows: int):
+    kernels = [worker_multinomial_sample_fused, worker_multinomial_sample_batched, worker_multinomial_sample_fastmath]
+
+    def make_args(utilities):
+        return utilities, worker_sequential_uniforms(1, utilities.shape[0], 1)
+
+    _compare("Sampling, 1 draw (run_discrete)", kernels, make_args, n_rows)
+
+
+def main(n_rows: int = 20_000):
+    bench_probabilities(n_rows)
+    bench_sampling(n_rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
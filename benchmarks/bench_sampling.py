@@ -0,0 +1,68 @@
+"""
+Benchmark of the samplers used by ChoiceModel.run_discrete(). Compares binary search with the alias method, for finding
+the number of draws at which the alias method becomes faster (see cheval.core.ALIAS_THRESHOLD); and the single-pass
+'fused' sampler against the default for one draw per row.
+
+Usage: python benchmarks/bench_sampling.py [n_rows]
+"""
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from cheval.core import worker_multinomial_sample, worker_multinomial_sample_fused, worker_sequential_uniforms
+
+N_COLS = [10, 40, 200, 1000, 4000]
+N_DRAWS = [2, 4, 8, 16, 32, 64, 128, 256]
+
+
+def _time(func, *args, repeats=3) -> float:
+    best = np.inf
+    for _ in range(repeats):
+        start = perf_counter()
+        func(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def _fused(utilities: np.ndarray, n_draws: int, seed: int):
+    draws = worker_sequential_uniforms(seed, utilities.shape[0], n_draws)
+    return worker_multinomial_sample_fused(utilities, draws)
+
+
+def bench_alias(n_rows: int):
+    randomizer = np.random.RandomState(12345)
+    worker_multinomial_sample(-randomizer.uniform(size=(4, 4)), 2, 1, False)  # Warm up the JIT
+    worker_multinomial_sample(-randomizer.uniform(size=(4, 4)), 2, 1, True)
+
+    print(f"{'n_cols':>8} {'n_draws':>8} {'search (s)':>12} {'alias (s)':>12} {'speedup':>8}")
+    for n_cols in N_COLS:
+        utilities = -randomizer.uniform(0, 5, size=(n_rows, n_cols))
+        crossover = None
+        for n_draws in N_DRAWS:
+            t_search = _time(worker_multinomial_sample, utilities, n_draws, 1, False)
+            t_alias = _time(worker_multinomial_sample, utilities, n_draws, 1, True)
+            if crossover is None and t_alias < t_search: crossover = n_draws
+            print(f"{n_cols:>8} {n_draws:>8} {t_search:>12.4f} {t_alias:>12.4f} {t_search / t_alias:>8.2f}")
+        print(f"Crossover for {n_cols} columns: n_draws={crossover}\n")
+
+
+def bench_fused(n_rows: int):
+    randomizer = np.random.RandomState(12345)
+    _fused(-randomizer.uniform(size=(4, 4)), 1, 1)  # Warm up the JIT
+
+    print(f"{'n_cols':>8} {'search (s)':>12} {'fused (s)':>12} {'speedup':>8}")
+    for n_cols in N_COLS:
+        utilities = -randomizer.uniform(0, 5, size=(n_rows, n_cols))
+        t_search = _time(worker_multinomial_sample, utilities, 1, 1, False)
+        t_fused = _time(_fused, utilities, 1, 1)
+        print(f"{n_cols:>8} {t_search:>12.4f} {t_fused:>12.4f} {t_search / t_fused:>8.2f}")
+
+
+def main(n_rows: int = 20_000):
+    bench_alias(n_rows)
+    bench_fused(n_rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
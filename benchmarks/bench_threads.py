@@ -0,0 +1,64 @@
+"""
+Thread-scaling benchmark for ChoiceModel.run_stochastic() and run_discrete(), on a synthetic destination choice model.
+Each run is made inside an ExecutionContext with the given number of threads, for both utility evaluation (NumExpr)
+and the probability kernels (Numba).
+
+Usage: python benchmarks/bench_threads.py [n_rows] [n_cols]
+"""
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from cheval import ChoiceModel, ExecutionContext, threading_layer
+from cheval.execution import max_threads
+
+
+def _build_model(n_rows: int, n_cols: int) -> ChoiceModel:
+    randomizer = np.random.RandomState(12345)
+
+    model = ChoiceModel()
+    model.add_choices([f"zone{i}" for i in range(n_cols)])
+    model.decision_units = pd.RangeIndex(n_rows)
+    model.declare_vector('income', 0)
+    model.declare_vector('employment', 1)
+    model.declare_matrix('distance')
+    model.expressions = ['-0.1 * distance', 'log(employment + 1)', '0.01 * income * distance']
+
+    model['income'].assign(randomizer.uniform(10, 100, n_rows))
+    model['employment'].assign(randomizer.uniform(0, 1000, n_cols))
+    model['distance'].assign(pd.DataFrame(randomizer.uniform(0, 50, (n_rows, n_cols)), index=model.decision_units,
+                                          columns=model.choices))
+    return model
+
+
+def _time(func, repeats=3) -> float:
+    best = np.inf
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main(n_rows: int = 20_000, n_cols: int = 1000):
+    model = _build_model(n_rows, n_cols)
+    model.run_stochastic(clear_scope=False)  # Warm up the JIT
+
+    thread_counts = sorted({1, 2, 4, 8, 16, max_threads()} & set(range(1, max_threads() + 1)))
+    print(f"Threading layer: {threading_layer()}, max threads: {max_threads()}")
+    print(f"{'n_threads':>10} {'stochastic (s)':>15} {'speedup':>8} {'discrete (s)':>13} {'speedup':>8}")
+
+    baseline = None
+    for n_threads in thread_counts:
+        with ExecutionContext(n_threads):
+            t_stochastic = _time(lambda: model.run_stochastic(clear_scope=False))
+            t_discrete = _time(lambda: model.run_discrete(random_seed=1, clear_scope=False))
+        if baseline is None: baseline = t_stochastic, t_discrete
+        print(f"{n_threads:>10} {t_stochastic:>15.4f} {baseline[0] / t_stochastic:>8.2f} {t_discrete:>13.4f} "
+              f"{baseline[1] / t_discrete:>8.2f}")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,4 +1,7 @@
 from ._version import __version__
 from .ldf import *
 from .model import ChoiceModel
+from .core import warmup
+from .execution import ExecutionContext, threading_layer, set_threading_layer, program_cache_info
 from .exceptions import ModelNotReadyError, UnsupportedSyntaxError
+from .parsing.expressions import expression_cache
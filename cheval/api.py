@@ -45,6 +45,7 @@ class ChoiceNode(object):
     def logsum_scale(self, value):
         assert 0.0 < value <= 1.0, "Logsum scale must be in hte interval (0, 1], got %s" % value
         self._logsum_scale = float(value)
+        self._root._cached_tree = None  # The flattened tree stores logsum scales, so it needs to be re-built
 
     @property
     def name(self):
@@ -108,22 +109,44 @@ class ChoiceNode(object):
 # region Expression containers
 
 
+@attr.s
+class CoefficientTable:
+    """Linear-in-parameters terms, with a coefficient for each choice (see ChoiceModel.load_coefficients())"""
+    expressions: List[Expression] = attr.ib()
+    coefficients: pd.DataFrame = attr.ib()  # One row for each expression, and one column for each choice or nest
+
+    @property
+    def symbols(self) -> Set[str]:
+        return set().union(*[e.symbols for e in self.expressions])
+
+    @property
+    def chained_symbols(self) -> Set[str]:
+        return set().union(*[e.chains.keys() for e in self.expressions])
+
+
 @attr.s
 class ExpressionSubGroup:
     name: Hashable = attr.ib()
     simple_symbols: Set[str] = attr.ib(default=attr.Factory(set))
     chained_symbols: Set[str] = attr.ib(default=attr.Factory(set))
     expressions: List[Expression] = attr.ib(default=attr.Factory(list))
+    tables: List[CoefficientTable] = attr.ib(default=attr.Factory(list))
 
     def append(self, e: Expression):
         self.expressions.append(e)
         self.simple_symbols |= e.symbols
         for chain_name in e.chains.keys(): self.chained_symbols.add(chain_name)
 
+    def append_table(self, table: CoefficientTable):
+        self.tables.append(table)
+        self.simple_symbols |= table.symbols
+        self.chained_symbols |= table.chained_symbols
+
     def __add__(self, other: 'ExpressionSubGroup') -> 'ExpressionSubGroup':
         new = ExpressionSubGroup(self.name)
         for e in self.expressions: new.append(e)
         for e in other.expressions: new.append(e)
+        for table in self.tables + other.tables: new.append_table(table)
         return new
 
     def itersimple(self):
@@ -132,6 +155,9 @@ class ExpressionSubGroup:
     def iterchained(self):
         yield from self.chained_symbols
 
+    def itertables(self):
+        yield from self.tables
+
     def __iter__(self):
         yield from self.expressions
 
@@ -143,6 +169,7 @@ class ExpressionGroup(object):
         self._simple_symbols: Set[str] = set()
         self._chained_symbols: Set[str] = set()
         self._subgroups: Dict[Hashable, ExpressionSubGroup] = {}
+        self._tables: List[CoefficientTable] = []
 
     def append(self, e: str, group: Hashable = None):
         # Parse the expression and look for invalid syntax and inconsistent usage. self._simple_symbols and
@@ -161,8 +188,22 @@ class ExpressionGroup(object):
             self._simple_symbols |= expr.symbols
             for chain_name in expr.chains.keys(): self._chained_symbols.add(chain_name)
 
+    def append_table(self, expressions: List[str], coefficients: pd.DataFrame, group: Hashable = None):
+        # Expressions of coefficient tables are parsed and checked for consistent usage like any other expression, but
+        # are kept separately since they're evaluated together
+        parsed = [Expression.parse(e, self._simple_symbols, self._chained_symbols) for e in expressions]
+        table = CoefficientTable(parsed, coefficients)
+        if group is not None:
+            if group not in self._subgroups: self._subgroups[group] = ExpressionSubGroup(group)
+            self._subgroups[group].append_table(table)
+        else:
+            self._tables.append(table)
+            self._simple_symbols |= table.symbols
+            self._chained_symbols |= table.chained_symbols
+
     def clear(self):
         self._ungrouped_expressions.clear()
+        self._tables.clear()
         self._subgroups.clear()
         self._simple_symbols.clear()
         self._chained_symbols.clear()
@@ -179,6 +220,12 @@ class ExpressionGroup(object):
         for subgroup in self._subgroups.values():
             yield from subgroup.iterchained()
 
+    def itertables(self, *, groups=True) -> Generator[CoefficientTable, None, None]:
+        yield from self._tables
+        if not groups: return
+        for subgroup in self._subgroups.values():
+            yield from subgroup.itertables()
+
     def __iter__(self, *, groups=True) -> Generator[Expression, None, None]:
         yield from self._ungrouped_expressions
         if not groups: return
@@ -191,6 +238,7 @@ class ExpressionGroup(object):
         new._simple_symbols = self._simple_symbols | other._simple_symbols
         new._chained_symbols = self._chained_symbols | other._chained_symbols
         new._ungrouped_expressions = self._ungrouped_expressions + other._ungrouped_expressions
+        new._tables = self._tables + other._tables
 
         new._subgroups = {}
         keys = set(self._subgroups.keys()) | set(other._subgroups.keys())
@@ -221,9 +269,14 @@ class ExpressionGroup(object):
             new._ungrouped_expressions.append(e)
             new._simple_symbols |= e.symbols
             for chain_name in e.chains.keys(): new._chained_symbols.add(chain_name)
+        for table in self._tables:
+            new._tables.append(table)
+            new._simple_symbols |= table.symbols
+            new._chained_symbols |= table.chained_symbols
         for name, subgroup in self._subgroups.items():
             new_sg = ExpressionSubGroup(name)
             for e in subgroup: new_sg.append(e)
+            for table in subgroup.itertables(): new_sg.append_table(table)
             new._subgroups[name] = new_sg
         return new
 
@@ -252,6 +305,21 @@ class AbstractSymbol(object, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def filled(self) -> bool: pass
 
+    def _storage_dtype(self, dtype: np.dtype) -> np.dtype:
+        # Floating-point data wider than the model's precision gets narrowed, so that single-precision models don't
+        # get upcast back to float64 during evaluation
+        float_dtype = np.dtype(f"f{self._parent.precision}")
+        if dtype.kind == 'f' and dtype.itemsize > float_dtype.itemsize: return float_dtype
+        return dtype
+
+    def _cast_floats(self, array: np.ndarray) -> np.ndarray:
+        dtype = self._storage_dtype(array.dtype)
+        return array if dtype == array.dtype else array.astype(dtype)
+
+    def _mark_assigned(self):
+        # Tells the model that this symbol has a new value, so that dependent expressions get re-evaluated
+        self._parent._symbol_assigned(self._name)
+
 
 class NumberSymbol(AbstractSymbol):
     def __init__(self, parent: 'ChoiceModel', name: str):
@@ -259,7 +327,9 @@ class NumberSymbol(AbstractSymbol):
         self._val = None
 
     def assign(self, data):
-        self._val = float(data)
+        val = float(data)
+        if val != self._val: self._mark_assigned()
+        self._val = val
 
     def _get(self):
         if self._val is None:
@@ -301,11 +371,12 @@ class VectorSymbol(AbstractSymbol):
         else:
             raise TypeError(type(data))
 
-        self._raw_array = vector[...]  # Shallow copy
+        self._raw_array = self._cast_floats(vector)[...]  # Shallow copy
         n = len(index_to_check)
 
         if self._orientation: self._raw_array.shape = 1, n
         else: self._raw_array.shape = n, 1
+        self._mark_assigned()
 
     def _get(self):
         if self._raw_array is None:
@@ -356,6 +427,7 @@ class TableSymbol(AbstractSymbol):
             raise TypeError(f"LinkedDataFrames not allowed for symbol {self._name}")
 
         self._table = data
+        self._mark_assigned()
 
     def _get(self, chain_info: ChainTuple=None):
         assert chain_info is not None
@@ -376,7 +448,7 @@ class TableSymbol(AbstractSymbol):
             attribute_name = chain_info.chain[0]
             series = self._table[attribute_name]
 
-        vector = convert_series(series, allow_raw=False)
+        vector = self._cast_floats(convert_series(series, allow_raw=False))
 
         n = len(vector)
         new_shape = (n, 1) if self._orientation == 0 else (1, n)
@@ -422,7 +494,7 @@ class MatrixSymbol(AbstractSymbol):
             cols_match = data.columns is cols or cols.equals(data.columns)
 
             if rows_match and cols_match:
-                self._matrix = data.values
+                self._matrix = self._cast_floats(data.values)
             else:
                 '''
                 Try to manually control the amount of excess RAM needed for partial utilities, as Pandas reindex()
@@ -430,7 +502,7 @@ class MatrixSymbol(AbstractSymbol):
                 cells with data. This is important to keep this feature scalable.
                 '''
 
-                matrix = np.empty([len(rows), len(cols)], dtype=data.values.dtype)
+                matrix = np.empty([len(rows), len(cols)], dtype=self._storage_dtype(data.values.dtype))
                 if not cols_match:
                     assert self._reindex_cols
                     col_indexer = cols.get_indexer(data.columns)
@@ -450,6 +522,7 @@ class MatrixSymbol(AbstractSymbol):
 
         else:
             raise TypeError(type(data))
+        self._mark_assigned()
 
     def _get(self): return self._matrix
 
@@ -0,0 +1,184 @@
+"""
+Generation of Numba kernels which evaluate many utility expressions in a single pass over the utility table, as an
+alternative to evaluating each expression with NumExpr.
+"""
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+import ast
+from collections import OrderedDict
+from threading import Lock
+
+import numba as nb
+import numpy as np
+
+MAX_KERNELS = 32  # Number of generated kernels kept, over all models
+
+_FUNCTIONS = {name: f"np.{name}" for name in [
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh', 'cosh', 'tanh', 'arcsinh', 'arccosh',
+    'arctanh', 'log', 'log10', 'log1p', 'exp', 'expm1', 'sqrt', 'abs', 'floor', 'ceil'
+]}
+_BINARY_OPERATORS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/', ast.Pow: '**', ast.Mod: '%',
+                     ast.BitAnd: '&', ast.BitOr: '|', ast.BitXor: '^'}
+_COMPARISONS = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+
+_kernels: 'OrderedDict[str, Optional[Callable]]' = OrderedDict()  # Kernel source -> compiled kernel, or None
+_kernels_lock = Lock()
+
+
+class UnsupportedExpression(Exception):
+    pass
+
+
+class _Translator(ast.NodeVisitor):
+    # Translates an expression (as transformed by the ExpressionParser) into Numba source for one cell of the utility
+    # table, at row `i` and column `column`
+
+    def __init__(self, builder: 'KernelBuilder', values: Mapping[str, object], column: str):
+        self.builder = builder
+        self.values = values
+        self.column = column
+
+    def generic_visit(self, node):
+        raise UnsupportedExpression(node.__class__.__name__)
+
+    def visit_Expression(self, node): return self.visit(node.body)
+
+    def visit_BinOp(self, node):
+        op = _BINARY_OPERATORS.get(type(node.op))
+        if op is None: raise UnsupportedExpression(node.op.__class__.__name__)
+        return f"({self.visit(node.left)} {op} {self.visit(node.right)})"
+
+    def visit_UnaryOp(self, node):
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.USub): return f"(-{operand})"
+        if isinstance(node.op, ast.UAdd): return operand
+        if isinstance(node.op, (ast.Invert, ast.Not)): return f"(not {operand})"  # The parser converts 'not' to '~'
+        raise UnsupportedExpression(node.op.__class__.__name__)
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1: raise UnsupportedExpression("Chained comparison")
+        op = _COMPARISONS.get(type(node.ops[0]))
+        if op is None: raise UnsupportedExpression(node.ops[0].__class__.__name__)
+        return f"({self.visit(node.left)} {op} {self.visit(node.comparators[0])})"
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords: raise UnsupportedExpression("Call")
+        args = [self.visit(arg) for arg in node.args]
+        name = node.func.id
+        if name == 'where' and len(args) == 3: return f"({args[1]} if {args[0]} else {args[2]})"
+        if name not in _FUNCTIONS: raise UnsupportedExpression(name)
+        return f"{_FUNCTIONS[name]}({', '.join(args)})"
+
+    def visit_Name(self, node):
+        if node.id not in self.values: raise UnsupportedExpression(node.id)
+        return self.builder._accessor(node.id, self.values[node.id], self.column)
+
+    def visit_Constant(self, node):
+        value = node.value
+        if isinstance(value, bool) or not isinstance(value, (int, float)): raise UnsupportedExpression(repr(value))
+        return repr(value)
+
+    def visit_Num(self, node): return repr(node.n)  # Python < 3.8
+
+
+class KernelBuilder(object):
+    """
+    Combines expressions into a kernel which loops over the rows of the utility table in parallel. Expressions without
+    a filter are added up into a local accumulator for each cell of the row, and filtered expressions are added to their
+    column of the row. Each input is indexed according to its shape, so row vectors, column vectors and matrices are
+    read directly without being broadcast.
+    """
+
+    def __init__(self):
+        self.arg_names: Dict[str, str] = {}  # Variable name -> argument name in the kernel
+        self.args: List[object] = []
+        self._cell_terms: List[str] = []
+        self._column_terms: List[Tuple[int, str]] = []
+
+    def __len__(self):
+        return len(self._cell_terms) + len(self._column_terms)
+
+    def add(self, source: str, values: Mapping[str, object], column: Optional[int]) -> bool:
+        """
+        Adds an expression to the kernel, if possible.
+
+        Args:
+            source: The transformed expression.
+            values: The value of each variable in the expression.
+            column: The column of the utility table which the expression applies to, or None for all columns.
+
+        Returns:
+            bool: False if the expression can't be translated, in which case nothing is added.
+        """
+        n_args = len(self.args)
+        try:
+            tree = ast.parse(source, mode='eval')
+            term = _Translator(self, values, 'j' if column is None else str(int(column))).visit(tree)
+        except (UnsupportedExpression, SyntaxError):
+            for name in list(self.arg_names)[n_args:]: del self.arg_names[name]
+            del self.args[n_args:]
+            return False
+
+        if column is None: self._cell_terms.append(term)
+        else: self._column_terms.append((int(column), term))
+        return True
+
+    def source(self) -> str:
+        """The source code of the kernel"""
+        lines = [f"def kernel(out{''.join(', ' + name for name in self.arg_names.values())}):",
+                 "    n_rows, n_cols = out.shape",
+                 "    for i in nb.prange(n_rows):"]
+        if self._cell_terms:
+            lines += ["        for j in range(n_cols):", "            acc = 0.0"]
+            lines += [f"            acc += {term}" for term in self._cell_terms]
+            lines += ["            out[i, j] += acc"]
+        lines += [f"        out[i, {column}] += {term}" for column, term in self._column_terms]
+        return '\n'.join(lines) + '\n'
+
+    def run(self, out: np.ndarray) -> bool:
+        """
+        Compiles (or re-uses) the kernel and adds the expressions to `out`. Returns False if Numba couldn't compile
+        the kernel, in which case `out` is unchanged.
+        """
+        kernel = get_kernel(self.source())
+        if kernel is None: return False
+        try:
+            kernel(out, *self.args)
+        except nb.core.errors.NumbaError:
+            with _kernels_lock: _kernels[self.source()] = None  # Don't try to compile it again
+            return False
+        return True
+
+    def _accessor(self, name: str, value, column: str) -> str:
+        # The source to read the value of a variable at row i of the given column
+        if isinstance(value, np.ndarray) and value.ndim == 2:
+            if value.dtype.kind not in 'biuf': raise UnsupportedExpression(f"{name} has dtype {value.dtype}")
+            arg = self._arg_name(name, value)
+            row = 'i' if value.shape[0] > 1 else '0'
+            return f"{arg}[{row}, {column if value.shape[1] > 1 else '0'}]"
+        if isinstance(value, (bool, int, float, np.bool_, np.integer, np.floating)):
+            return self._arg_name(name, value)
+        raise UnsupportedExpression(f"{name} has type {type(value).__name__}")
+
+    def _arg_name(self, name: str, value) -> str:
+        arg = self.arg_names.get(name)
+        if arg is None:
+            arg = self.arg_names[name] = f"a{len(self.args)}"
+            self.args.append(value)
+        return arg
+
+
+def get_kernel(source: str) -> Optional[Callable]:
+    """Compiles the source of a kernel, keeping the most recent MAX_KERNELS kernels for re-use"""
+    with _kernels_lock:
+        if source in _kernels:
+            _kernels.move_to_end(source)
+            return _kernels[source]
+
+    namespace = {'nb': nb, 'np': np}
+    exec(compile(source, '<cheval kernel>', 'exec'), namespace)
+    kernel = nb.njit(parallel=True)(namespace['kernel'])
+
+    with _kernels_lock:
+        _kernels[source] = kernel
+        while len(_kernels) > MAX_KERNELS: _kernels.popitem(last=False)
+    return kernel
@@ -2,22 +2,86 @@
 from typing import Tuple
 import numpy as np
 from numpy import ndarray
-from numba import prange, njit, float64 as ndouble, int64 as nlong, void, float32 as nfloat, boolean as nbool
-from numba.types import Tuple as NTuple, optional as maybe
+from numba import prange, njit
 
 MIN_RANDOM_VALUE = np.finfo(np.float64).tiny
 MAX_RANDOM_VALUE = np.iinfo(np.int32).max
-
-TREE_INFO_TYPE = NTuple((nlong[:], nlong[:], ndouble[:]))
+ROW_BLOCK_SIZE = 256  # Number of rows per parallel work item, for kernels which need per-thread working space
+# The alias method is faster than binary search when n_draws >= max(ALIAS_THRESHOLD, n_cols / ALIAS_COLUMN_RATIO). See
+# benchmarks/bench_sampling.py
+ALIAS_THRESHOLD = 32
+ALIAS_COLUMN_RATIO = 4
+BATCH_SIZE = 16  # Number of rows processed together by the batched kernels
+# Fast-math flags for the batched kernels. Excludes 'nnan' and 'ninf', as utilities of -inf are used to disable choices.
+FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
 
 
 class UtilityBoundsError(ValueError):
     pass
 
+
+# region Counter-based random numbers
+
+_MASK_32 = np.uint64(0xFFFFFFFF)
+_SHIFT_32 = np.uint64(32)
+_SHIFT_11 = np.uint64(11)
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = np.uint64(0x9E3779B9)
+_PHILOX_W1 = np.uint64(0xBB67AE85)
+_PHILOX_ROUNDS = 10
+_INV_2_53 = 1.0 / 9007199254740992.0
+
+
+@njit(nogil=True, cache=True)
+def philox4x32(c0, c1, c2, c3, k0, k1) -> Tuple[int, int, int, int]:
+    """
+    The Philox-4x32-10 counter-based random number generator (Salmon et al., 2011). Maps a 128-bit counter and a 64-bit
+    key to 128 random bits, with no state carried between calls. Each argument and return value holds 32 bits, stored
+    in an unsigned 64-bit integer to make the multiplications simpler.
+    """
+    c0, c1, c2, c3 = np.uint64(c0), np.uint64(c1), np.uint64(c2), np.uint64(c3)
+    k0, k1 = np.uint64(k0), np.uint64(k1)
+    for _ in range(_PHILOX_ROUNDS):
+        product0 = _PHILOX_M0 * c0
+        product1 = _PHILOX_M1 * c2
+        c0, c1, c2, c3 = ((product1 >> _SHIFT_32) ^ c1 ^ k0, product1 & _MASK_32,
+                          (product0 >> _SHIFT_32) ^ c3 ^ k1, product0 & _MASK_32)
+        k0 = (k0 + _PHILOX_W0) & _MASK_32
+        k1 = (k1 + _PHILOX_W1) & _MASK_32
+    return c0, c1, c2, c3
+
+
+@njit(nogil=True, cache=True)
+def counter_uniform(seed, unit_hash, draw) -> float:
+    """
+    Returns a random float in the open interval (0, 1), determined only by the random seed, a (hashed) identifier for
+    the decision unit, and the draw number. This allows the same decision unit to get the same random draws regardless
+    of its position in the table, the number of threads, or how the table is partitioned.
+    """
+    seed, unit_hash, draw = np.uint64(seed), np.uint64(unit_hash), np.uint64(draw)
+    x0, x1, _, _ = philox4x32(unit_hash & _MASK_32, unit_hash >> _SHIFT_32, draw & _MASK_32, draw >> _SHIFT_32,
+                              seed & _MASK_32, seed >> _SHIFT_32)
+    bits = ((x0 << _SHIFT_32) | x1) >> _SHIFT_11  # Top 53 bits
+    return (bits + 0.5) * _INV_2_53
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_counter_uniforms(seed, unit_hashes: ndarray, n: int) -> ndarray:
+    """Generates n counter-based random draws for each decision unit, in parallel."""
+    n_rows = len(unit_hashes)
+    result = np.empty((n_rows, n), dtype=np.float64)
+    for i in prange(n_rows):
+        for k in range(n):
+            result[i, k] = counter_uniform(seed, unit_hashes[i], np.uint64(k))
+    return result
+
+# endregion
+
 # region Sampling
 
 
-@njit(nlong(ndouble[:], ndouble), nogil=True)
+@njit(nogil=True, cache=True)
 def sample_once(p_array: ndarray, r: float) -> int:
     r = max(r, MIN_RANDOM_VALUE)
     cumsum = 0.0
@@ -30,7 +94,7 @@ def sample_once(p_array: ndarray, r: float) -> int:
     return len(p_array) - 1
 
 
-@njit(nlong(ndouble, ndouble[:]), nogil=True)
+@njit(nogil=True, cache=True)
 def logarithmic_search(r: float, cps: ndarray) -> int:
     """
     Logarithmic (binary) search algorithm for finding the greatest index whose cumulative probability is <= the random
@@ -69,7 +133,7 @@ def logarithmic_search(r: float, cps: ndarray) -> int:
         return upper_bound
 
 
-@njit(void(ndouble[:]), nogil=True)
+@njit(nogil=True, cache=True)
 def nbf_cumsum(array: ndarray):
     accum = 0.0
     length = len(array)
@@ -78,21 +142,21 @@ def nbf_cumsum(array: ndarray):
         array[i] = accum
 
 
-@njit(nlong[:](nlong, nlong), nogil=True)
+@njit(nogil=True, cache=True)
 def generate_rand_ints_for_parallel(seed: int, n: int) -> ndarray:
     """Wrap random sampling in a separate function with parallel=False for stable results"""
     np.random.seed(seed)
     return np.random.randint(0, MAX_RANDOM_VALUE, n)
 
 
-@njit(ndouble[:](nlong, nlong), nogil=True)
+@njit(nogil=True, cache=True)
 def generate_rand_floats_for_parallel(seed: int, n: int) -> ndarray:
     """Wrap random sampling in a separate function with parallel=False for stable results"""
     np.random.seed(seed)
     return np.random.uniform(MIN_RANDOM_VALUE, 1, n)
 
 
-@njit(nlong[:](ndouble[:], nlong, nlong, maybe(nlong[:])), nogil=True)
+@njit(nogil=True, cache=True)
 def sample_multi(p_array: ndarray, n: int, random_seed: int, out_array: ndarray = None) -> ndarray:
     """Sample from a probability distribution multiple times using binary search"""
     np.random.seed(random_seed)
@@ -105,110 +169,428 @@ def sample_multi(p_array: ndarray, n: int, random_seed: int, out_array: ndarray
         assert len(out_array) == n
 
     for i in range(n):
-        r = np.random.uniform(MIN_RANDOM_VALUE, 1.0, 1)[0]
+        r = np.random.uniform(MIN_RANDOM_VALUE, 1.0)
         out_array[i] = logarithmic_search(r, p_array)
     return out_array
 
+
+@njit(nogil=True, cache=True)
+def build_alias_table(p_array: ndarray, table_prob: ndarray, table_alias: ndarray, stack: ndarray):
+    """
+    Builds a Walker alias table (using Vose's method) for a probability distribution, in O(n) time. After setup, each
+    draw from the distribution takes O(1) time, using alias_draw().
+
+    Args:
+        p_array (float[]): The probabilities to sample from. Does not need to be normalized.
+        table_prob (float[]): Output array for the acceptance probability of each cell. Same length as `p_array`.
+        table_alias (int[]): Output array for the alias of each cell. Same length as `p_array`.
+        stack (int[]): Working space, same length as `p_array`. Small cells are stacked at the front, and large cells at
+            the back.
+    """
+    n = len(p_array)
+    total = 0.0
+    for p in p_array:
+        total += p
+
+    n_small, n_large = 0, 0
+    for i in range(n):
+        q = p_array[i] * n / total
+        table_prob[i] = q
+        table_alias[i] = i
+        if q < 1.0:
+            stack[n_small] = i
+            n_small += 1
+        else:
+            n_large += 1
+            stack[n - n_large] = i
+
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        small = stack[n_small]
+        large = stack[n - n_large]
+
+        table_alias[small] = large
+        table_prob[large] = (table_prob[large] + table_prob[small]) - 1.0
+
+        if table_prob[large] < 1.0:
+            # Move the large cell from the large stack to the small stack
+            n_large -= 1
+            stack[n_small] = large
+            n_small += 1
+
+    # Any remaining cells are full, save for numerical error
+    while n_large > 0:
+        table_prob[stack[n - n_large]] = 1.0
+        n_large -= 1
+    while n_small > 0:
+        n_small -= 1
+        table_prob[stack[n_small]] = 1.0
+
+
+@njit(nogil=True, cache=True)
+def alias_draw(table_prob: ndarray, table_alias: ndarray, r: float) -> int:
+    """Samples once from an alias table built by build_alias_table(), from an existing random draw"""
+    n = len(table_prob)
+    x = r * n
+    index = min(int(x), n - 1)
+    if (x - index) < table_prob[index]:
+        return index
+    return table_alias[index]
+
+
+@njit(nogil=True, cache=True)
+def sample_multi_alias(p_array: ndarray, n: int, random_seed: int, out_array: ndarray, table_prob: ndarray,
+                       table_alias: ndarray, stack: ndarray) -> ndarray:
+    """
+    Sample from a probability distribution multiple times using the alias method. The setup cost is higher than for
+    sample_multi(), but each draw takes constant time, so this is faster for large numbers of draws (see
+    ALIAS_THRESHOLD and ALIAS_COLUMN_RATIO). The table and stack arrays are working space, to allow re-use across rows.
+    """
+    np.random.seed(random_seed)
+
+    build_alias_table(p_array, table_prob, table_alias, stack)
+
+    for i in range(n):
+        r = np.random.uniform(MIN_RANDOM_VALUE, 1.0)
+        out_array[i] = alias_draw(table_prob, table_alias, r)
+    return out_array
+
+
+@njit(nogil=True, cache=True)
+def counter_sample_multi(p_array: ndarray, n: int, seed, unit_hash, out_array: ndarray, table_prob: ndarray,
+                         table_alias: ndarray, stack: ndarray, use_alias=False) -> ndarray:
+    """
+    Sample from a probability distribution one or more times using counter-based random draws, either by binary search
+    or the alias method. The p_array gets modified in-place.
+    """
+    if use_alias:
+        build_alias_table(p_array, table_prob, table_alias, stack)
+        for k in range(n):
+            r = counter_uniform(seed, unit_hash, np.uint64(k))
+            out_array[k] = alias_draw(table_prob, table_alias, r)
+    else:
+        nbf_cumsum(p_array)
+        for k in range(n):
+            r = counter_uniform(seed, unit_hash, np.uint64(k))
+            out_array[k] = logarithmic_search(r, p_array)
+    return out_array
+
+
+@njit(nogil=True, cache=True)
+def gumbel_top_k(p_array: ndarray, uniforms: ndarray, out_array: ndarray, out_log_q: ndarray, heap_index: ndarray,
+                 heap_keys: ndarray):
+    """
+    Samples k = len(out_array) distinct choices from a probability distribution without replacement, by perturbing the
+    log-probabilities with Gumbel noise and keeping the k largest keys. Choices are returned in the order they would be
+    drawn one at a time, so the first choice is a regular sample from the distribution.
+
+    Also computes the log inclusion probability of each sampled choice, conditional on the (k+1)-th largest key. This
+    is the correction term for estimating or simulating with the sampled choice set. When fewer than k choices are
+    available, the remaining output cells are set to -1 (with a log inclusion probability of NaN).
+
+    Args:
+        p_array (float[]): The probabilities of each choice
+        uniforms (float[]): One uniform random draw per choice, same length as `p_array`
+        out_array (int[]): Output array for the sampled choices, of length k
+        out_log_q (float[]): Output array for the log inclusion probabilities, of length k
+        heap_index, heap_keys: Working space, of length k + 1
+    """
+    k = len(out_array)
+    capacity = k + 1
+
+    # Keep the k + 1 largest keys in a min-heap, so the smallest is always at the root
+    size = 0
+    for j in range(len(p_array)):
+        if p_array[j] <= 0: continue
+        key = np.log(p_array[j]) - np.log(-np.log(max(uniforms[j], MIN_RANDOM_VALUE)))
+
+        if size < capacity:
+            position = size
+            size += 1
+            while position > 0:  # Sift up
+                parent = (position - 1) // 2
+                if heap_keys[parent] <= key: break
+                heap_keys[position], heap_index[position] = heap_keys[parent], heap_index[parent]
+                position = parent
+        elif key > heap_keys[0]:
+            position = 0
+            while True:  # Sift down
+                child = 2 * position + 1
+                if child >= size: break
+                if child + 1 < size and heap_keys[child + 1] < heap_keys[child]: child += 1
+                if key <= heap_keys[child]: break
+                heap_keys[position], heap_index[position] = heap_keys[child], heap_index[child]
+                position = child
+        else:
+            continue
+        heap_keys[position], heap_index[position] = key, j
+
+    order = np.argsort(-heap_keys[:size])
+    threshold = heap_keys[order[k]] if size == capacity else -np.inf
+    n_sampled = min(size, k)
+
+    for i in range(n_sampled):
+        j = heap_index[order[i]]
+        # P(key_j > threshold) = 1 - exp(-p_j * exp(-threshold))
+        x = np.exp(np.log(p_array[j]) - threshold)
+        out_array[i] = j
+        out_log_q[i] = np.log(-np.expm1(-x))
+    for i in range(n_sampled, k):
+        out_array[i] = -1
+        out_log_q[i] = np.nan
+
+
+@njit(nogil=True, cache=True)
+def fused_search(r: float, cumsums: ndarray, maxes: ndarray, n_cols: int) -> int:
+    """
+    Binary search over a running sum of exponentiated utilities stored by multinomial_cumulative_inplace(). Each
+    partial sum is rescaled to the final maximum utility only when it is probed, so no second pass is needed. Returns
+    the smallest index whose cumulative probability is >= the random draw, skipping cells with 0 probability.
+    """
+    final_max = maxes[n_cols - 1]
+    threshold = max(r, MIN_RANDOM_VALUE) * cumsums[n_cols - 1]
+
+    lower_bound, upper_bound = 0, n_cols - 1
+    while lower_bound < upper_bound:
+        mid_index = (lower_bound + upper_bound) // 2
+        if threshold <= cumsums[mid_index] * np.exp(maxes[mid_index] - final_max):
+            upper_bound = mid_index
+        else:
+            lower_bound = mid_index + 1
+    return lower_bound
+
+
+@njit(nogil=True, cache=True)
+def multinomial_cumulative_inplace(utilities: ndarray, cumsums: ndarray, maxes: ndarray) -> float:
+    """
+    Accumulates exponentiated multinomial logit utilities in a single pass over the row, for sampling with
+    fused_search(). The running maximum utility is subtracted as it is found, so that large utilities do not overflow:
+    cumsums[i] holds the sum of exp(u - maxes[i]) over the first i + 1 cells.
+
+    Returns (float): The sum of exponentiated utilities (i.e. the same value returned by multinomial_probabilities)
+    """
+    running_max = -np.inf
+    running_sum = 0.0
+    for i in range(len(utilities)):
+        u = utilities[i]
+        if u > running_max:
+            running_sum = running_sum * np.exp(running_max - u) + 1.0
+            running_max = u
+        elif u > -np.inf:
+            running_sum += np.exp(u - running_max)
+        cumsums[i] = running_sum
+        maxes[i] = running_max
+
+    if running_max == -np.inf:
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+
+    return running_sum * np.exp(running_max)
+
+
+@njit(nogil=True, cache=True)
+def nested_descend(r: float, utilities: ndarray, logsums: ndarray, top_logsum: float, top_group: int,
+                   child_groups: ndarray, child_offsets, children, logsum_scales, bottom_flags, scale_utilities=True
+                   ) -> int:
+    """
+    Samples one elemental choice of a nested logit model by descending the tree from the top, using the nest logsums
+    from nested_logsums_inplace(). Within each nest, the child is chosen by a linear search over its conditional
+    probabilities, and the random draw is rescaled to the chosen child's interval for the next level down. Children
+    with 0 probability are skipped.
+
+    Args:
+        r (float): The random draw
+        utilities (float[]): The utilities of each node in the tree
+        logsums (float[]): The logsum of each nest, from nested_logsums_inplace()
+        top_logsum (float): The top-level logsum, from nested_logsums_inplace()
+        top_group (int): The position of the top level in the flattened tree (i.e. where `parent_order` is -1)
+        child_groups (int[]): For each node, its position as a parent in the flattened tree, or -1 for elemental
+            choices
+        child_offsets, children, logsum_scales, bottom_flags: The flattened tree, from ChoiceModel._flatten()
+        scale_utilities (bool): If True, divide lower-level utilities by the logsum scale of the parent nest.
+
+    Returns (int): The index of the sampled elemental choice
+    """
+    group, ls, parent_ls_scale = top_group, top_logsum, 1.0
+    r = max(r, MIN_RANDOM_VALUE)
+    while True:
+        chosen, lower, width = -1, 0.0, 0.0
+        cumulative = 0.0
+        for position in range(child_offsets[group], child_offsets[group + 1]):
+            index = children[position]
+            v = utilities[index] if bottom_flags[index] else utilities[index] + logsum_scales[index] * logsums[index]
+            p = np.exp(v / parent_ls_scale - ls)
+            if p <= 0.0: continue
+            chosen, lower, width = index, cumulative, p
+            cumulative += p
+            if r <= cumulative: break  # Rounding can leave the total below r, in which case the last child is chosen
+
+        if bottom_flags[chosen]: return chosen
+        r = min(max((r - lower) / width, MIN_RANDOM_VALUE), 1.0)
+        group, ls = child_groups[chosen], logsums[chosen]
+        parent_ls_scale = logsum_scales[chosen] if scale_utilities else 1.0
+
 # endregion
 
 # region Probability Computation
 
 
-@njit(ndouble[:](ndouble[:]), nogil=True)
+@njit(nogil=True, cache=True)
 def simple_probabilities(weights: ndarray) -> ndarray:
     return weights / weights.sum()
 
 
-@njit([
-    NTuple((ndouble[:], ndouble))(ndouble[:]), NTuple((ndouble[:], ndouble))(nfloat[:])
-], nogil=True)
-def multinomial_probabilities(utilities: ndarray) -> Tuple[ndarray, float]:
-    """Computes probabilities given a multinomial logit model formulation."""
-    n_cols = len(utilities)
-    p = np.zeros(n_cols, dtype=np.float64)  # Return value
+@njit(nogil=True, cache=True)
+def multinomial_probabilities_inplace(utilities: ndarray, out: ndarray) -> float:
+    """
+    Computes probabilities given a multinomial logit model formulation, writing them into a preallocated array.
+
+    The maximum utility is subtracted before exponentiating, so that large utilities do not overflow to inf (and
+    probabilities to NaN). The returned logsum term is the (unshifted) sum of exponentiated utilities, which can still
+    overflow for very large utilities even though the probabilities remain valid.
 
-    ls = 0.0  # Logsum
-    for i, u in enumerate(utilities):
-        expu = np.exp(u)
-        ls += expu
-        p[i] = expu
+    Args:
+        utilities (float[]): The utilities of each choice
+        out (float[]): Output array for the probabilities, same length as `utilities`
 
-    if ls <= 0:
+    Returns (float): The sum of exponentiated utilities
+    """
+    ls, valid = _multinomial_row(utilities, out)
+    if not valid:
         raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return ls
 
-    for i in range(n_cols):
-        p[i] = p[i] / ls
 
-    return p, ls
+@njit(nogil=True, cache=True)
+def _multinomial_row(utilities: ndarray, out: ndarray) -> Tuple[float, bool]:
+    """
+    multinomial_probabilities_inplace() without raising an error, since errors can't be raised inside a parallel loop.
+    Also returns False if all utilities are -inf (including rows without any choices), in which case `out` is not
+    written.
+    """
+    n_cols = len(utilities)
 
+    max_u = -np.inf
+    for i in range(n_cols):
+        u = utilities[i]
+        if u > max_u: max_u = u
 
-@njit([
-    NTuple((ndouble[:], ndouble))(ndouble[:], nlong[:], nlong[:], ndouble[:], nbool[:], nbool),
-    NTuple((ndouble[:], ndouble))(nfloat[:], nlong[:], nlong[:], ndouble[:], nbool[:], nbool)
-], nogil=True)
-def nested_probabilities(utilities: ndarray, hierarchy, levels, logsum_scales, bottom_flags, scale_utilities=True
-                         ) -> Tuple[ndarray, float]:
-    """Probability evaluation of a nested logit model, without needing a tree structure or any recursion."""
+    if max_u == -np.inf: return 0.0, False
 
-    n_cells = len(utilities)
-    probabilities = utilities.astype(np.float64)
-    top_logsum = 0
-    logsums = np.zeros(n_cells, dtype=np.float64)
-
-    # Step 1: Exponentiate the utilities and collect logsums
-    max_level = levels.max()
-    current_level = max_level
-    for _ in range(max_level + 1):
-        # Go through levels in reverse order (e.g. starting at the bottom)
-        for index, level in enumerate(levels):
-            if level != current_level: continue  # This is still faster than using np.where()
-
-            parent = hierarchy[index]
-            parent_ls_scale = 1.0 if not scale_utilities or parent < 0 else logsum_scales[parent]
-            is_bottom = bottom_flags[index]
-
-            if is_bottom:
-                # If this node is at the bottom of the tree, no need to lookup the previously-stored logsum
-                expu = np.exp(probabilities[index] / parent_ls_scale)
-            else:
-                existing_logsum = logsums[index]
-                current_ls_scale = logsum_scales[index]
+    scaled_ls = 0.0
+    for i in range(n_cols):
+        expu = np.exp(utilities[i] - max_u)
+        scaled_ls += expu
+        out[i] = expu
 
-                # Note: It is deliberate to take the log of 0 in some cases. This can occur when all children in a nest
-                # exponentiate to 0 (e.g. have very low utility, usually deliberately to disable some choices). The
-                # function np.log() evaluates to -inf, which is exactly what we want it to be: the upper choice should
-                # also get disabled.
-                expu = np.exp((probabilities[index] + current_ls_scale * np.log(existing_logsum)) / parent_ls_scale)
+    for i in range(n_cols):
+        out[i] = out[i] / scaled_ls
 
-            if parent >= 0: logsums[parent] += expu
-            else: top_logsum += expu
-            probabilities[index] = expu
-        current_level -= 1
+    return scaled_ls * np.exp(max_u), True
 
-    if top_logsum <= 0:
-        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
 
-    # Step 2: Use logsums to compute conditional probabilities
-    for index, parent in enumerate(hierarchy):
-        ls = top_logsum if parent == -1 else logsums[parent]
+@njit(nogil=True, cache=True)
+def multinomial_probabilities(utilities: ndarray) -> Tuple[ndarray, float]:
+    """Computes probabilities given a multinomial logit model formulation."""
+    p = np.zeros(len(utilities), dtype=np.float64)  # Return value
+    ls = multinomial_probabilities_inplace(utilities, p)
+    return p, ls
 
-        # Logsums of 0 can happen sometimes when all choices in a nest are -inf, so just fix the probabilities to 0
-        p = 0.0 if ls <= 0 else probabilities[index] / ls
-        probabilities[index] = p
 
-    # Step 3: Compute absolute probabilities for child nodes, collecting parent nodes
-    for current_level in range(1, max_level + 1):
-        for index, level in enumerate(levels):
-            if level != current_level: continue
-            parent = hierarchy[index]
-            probabilities[index] *= probabilities[parent]
+@njit(nogil=True, cache=True)
+def nested_probabilities_inplace(utilities: ndarray, out: ndarray, scratch: ndarray, parent_order, child_offsets,
+                                 children, logsum_scales, bottom_flags, scale_utilities=True) -> float:
+    """
+    Probability evaluation of a nested logit model, writing into a preallocated array. The tree is traversed using the
+    plan produced by ChoiceModel._flatten(), visiting each node once from the bottom up (to collect logsums) and once
+    from the top down (to compute probabilities). Logsums are accumulated in log-space, subtracting the maximum
+    (scaled) utility within each nest, so that large utilities do not overflow.
 
-    # Step 4: Zero-out parent node probabilities
-    # This does not use a Set because Numba sets are really slow
-    for parent in hierarchy:
-        if parent < 0: continue
-        probabilities[parent] = 0.0
+    Args:
+        utilities (float[]): The utilities of each node in the tree
+        out (float[]): Output array for the probabilities, same length as `utilities`
+        scratch (float[]): Working space for the logsum of each nest, same length as `utilities`. Its contents are
+            overwritten.
+        parent_order, child_offsets, children, logsum_scales, bottom_flags: The flattened tree, from
+            ChoiceModel._flatten()
+        scale_utilities (bool): If True, divide lower-level utilities by the logsum scale of the parent nest.
+
+    Returns (float): The top-level sum of exponentiated utilities
+    """
+    ls, valid = _nested_row(utilities, out, scratch, parent_order, child_offsets, children, logsum_scales, bottom_flags,
+                            scale_utilities)
+    if not valid:
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return ls
 
+
+@njit(nogil=True, cache=True)
+def _nested_row(utilities: ndarray, out: ndarray, scratch: ndarray, parent_order, child_offsets, children,
+                logsum_scales, bottom_flags, scale_utilities=True) -> Tuple[float, bool]:
+    """
+    nested_probabilities_inplace() without raising an error, since errors can't be raised inside a parallel loop. Also
+    returns False if the top-level logsum is -inf, in which case the probabilities in `out` are not computed.
+    """
+    logsums = scratch
+    top_logsum = -np.inf
+    n_parents = len(parent_order)
+
+    # Step 1: Compute the scaled utility of each node, and collect logsums, starting at the bottom of the tree. All
+    # children of a nest are visited before the nest itself, so their logsums are complete.
+    for k in range(n_parents):
+        parent = parent_order[k]
+        start, stop = child_offsets[k], child_offsets[k + 1]
+        parent_ls_scale = 1.0 if not scale_utilities or parent < 0 else logsum_scales[parent]
+
+        max_v = -np.inf
+        for position in range(start, stop):
+            index = children[position]
+            if bottom_flags[index]:
+                v = utilities[index] / parent_ls_scale
+            else:
+                v = (utilities[index] + logsum_scales[index] * logsums[index]) / parent_ls_scale
+            out[index] = v
+            if v > max_v: max_v = v
+
+        # When all children have a utility of -inf (usually deliberately, to disable some choices), the logsum is also
+        # -inf, which is exactly what we want it to be: the upper choice should also get disabled.
+        logsum = -np.inf
+        if max_v > -np.inf:
+            sum_expv = 0.0
+            for position in range(start, stop):
+                sum_expv += np.exp(out[children[position]] - max_v)
+            logsum = max_v + np.log(sum_expv)
+
+        if parent >= 0: logsums[parent] = logsum
+        else: top_logsum = logsum
+
+    if top_logsum == -np.inf: return 0.0, False
+
+    # Step 2: Compute absolute probabilities from the top down, zeroing-out parent nodes once their children are done
+    for k in range(n_parents - 1, -1, -1):
+        parent = parent_order[k]
+        if parent >= 0:
+            parent_p, ls = out[parent], logsums[parent]
+            out[parent] = 0.0
+        else:
+            parent_p, ls = 1.0, top_logsum
+
+        for position in range(child_offsets[k], child_offsets[k + 1]):
+            index = children[position]
+            # Logsums of -inf can happen sometimes when all choices in a nest are -inf, so fix the probabilities to 0
+            out[index] = 0.0 if ls == -np.inf else parent_p * np.exp(out[index] - ls)
+
+    return np.exp(top_logsum), True
+
+
+@njit(nogil=True, cache=True)
+def nested_probabilities(utilities: ndarray, parent_order, child_offsets, children, logsum_scales, bottom_flags,
+                         scale_utilities=True) -> Tuple[ndarray, float]:
+    """Probability evaluation of a nested logit model, without needing a tree structure or any recursion."""
+    n_cells = len(utilities)
+    probabilities = np.zeros(n_cells, dtype=np.float64)
+    scratch = np.empty(n_cells, dtype=np.float64)
+    top_logsum = nested_probabilities_inplace(utilities, probabilities, scratch, parent_order, child_offsets, children,
+                                              logsum_scales, bottom_flags, scale_utilities)
     return probabilities, top_logsum
 
 # endregion
@@ -216,60 +598,48 @@ def nested_probabilities(utilities: ndarray, hierarchy, levels, logsum_scales, b
 # region Middle functions
 
 
-@njit(nlong(ndouble[:], ndouble), nogil=True)
+@njit(nogil=True, cache=True)
 def simple_sample(weights: ndarray, r: float) -> int:
     """Samples once from an array of weights, from an existing random draw"""
     p_array = simple_probabilities(weights)
     return sample_once(p_array, r)
 
 
-@njit(nlong[:](ndouble[:], nlong, nlong, maybe(nlong[:])), nogil=True)
+@njit(nogil=True, cache=True)
 def simple_multisample(weights: ndarray, n: int, seed: int, out: ndarray = None) -> ndarray:
     """Samples multiple times from an array of weights, based on a random seed. Thread-safe."""
     p_array = simple_probabilities(weights)
     return sample_multi(p_array, n, seed, out)
 
 
-@njit([
-    NTuple((nlong, ndouble))(ndouble[:], ndouble),
-    NTuple((nlong, ndouble))(nfloat[:], ndouble)
-], nogil=True)
+@njit(nogil=True, cache=True)
 def multinomial_sample(utilities: ndarray, r: float) -> Tuple[int, float]:
     """Samples once from an array of multinomial logit utilities, from an existing random draw"""
     p_array, ls = multinomial_probabilities(utilities)
     return sample_once(p_array, r), ls
 
 
-@njit([
-    NTuple((nlong[:], ndouble))(ndouble[:], nlong, nlong, maybe(nlong[:])),
-    NTuple((nlong[:], ndouble))(nfloat[:], nlong, nlong, maybe(nlong[:]))
-], nogil=True)
+@njit(nogil=True, cache=True)
 def multinomial_multisample(utilities: ndarray, n: int, seed: int, out: ndarray = None) -> Tuple[np.ndarray, float]:
     """Samples multiple times from an array of multinomial logit utilities, based on a random seed. Thread-safe."""
     p_array, ls = multinomial_probabilities(utilities)
     return sample_multi(p_array, n, seed, out), ls
 
 
-@njit([
-    NTuple((nlong, ndouble))(ndouble[:], ndouble, nlong[:], nlong[:], ndouble[:], nbool[:], nbool),
-    NTuple((nlong, ndouble))(nfloat[:], ndouble, nlong[:], nlong[:], ndouble[:], nbool[:], nbool)
-], nogil=True)
-def nested_sample(utilities: ndarray, r: float, parents, levels, ls_scales, bottom_flags, scale_utilities=True
-                  ) -> Tuple[int, float]:
+@njit(nogil=True, cache=True)
+def nested_sample(utilities: ndarray, r: float, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                  scale_utilities=True) -> Tuple[int, float]:
     """Samples once from an array of nested logit utilities, from an existing random draw"""
-    p_array, ls = nested_probabilities(utilities, parents, levels, ls_scales, bottom_flags,
+    p_array, ls = nested_probabilities(utilities, parent_order, child_offsets, children, ls_scales, bottom_flags,
                                        scale_utilities=scale_utilities)
     return sample_once(p_array, r), ls
 
 
-@njit([
-    NTuple((nlong[:], ndouble))(ndouble[:], nlong[:], nlong[:], ndouble[:], nbool[:], nlong, nlong, maybe(nlong[:]), nbool),
-    NTuple((nlong[:], ndouble))(nfloat[:], nlong[:], nlong[:], ndouble[:], nbool[:], nlong, nlong, maybe(nlong[:]), nbool)
-], nogil=True)
-def nested_multisample(utilities: ndarray, parents, levels, ls_scales, bottom_flags, n: int, seed: int,
-                       out: ndarray = None, scale_utilities=True) -> Tuple[ndarray, float]:
+@njit(nogil=True, cache=True)
+def nested_multisample(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags, n: int,
+                       seed: int, out: ndarray = None, scale_utilities=True) -> Tuple[ndarray, float]:
     """Samples multiple times from an array of nested logit utilities, based on a random seed. Thread-safe."""
-    p_array, ls = nested_probabilities(utilities, parents, levels, ls_scales, bottom_flags,
+    p_array, ls = nested_probabilities(utilities, parent_order, child_offsets, children, ls_scales, bottom_flags,
                                        scale_utilities=scale_utilities)
     return sample_multi(p_array, n, seed, out), ls
 
@@ -279,8 +649,9 @@ def nested_multisample(utilities: ndarray, parents, levels, ls_scales, bottom_fl
 # region High level functions
 
 
-@njit(nlong[:, :](ndouble[:, :], nlong, nlong), parallel=True, nogil=True)
+@njit(parallel=True, nogil=True, cache=True)
 def worker_weighted_sample(weights: ndarray, n: int, seed: int) -> ndarray:
+    """Samples (with replacement) n times from each row of non-negative weights in parallel, e.g. proposal weights"""
     n_rows = weights.shape[0]
     result = np.zeros((n_rows, n), dtype=np.int64)
 
@@ -296,27 +667,52 @@ def worker_weighted_sample(weights: ndarray, n: int, seed: int) -> ndarray:
         for i in prange(n_rows):
             weight_row = weights[i, :]
             seed_i = seed_array[i]
-            _, ls = simple_multisample(weight_row, n, seed_i, result[i, :])
+            simple_multisample(weight_row, n, seed_i, result[i, :])
     return result
 
 
-@njit([
-    NTuple((nlong[:, :], ndouble[:]))(ndouble[:, :], nlong, nlong),
-    NTuple((nlong[:, :], ndouble[:]))(nfloat[:, :], nlong, nlong)
-], parallel=True, nogil=True)
-def worker_multinomial_sample(utilities: ndarray, n: int, seed: int) -> Tuple[ndarray, ndarray]:
-    """Runs multinomial_sample or multinomial_multisample in parallel."""
-    n_rows = utilities.shape[0]
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_sample(utilities: ndarray, n: int, seed: int, use_alias=False, draws: ndarray = None
+                              ) -> Tuple[ndarray, ndarray]:
+    """
+    Runs multinomial_sample or multinomial_multisample in parallel. Optionally uses the alias method for n > 1. If
+    pre-computed `draws` are given (from worker_sequential_uniforms()), they are used instead of the seed, with the same
+    results; e.g. to sample a slice of the decision units.
+    """
+    n_rows, n_cols = utilities.shape
     result = np.zeros((n_rows, n), dtype=np.int64)
     ls_array = np.zeros(n_rows, dtype=np.float64)
 
-    if n <= 1:
+    if draws is not None:
+        indices = np.arange(n_cols)
+        n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+        for block in prange(n_blocks):
+            p_array = np.empty(n_cols, dtype=np.float64)
+            table_prob = np.empty(n_cols, dtype=np.float64)
+            table_alias = np.empty(n_cols, dtype=np.int64)
+            stack = np.empty(n_cols, dtype=np.int64)
+            for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+                ls_array[i] = multinomial_probabilities_inplace(utilities[i, :], p_array)
+                _sample_sparse_row(p_array, indices, draws[i, :], result[i, :], table_prob, table_alias, stack,
+                                   use_alias and n > 1)
+    elif n <= 1:
         r_array = generate_rand_floats_for_parallel(seed, n_rows)
         for i in prange(n_rows):
             utility_row = utilities[i, :]
             r = r_array[i]
             result[i, 0], ls = multinomial_sample(utility_row, r)
             ls_array[i] = ls
+    elif use_alias:
+        seed_array = generate_rand_ints_for_parallel(seed, n_rows)
+        n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+        for block in prange(n_blocks):
+            p_array = np.empty(n_cols, dtype=np.float64)
+            table_prob = np.empty(n_cols, dtype=np.float64)
+            table_alias = np.empty(n_cols, dtype=np.int64)
+            stack = np.empty(n_cols, dtype=np.int64)
+            for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+                ls_array[i] = multinomial_probabilities_inplace(utilities[i, :], p_array)
+                sample_multi_alias(p_array, n, seed_array[i], result[i, :], table_prob, table_alias, stack)
     else:
         seed_array = generate_rand_ints_for_parallel(seed, n_rows)
         for i in prange(n_rows):
@@ -327,84 +723,1239 @@ def worker_multinomial_sample(utilities: ndarray, n: int, seed: int) -> Tuple[nd
     return result, ls_array
 
 
-@njit([
-    NTuple((ndouble[:, :], ndouble[:]))(ndouble[:, :]),
-    NTuple((ndouble[:, :], ndouble[:]))(nfloat[:, :])
-], parallel=True, nogil=True)
+@njit(parallel=True, nogil=True, cache=True)
 def worker_multinomial_probabilities(utilities: ndarray) -> Tuple[ndarray, ndarray]:
-    """Runs multinomial_probabilities in parallel"""
+    """
+    Runs multinomial_probabilities in parallel. Probabilities are returned in the same precision as the utilities, but
+    are always computed in double precision. Logsums (sums of exponentials) are returned in double precision, as they
+    can overflow single precision.
+    """
     n_rows, n_cols = utilities.shape
-    result = np.zeros((n_rows, n_cols), dtype=np.float64)
+    result = np.zeros((n_rows, n_cols), dtype=utilities.dtype)
     ls_array = np.zeros(n_rows, dtype=np.float64)
 
-    for i in prange(n_rows):
-        utility_row = utilities[i, :]
-        p_array, ls = multinomial_probabilities(utility_row)
-        result[i, :] = p_array
-        ls_array[i] = ls
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = multinomial_probabilities_inplace(utilities[i, :], p_array)
+            result[i, :] = p_array
 
     return result, ls_array
 
 
-@njit([
-    NTuple((nlong[:, :], ndouble[:]))(ndouble[:, :], nlong[:], nlong[:], ndouble[:], nbool[:], nlong, nlong, nbool),
-    NTuple((nlong[:, :], ndouble[:]))(nfloat[:, :], nlong[:], nlong[:], ndouble[:], nbool[:], nlong, nlong, nbool)
-], parallel=True, nogil=True)
-def worker_nested_sample(utilities: ndarray, parents, levels, ls_scales, bottom_flags, n: int, seed: int,
-                         scale_utilities=True) -> Tuple[ndarray, ndarray]:
-    """Runs nested_sample or nested_multisample in parallel."""
-    n_rows = len(utilities)
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags, n: int,
+                         seed: int, scale_utilities=True, use_alias=False, draws: ndarray = None
+                         ) -> Tuple[ndarray, ndarray]:
+    """
+    Runs nested_sample or nested_multisample in parallel. Optionally uses the alias method for n > 1. Pre-computed
+    `draws` can be given as in worker_multinomial_sample().
+    """
+    n_rows, n_cols = utilities.shape
     result = np.zeros((n_rows, n), dtype=np.int64)
     ls_array = np.zeros(n_rows, dtype=np.float64)
 
     np.random.seed(seed)
-    if n <= 1:
+    if draws is not None:
+        indices = np.arange(n_cols)
+        n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+        for block in prange(n_blocks):
+            p_array = np.empty(n_cols, dtype=np.float64)
+            scratch = np.empty(n_cols, dtype=np.float64)
+            table_prob = np.empty(n_cols, dtype=np.float64)
+            table_alias = np.empty(n_cols, dtype=np.int64)
+            stack = np.empty(n_cols, dtype=np.int64)
+            for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+                ls_array[i] = nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order,
+                                                           child_offsets, children, ls_scales, bottom_flags,
+                                                           scale_utilities)
+                _sample_sparse_row(p_array, indices, draws[i, :], result[i, :], table_prob, table_alias, stack,
+                                   use_alias and n > 1)
+    elif n <= 1:
         r_array = generate_rand_floats_for_parallel(seed, n_rows)
         for i in prange(n_rows):
             utility_row = utilities[i, :]
             r = r_array[i]
-            this_result, ls = nested_sample(utility_row, r, parents, levels, ls_scales, bottom_flags,
-                                            scale_utilities=scale_utilities)
+            this_result, ls = nested_sample(utility_row, r, parent_order, child_offsets, children, ls_scales,
+                                            bottom_flags, scale_utilities=scale_utilities)
             result[i, 0] = this_result
             ls_array[i] = ls
+    elif use_alias:
+        seed_array = generate_rand_ints_for_parallel(seed, n_rows)
+        n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+        for block in prange(n_blocks):
+            p_array = np.empty(n_cols, dtype=np.float64)
+            scratch = np.empty(n_cols, dtype=np.float64)
+            table_prob = np.empty(n_cols, dtype=np.float64)
+            table_alias = np.empty(n_cols, dtype=np.int64)
+            stack = np.empty(n_cols, dtype=np.int64)
+            for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+                ls_array[i] = nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order,
+                                                           child_offsets, children, ls_scales, bottom_flags,
+                                                           scale_utilities)
+                sample_multi_alias(p_array, n, seed_array[i], result[i, :], table_prob, table_alias, stack)
     else:
         seed_array = generate_rand_ints_for_parallel(seed, n_rows)
         for i in prange(n_rows):
             utility_row = utilities[i, :]
             seed_i = seed_array[i]
-            _, ls = nested_multisample(utility_row, parents, levels, ls_scales, bottom_flags, n, seed_i, result[i, :],
-                                       scale_utilities=scale_utilities)
+            _, ls = nested_multisample(utility_row, parent_order, child_offsets, children, ls_scales, bottom_flags, n,
+                                       seed_i, result[i, :], scale_utilities=scale_utilities)
             ls_array[i] = ls
     return result, ls_array
 
 
-@njit([
-    NTuple((ndouble[:, :], ndouble[:]))(ndouble[:, :], nlong[:], nlong[:], ndouble[:], nbool[:], nbool),
-    NTuple((ndouble[:, :], ndouble[:]))(nfloat[:, :], nlong[:], nlong[:], ndouble[:], nbool[:], nbool)
-], parallel=True, nogil=True)
-def worker_nested_probabilities(utilities: ndarray, parents, levels, ls_scales, bottom_flags, scale_utilities=True
-                                ) -> Tuple[ndarray, ndarray]:
-    """Runs nested_probabilities in parallel"""
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_probabilities(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                                scale_utilities=True) -> Tuple[ndarray, ndarray]:
+    """
+    Runs nested_probabilities in parallel. Probabilities are returned in the same precision as the utilities, but are
+    always computed in double precision. Logsums (sums of exponentials) are returned in double precision, as they can
+    overflow single precision.
+    """
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, n_cols), dtype=utilities.dtype)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    # Rows are processed in blocks so that the working space only gets allocated once per block
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        scratch = np.empty(n_cols, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order, child_offsets,
+                                                       children, ls_scales, bottom_flags, scale_utilities)
+            result[i, :] = p_array
+
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_sample_counter(utilities: ndarray, n: int, seed, unit_hashes: ndarray, use_alias=False
+                                      ) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from multinomial logit utilities in parallel, using counter-based random draws keyed on the hash of each
+    decision unit. Results do not depend on the order of rows or the number of threads.
+    """
     n_rows, n_cols = utilities.shape
-    result = np.zeros((n_rows, n_cols), dtype=np.float64)
+    result = np.zeros((n_rows, n), dtype=np.int64)
     ls_array = np.zeros(n_rows, dtype=np.float64)
 
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        table_prob = np.empty(n_cols, dtype=np.float64)
+        table_alias = np.empty(n_cols, dtype=np.int64)
+        stack = np.empty(n_cols, dtype=np.int64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = multinomial_probabilities_inplace(utilities[i, :], p_array)
+            counter_sample_multi(p_array, n, seed, unit_hashes[i], result[i, :], table_prob, table_alias, stack,
+                                 use_alias)
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample_counter(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                                 n: int, seed, unit_hashes: ndarray, scale_utilities=True, use_alias=False
+                                 ) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from nested logit utilities in parallel, using counter-based random draws keyed on the hash of each
+    decision unit. Results do not depend on the order of rows or the number of threads.
+    """
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, n), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        scratch = np.empty(n_cols, dtype=np.float64)
+        table_prob = np.empty(n_cols, dtype=np.float64)
+        table_alias = np.empty(n_cols, dtype=np.int64)
+        stack = np.empty(n_cols, dtype=np.int64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order, child_offsets,
+                                                       children, ls_scales, bottom_flags, scale_utilities)
+            counter_sample_multi(p_array, n, seed, unit_hashes[i], result[i, :], table_prob, table_alias, stack,
+                                 use_alias)
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_sequential_uniforms(seed: int, n_rows: int, n: int) -> ndarray:
+    """
+    Generates the same random draws used by worker_multinomial_sample() and worker_nested_sample() (with binary
+    search), as an (n_rows, n) table which can be passed to the kernels that take pre-computed draws.
+    """
+    result = np.empty((n_rows, max(n, 1)), dtype=np.float64)
+    if n <= 1:
+        result[:, 0] = generate_rand_floats_for_parallel(seed, n_rows)
+        return result
+
+    seed_array = generate_rand_ints_for_parallel(seed, n_rows)
     for i in prange(n_rows):
-        utility_row = utilities[i, :]
-        p_array, ls = nested_probabilities(utility_row, parents, levels, ls_scales, bottom_flags,
-                                           scale_utilities=scale_utilities)
-        result[i, :] = p_array
-        ls_array[i] = ls
+        np.random.seed(seed_array[i])
+        for k in range(n):
+            result[i, k] = np.random.uniform(MIN_RANDOM_VALUE, 1.0)
+    return result
+
 
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_sample_fused(utilities: ndarray, draws: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from multinomial logit utilities in parallel, streaming through each utility row only once, without
+    computing a row of probabilities. Takes one column of pre-computed random draws per sample.
+    """
+    n_rows, n_cols = utilities.shape
+    n = draws.shape[1]
+    result = np.zeros((n_rows, n), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        cumsums = np.empty(n_cols, dtype=np.float64)
+        maxes = np.empty(n_cols, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = multinomial_cumulative_inplace(utilities[i, :], cumsums, maxes)
+            for k in range(n):
+                result[i, k] = fused_search(draws[i, k], cumsums, maxes, n_cols)
     return result, ls_array
 
 
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample_draws(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                               draws: ndarray, scale_utilities=True) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from nested logit utilities in parallel, computing each row of probabilities into working space that is
+    re-used for every row in a block, rather than allocating it per row. Takes one column of pre-computed random draws
+    per sample, and gives the same results as worker_nested_sample() (with binary search) for the same draws.
+    """
+    n_rows, n_cols = utilities.shape
+    n = draws.shape[1]
+    result = np.zeros((n_rows, n), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        scratch = np.empty(n_cols, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order, child_offsets,
+                                                       children, ls_scales, bottom_flags, scale_utilities)
+            nbf_cumsum(p_array)
+            for k in range(n):
+                result[i, k] = logarithmic_search(draws[i, k], p_array)
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample_fused(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                               draws: ndarray, scale_utilities=True) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from nested logit utilities in parallel, without computing a row of probabilities: each row only gets its
+    nest logsums collected, and each draw then descends the tree with nested_descend(). Takes one column of
+    pre-computed random draws per sample. Results can differ from worker_nested_sample_draws() for the same draws, as
+    the draws are mapped onto the choices in the order of the tree rather than in the order of the columns.
+    """
+    n_rows, n_cols = utilities.shape
+    n = draws.shape[1]
+    result = np.zeros((n_rows, n), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    child_groups = np.full(n_cols, -1, dtype=np.int64)
+    top_group = 0
+    for k in range(len(parent_order)):
+        if parent_order[k] >= 0: child_groups[parent_order[k]] = k
+        else: top_group = k
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        logsums = np.empty(n_cols, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            util_row = utilities[i, :]
+            top_logsum = nested_logsums_inplace(util_row, logsums, parent_order, child_offsets, children, ls_scales,
+                                                bottom_flags, scale_utilities)
+            if top_logsum == -np.inf:
+                invalid[block] = True
+                continue
+            ls_array[i] = np.exp(top_logsum)
+            for k in range(n):
+                result[i, k] = nested_descend(draws[i, k], util_row, logsums, top_logsum, top_group, child_groups,
+                                              child_offsets, children, ls_scales, bottom_flags, scale_utilities)
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return result, ls_array
+
+
+@njit(nogil=True, cache=True)
+def _top_k_uniforms(seed: int, unit_hash, use_counter: bool, out: ndarray):
+    """Fills one uniform random draw per choice, either from a seeded sequence or keyed on the hashed decision unit"""
+    if use_counter:
+        for j in range(len(out)):
+            out[j] = counter_uniform(np.uint64(seed), unit_hash, np.uint64(j))
+    else:
+        np.random.seed(seed)
+        for j in range(len(out)):
+            out[j] = np.random.uniform(MIN_RANDOM_VALUE, 1.0)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_sample_without_replacement(utilities: ndarray, k: int, seed: int, unit_hashes: ndarray,
+                                                  use_counter: bool, row_seeds: ndarray = None
+                                                  ) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Samples k distinct choices from multinomial logit utilities in parallel, using gumbel_top_k. If `use_counter` is
+    True, the random draws are keyed on the seed, the hash of each decision unit, and the choice; otherwise each row is
+    seeded from a single sequence, and `unit_hashes` is ignored. That sequence of row seeds (from
+    generate_rand_ints_for_parallel()) can also be given as `row_seeds`, e.g. to sample a slice of the decision units.
+
+    Returns: The sampled choices, their log inclusion probabilities, and the logsum for each row.
+    """
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, k), dtype=np.int64)
+    log_q = np.zeros((n_rows, k), dtype=np.float64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    if row_seeds is None:
+        seed_array = generate_rand_ints_for_parallel(seed, n_rows)
+    else:
+        seed_array = row_seeds
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        uniforms = np.empty(n_cols, dtype=np.float64)
+        heap_index = np.empty(k + 1, dtype=np.int64)
+        heap_keys = np.empty(k + 1, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = multinomial_probabilities_inplace(utilities[i, :], p_array)
+            row_seed = seed if use_counter else seed_array[i]
+            _top_k_uniforms(row_seed, unit_hashes[i] if use_counter else np.uint64(0), use_counter, uniforms)
+            gumbel_top_k(p_array, uniforms, result[i, :], log_q[i, :], heap_index, heap_keys)
+    return result, log_q, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample_without_replacement(utilities: ndarray, parent_order, child_offsets, children, ls_scales,
+                                             bottom_flags, k: int, seed: int, unit_hashes: ndarray, use_counter: bool,
+                                             scale_utilities=True, row_seeds: ndarray = None
+                                             ) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Samples k distinct elemental choices from nested logit utilities in parallel, using gumbel_top_k. Random draws (and
+    `row_seeds`) are made the same way as worker_multinomial_sample_without_replacement().
+
+    Returns: The sampled choices, their log inclusion probabilities, and the top-level logsum for each row.
+    """
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, k), dtype=np.int64)
+    log_q = np.zeros((n_rows, k), dtype=np.float64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    if row_seeds is None:
+        seed_array = generate_rand_ints_for_parallel(seed, n_rows)
+    else:
+        seed_array = row_seeds
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        scratch = np.empty(n_cols, dtype=np.float64)
+        uniforms = np.empty(n_cols, dtype=np.float64)
+        heap_index = np.empty(k + 1, dtype=np.int64)
+        heap_keys = np.empty(k + 1, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            # Parent nodes get a probability of 0, so only elemental choices can be sampled
+            ls_array[i] = nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order, child_offsets,
+                                                       children, ls_scales, bottom_flags, scale_utilities)
+            row_seed = seed if use_counter else seed_array[i]
+            _top_k_uniforms(row_seed, unit_hashes[i] if use_counter else np.uint64(0), use_counter, uniforms)
+            gumbel_top_k(p_array, uniforms, result[i, :], log_q[i, :], heap_index, heap_keys)
+    return result, log_q, ls_array
+
+
+# endregion
+
+# region Sparse choice sets
+# Kernels for models where each decision unit only has a subset of the choices available. The available choices of
+# all rows are stored in CSR format: the utilities of row i are in utilities[indptr[i]: indptr[i + 1]], for the
+# choices in indices[indptr[i]: indptr[i + 1]] (which must be sorted). Unavailable choices are never visited.
+
+
+@njit(nogil=True, cache=True)
+def _max_row_width(indptr: ndarray) -> int:
+    width = 0
+    for i in range(len(indptr) - 1):
+        width = max(width, indptr[i + 1] - indptr[i])
+    return width
+
+
+@njit(nogil=True, cache=True)
+def _scatter_nested_row(utilities: ndarray, indices: ndarray, dense: ndarray):
+    """Copies the utilities of one row into a dense array of all nodes, with unavailable nodes set to -inf"""
+    dense[:] = -np.inf
+    for j in range(len(indices)):
+        dense[indices[j]] = utilities[j]
+
+
+@njit(nogil=True, cache=True)
+def _sample_sparse_row(p_array: ndarray, indices: ndarray, draws: ndarray, out_array: ndarray, table_prob: ndarray,
+                       table_alias: ndarray, stack: ndarray, use_alias: bool):
+    """Samples choices from one row of available probabilities (modified in-place), given pre-computed random draws"""
+    if use_alias:
+        build_alias_table(p_array, table_prob, table_alias, stack)
+        for k in range(len(draws)):
+            out_array[k] = indices[alias_draw(table_prob, table_alias, draws[k])]
+    else:
+        nbf_cumsum(p_array)
+        for k in range(len(draws)):
+            out_array[k] = indices[logarithmic_search(draws[k], p_array)]
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_probabilities_sparse(indptr: ndarray, utilities: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    Multinomial logit probabilities of the available choices of each row, in parallel. Probabilities are returned in
+    the same (long) layout and precision as the utilities, and logsums in double precision.
+    """
+    n_rows = len(indptr) - 1
+    result = np.zeros(len(utilities), dtype=utilities.dtype)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+    width = _max_row_width(indptr)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        p_array = np.empty(width, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            start, stop = indptr[i], indptr[i + 1]
+            ls_array[i], valid = _multinomial_row(utilities[start: stop], p_array[: stop - start])
+            if not valid:
+                invalid[block] = True
+                continue
+            result[start: stop] = p_array[: stop - start]
+
+    if invalid.any():
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_sample_sparse(indptr: ndarray, indices: ndarray, utilities: ndarray, draws: ndarray,
+                                     use_alias=False) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from the available choices of each row of multinomial logit utilities, in parallel. Takes one column of
+    pre-computed random draws per sample; with binary search, the results are the same as for a dense table where
+    unavailable choices have a utility of -inf.
+    """
+    n_rows = len(indptr) - 1
+    n = draws.shape[1]
+    result = np.zeros((n_rows, n), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+    width = _max_row_width(indptr)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        p_array = np.empty(width, dtype=np.float64)
+        table_prob = np.empty(width, dtype=np.float64)
+        table_alias = np.empty(width, dtype=np.int64)
+        stack = np.empty(width, dtype=np.int64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            start, stop = indptr[i], indptr[i + 1]
+            w = stop - start
+            ls_array[i], valid = _multinomial_row(utilities[start: stop], p_array[:w])
+            if not valid:
+                invalid[block] = True
+                continue
+            _sample_sparse_row(p_array[:w], indices[start: stop], draws[i, :], result[i, :], table_prob[:w],
+                               table_alias[:w], stack[:w], use_alias)
+
+    if invalid.any():
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_probabilities_sparse(indptr: ndarray, indices: ndarray, utilities: ndarray, parent_order,
+                                       child_offsets, children, ls_scales, bottom_flags, scale_utilities=True
+                                       ) -> Tuple[ndarray, ndarray]:
+    """
+    Nested logit probabilities of the available nodes of each row, in parallel. Each row is scattered into dense working
+    space covering all nodes of the tree, so the available nodes must include the parents of any available choices.
+    Probabilities are returned in the same (long) layout and precision as the utilities, and logsums in double
+    precision.
+    """
+    n_rows = len(indptr) - 1
+    n_nodes = len(bottom_flags)
+    result = np.zeros(len(utilities), dtype=utilities.dtype)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        dense = np.empty(n_nodes, dtype=np.float64)
+        p_array = np.empty(n_nodes, dtype=np.float64)
+        scratch = np.empty(n_nodes, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            start, stop = indptr[i], indptr[i + 1]
+            _scatter_nested_row(utilities[start: stop], indices[start: stop], dense)
+            ls_array[i], valid = _nested_row(dense, p_array, scratch, parent_order, child_offsets, children, ls_scales,
+                                             bottom_flags, scale_utilities)
+            if not valid:
+                invalid[block] = True
+                continue
+            for j in range(start, stop):
+                result[j] = p_array[indices[j]]
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return result, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample_sparse(indptr: ndarray, indices: ndarray, utilities: ndarray, parent_order, child_offsets,
+                                children, ls_scales, bottom_flags, draws: ndarray, scale_utilities=True,
+                                use_alias=False) -> Tuple[ndarray, ndarray]:
+    """
+    Samples elemental choices from the available nodes of each row of nested logit utilities, in parallel. Takes one
+    column of pre-computed random draws per sample.
+    """
+    n_rows = len(indptr) - 1
+    n_nodes = len(bottom_flags)
+    n = draws.shape[1]
+    result = np.zeros((n_rows, n), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+    width = _max_row_width(indptr)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        dense = np.empty(n_nodes, dtype=np.float64)
+        p_dense = np.empty(n_nodes, dtype=np.float64)
+        scratch = np.empty(n_nodes, dtype=np.float64)
+        p_array = np.empty(width, dtype=np.float64)
+        table_prob = np.empty(width, dtype=np.float64)
+        table_alias = np.empty(width, dtype=np.int64)
+        stack = np.empty(width, dtype=np.int64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            start, stop = indptr[i], indptr[i + 1]
+            w = stop - start
+            _scatter_nested_row(utilities[start: stop], indices[start: stop], dense)
+            ls_array[i], valid = _nested_row(dense, p_dense, scratch, parent_order, child_offsets, children, ls_scales,
+                                             bottom_flags, scale_utilities)
+            if not valid:
+                invalid[block] = True
+                continue
+            for j in range(w):
+                p_array[j] = p_dense[indices[start + j]]  # Parent nodes have a probability of 0
+            _sample_sparse_row(p_array[:w], indices[start: stop], draws[i, :], result[i, :], table_prob[:w],
+                               table_alias[:w], stack[:w], use_alias)
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return result, ls_array
+
+
+@njit(nogil=True, cache=True)
+def _sparse_top_k_uniforms(seed: int, unit_hash, use_counter: bool, indices: ndarray, out: ndarray):
+    """
+    _top_k_uniforms() for the available choices of one row: each choice gets the same random draw as it would in a
+    dense row. Sequential draws for unavailable choices are generated and skipped.
+    """
+    if use_counter:
+        for j in range(len(indices)):
+            out[j] = counter_uniform(np.uint64(seed), unit_hash, np.uint64(indices[j]))
+    else:
+        np.random.seed(seed)
+        position = 0
+        for j in range(len(indices)):
+            while position < indices[j]:
+                np.random.uniform(MIN_RANDOM_VALUE, 1.0)
+                position += 1
+            out[j] = np.random.uniform(MIN_RANDOM_VALUE, 1.0)
+            position += 1
+
+
+@njit(nogil=True, cache=True)
+def _sparse_top_k(p_array: ndarray, indices: ndarray, uniforms: ndarray, positions: ndarray, out_array: ndarray,
+                  out_log_q: ndarray, heap_index: ndarray, heap_keys: ndarray):
+    """gumbel_top_k() over the available choices of one row, returning the sampled choices as column indices"""
+    gumbel_top_k(p_array, uniforms, positions, out_log_q, heap_index, heap_keys)
+    for c in range(len(positions)):
+        out_array[c] = indices[positions[c]] if positions[c] >= 0 else -1
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_sample_sparse_without_replacement(indptr: ndarray, indices: ndarray, utilities: ndarray, k: int,
+                                                         seed: int, unit_hashes: ndarray, use_counter: bool,
+                                                         row_seeds: ndarray = None) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Samples k distinct choices from the available choices of each row of multinomial logit utilities, in parallel,
+    using gumbel_top_k. Random draws (and `row_seeds`) are made as in worker_multinomial_sample_without_replacement(),
+    so the results are the same as for a dense table where unavailable choices have a utility of -inf.
+
+    Returns: The sampled choices, their log inclusion probabilities, and the logsum for each row.
+    """
+    n_rows = len(indptr) - 1
+    result = np.zeros((n_rows, k), dtype=np.int64)
+    log_q = np.zeros((n_rows, k), dtype=np.float64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+    width = _max_row_width(indptr)
+
+    if row_seeds is None:
+        seed_array = generate_rand_ints_for_parallel(seed, n_rows)
+    else:
+        seed_array = row_seeds
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        p_array = np.empty(width, dtype=np.float64)
+        uniforms = np.empty(width, dtype=np.float64)
+        positions = np.empty(k, dtype=np.int64)
+        heap_index = np.empty(k + 1, dtype=np.int64)
+        heap_keys = np.empty(k + 1, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            start, stop = indptr[i], indptr[i + 1]
+            w = stop - start
+            ls_array[i], valid = _multinomial_row(utilities[start: stop], p_array[:w])
+            if not valid:
+                invalid[block] = True
+                continue
+            row_seed = seed if use_counter else seed_array[i]
+            _sparse_top_k_uniforms(row_seed, unit_hashes[i] if use_counter else np.uint64(0), use_counter,
+                                   indices[start: stop], uniforms[:w])
+            _sparse_top_k(p_array[:w], indices[start: stop], uniforms[:w], positions, result[i, :], log_q[i, :],
+                          heap_index, heap_keys)
+
+    if invalid.any():
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return result, log_q, ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_sample_sparse_without_replacement(indptr: ndarray, indices: ndarray, utilities: ndarray,
+                                                    parent_order, child_offsets, children, ls_scales, bottom_flags,
+                                                    k: int, seed: int, unit_hashes: ndarray, use_counter: bool,
+                                                    scale_utilities=True, row_seeds: ndarray = None
+                                                    ) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Samples k distinct elemental choices from the available nodes of each row of nested logit utilities, in parallel.
+    Random draws (and `row_seeds`) are made as in worker_nested_sample_without_replacement(), so the results are the
+    same as for a dense table where unavailable choices have a utility of -inf.
+
+    Returns: The sampled choices, their log inclusion probabilities, and the top-level logsum for each row.
+    """
+    n_rows = len(indptr) - 1
+    n_nodes = len(bottom_flags)
+    result = np.zeros((n_rows, k), dtype=np.int64)
+    log_q = np.zeros((n_rows, k), dtype=np.float64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+    width = _max_row_width(indptr)
+
+    if row_seeds is None:
+        seed_array = generate_rand_ints_for_parallel(seed, n_rows)
+    else:
+        seed_array = row_seeds
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    invalid = np.zeros(n_blocks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for block in prange(n_blocks):
+        dense = np.empty(n_nodes, dtype=np.float64)
+        p_dense = np.empty(n_nodes, dtype=np.float64)
+        scratch = np.empty(n_nodes, dtype=np.float64)
+        p_array = np.empty(width, dtype=np.float64)
+        uniforms = np.empty(width, dtype=np.float64)
+        positions = np.empty(k, dtype=np.int64)
+        heap_index = np.empty(k + 1, dtype=np.int64)
+        heap_keys = np.empty(k + 1, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            start, stop = indptr[i], indptr[i + 1]
+            w = stop - start
+            _scatter_nested_row(utilities[start: stop], indices[start: stop], dense)
+            ls_array[i], valid = _nested_row(dense, p_dense, scratch, parent_order, child_offsets, children, ls_scales,
+                                             bottom_flags, scale_utilities)
+            if not valid:
+                invalid[block] = True
+                continue
+            for j in range(w):
+                p_array[j] = p_dense[indices[start + j]]  # Parent nodes have a probability of 0
+            row_seed = seed if use_counter else seed_array[i]
+            _sparse_top_k_uniforms(row_seed, unit_hashes[i] if use_counter else np.uint64(0), use_counter,
+                                   indices[start: stop], uniforms[:w])
+            _sparse_top_k(p_array[:w], indices[start: stop], uniforms[:w], positions, result[i, :], log_q[i, :],
+                          heap_index, heap_keys)
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return result, log_q, ls_array
+
+
+# endregion
+
+# region Aggregation
+# Kernels which reduce probabilities to weighted totals by group of decision units, without allocating a table of
+# probabilities. Rows are split into `n_chunks` contiguous chunks (usually one per thread), each with its own
+# (n_groups, n_cols) accumulator.
+
+
+@njit(nogil=True, cache=True)
+def _reduce_chunks(accumulators: ndarray) -> ndarray:
+    n_chunks, n_groups, n_cols = accumulators.shape
+    result = np.zeros((n_groups, n_cols), dtype=np.float64)
+    for chunk in range(n_chunks):
+        for g in range(n_groups):
+            for j in range(n_cols):
+                result[g, j] += accumulators[chunk, g, j]
+    return result
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_aggregate(utilities: ndarray, weights: ndarray, group_codes: ndarray, n_groups: int,
+                                 n_chunks: int) -> ndarray:
+    """
+    Sums multinomial logit probabilities times `weights` for each group of rows, returning an (n_groups, n_cols) table
+    """
+    n_rows, n_cols = utilities.shape
+    n_chunks = max(1, min(n_chunks, n_rows))
+    chunk_size = (n_rows + n_chunks - 1) // n_chunks
+    accumulators = np.zeros((n_chunks, n_groups, n_cols), dtype=np.float64)
+
+    for chunk in prange(n_chunks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        for i in range(chunk * chunk_size, min(n_rows, (chunk + 1) * chunk_size)):
+            multinomial_probabilities_inplace(utilities[i, :], p_array)
+            w, g = weights[i], group_codes[i]
+            for j in range(n_cols):
+                accumulators[chunk, g, j] += w * p_array[j]
+    return _reduce_chunks(accumulators)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_aggregate(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                            weights: ndarray, group_codes: ndarray, n_groups: int, n_chunks: int, scale_utilities=True
+                            ) -> ndarray:
+    """
+    Sums nested logit probabilities times `weights` for each group of rows, returning an (n_groups, n_nodes) table in
+    which parent nodes are 0
+    """
+    n_rows, n_cols = utilities.shape
+    n_chunks = max(1, min(n_chunks, n_rows))
+    chunk_size = (n_rows + n_chunks - 1) // n_chunks
+    accumulators = np.zeros((n_chunks, n_groups, n_cols), dtype=np.float64)
+
+    for chunk in prange(n_chunks):
+        p_array = np.empty(n_cols, dtype=np.float64)
+        scratch = np.empty(n_cols, dtype=np.float64)
+        for i in range(chunk * chunk_size, min(n_rows, (chunk + 1) * chunk_size)):
+            nested_probabilities_inplace(utilities[i, :], p_array, scratch, parent_order, child_offsets, children,
+                                         ls_scales, bottom_flags, scale_utilities)
+            w, g = weights[i], group_codes[i]
+            for j in range(n_cols):
+                accumulators[chunk, g, j] += w * p_array[j]
+    return _reduce_chunks(accumulators)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_aggregate_sparse(indptr: ndarray, indices: ndarray, utilities: ndarray, n_cols: int,
+                                        weights: ndarray, group_codes: ndarray, n_groups: int, n_chunks: int
+                                        ) -> ndarray:
+    """worker_multinomial_aggregate() for utilities of the available choices only, in CSR format"""
+    n_rows = len(indptr) - 1
+    n_chunks = max(1, min(n_chunks, n_rows))
+    chunk_size = (n_rows + n_chunks - 1) // n_chunks
+    accumulators = np.zeros((n_chunks, n_groups, n_cols), dtype=np.float64)
+    width = _max_row_width(indptr)
+
+    invalid = np.zeros(n_chunks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for chunk in prange(n_chunks):
+        p_array = np.empty(width, dtype=np.float64)
+        for i in range(chunk * chunk_size, min(n_rows, (chunk + 1) * chunk_size)):
+            start, stop = indptr[i], indptr[i + 1]
+            _, valid = _multinomial_row(utilities[start: stop], p_array[: stop - start])
+            if not valid:
+                invalid[chunk] = True
+                continue
+            w, g = weights[i], group_codes[i]
+            for j in range(stop - start):
+                accumulators[chunk, g, indices[start + j]] += w * p_array[j]
+
+    if invalid.any():
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return _reduce_chunks(accumulators)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_aggregate_sparse(indptr: ndarray, indices: ndarray, utilities: ndarray, parent_order, child_offsets,
+                                   children, ls_scales, bottom_flags, weights: ndarray, group_codes: ndarray,
+                                   n_groups: int, n_chunks: int, scale_utilities=True) -> ndarray:
+    """worker_nested_aggregate() for utilities of the available nodes only, in CSR format"""
+    n_rows = len(indptr) - 1
+    n_nodes = len(bottom_flags)
+    n_chunks = max(1, min(n_chunks, n_rows))
+    chunk_size = (n_rows + n_chunks - 1) // n_chunks
+    accumulators = np.zeros((n_chunks, n_groups, n_nodes), dtype=np.float64)
+
+    invalid = np.zeros(n_chunks, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for chunk in prange(n_chunks):
+        dense = np.empty(n_nodes, dtype=np.float64)
+        p_array = np.empty(n_nodes, dtype=np.float64)
+        scratch = np.empty(n_nodes, dtype=np.float64)
+        for i in range(chunk * chunk_size, min(n_rows, (chunk + 1) * chunk_size)):
+            start, stop = indptr[i], indptr[i + 1]
+            _scatter_nested_row(utilities[start: stop], indices[start: stop], dense)
+            _, valid = _nested_row(dense, p_array, scratch, parent_order, child_offsets, children, ls_scales,
+                                   bottom_flags, scale_utilities)
+            if not valid:
+                invalid[chunk] = True
+                continue
+            w, g = weights[i], group_codes[i]
+            for j in range(start, stop):
+                accumulators[chunk, g, indices[j]] += w * p_array[indices[j]]
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return _reduce_chunks(accumulators)
+
+
+# endregion
+
+# region Logsums
+# Kernels for accessibility calculations, which only need the logsums. Unlike the logsums returned by the probability
+# kernels, these are the natural logarithms of the sums of exponentiated utilities. No probabilities or random draws
+# are computed, and decision units without any available choices get a logsum of -inf instead of raising an error.
+
+
+@njit(nogil=True, cache=True)
+def multinomial_logsum(utilities: ndarray) -> float:
+    """The log of the sum of exponentiated utilities, computed without overflow"""
+    max_u = -np.inf
+    for u in utilities:
+        if u > max_u: max_u = u
+    if max_u == -np.inf: return -np.inf
+
+    sum_expu = 0.0
+    for u in utilities:
+        sum_expu += np.exp(u - max_u)
+    return max_u + np.log(sum_expu)
+
+
+@njit(nogil=True, cache=True)
+def nested_logsums_inplace(utilities: ndarray, logsums: ndarray, parent_order, child_offsets, children,
+                           logsum_scales, bottom_flags, scale_utilities=True) -> float:
+    """
+    Collects the logsum of each nest of a nested logit model, from the bottom of the tree up (the first step of
+    nested_probabilities_inplace()), without computing any probabilities.
+
+    Args:
+        utilities (float[]): The utilities of each node in the tree
+        logsums (float[]): Output array for the logsum of each nest, same length as `utilities`. Entries for nodes
+            without children are not written.
+        parent_order, child_offsets, children, logsum_scales, bottom_flags: The flattened tree, from
+            ChoiceModel._flatten()
+        scale_utilities (bool): If True, divide lower-level utilities by the logsum scale of the parent nest.
+
+    Returns (float): The top-level logsum
+    """
+    top_logsum = -np.inf
+    for k in range(len(parent_order)):
+        parent = parent_order[k]
+        start, stop = child_offsets[k], child_offsets[k + 1]
+        parent_ls_scale = 1.0 if not scale_utilities or parent < 0 else logsum_scales[parent]
+
+        # The scaled utilities get computed twice (for the maximum and then the sum), to avoid needing working space
+        max_v = -np.inf
+        for position in range(start, stop):
+            index = children[position]
+            v = utilities[index] if bottom_flags[index] else utilities[index] + logsum_scales[index] * logsums[index]
+            v /= parent_ls_scale
+            if v > max_v: max_v = v
+
+        logsum = -np.inf
+        if max_v > -np.inf:
+            sum_expv = 0.0
+            for position in range(start, stop):
+                index = children[position]
+                if bottom_flags[index]: v = utilities[index]
+                else: v = utilities[index] + logsum_scales[index] * logsums[index]
+                sum_expv += np.exp(v / parent_ls_scale - max_v)
+            logsum = max_v + np.log(sum_expv)
+
+        if parent >= 0: logsums[parent] = logsum
+        else: top_logsum = logsum
+    return top_logsum
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_logsums(utilities: ndarray) -> ndarray:
+    """Runs multinomial_logsum in parallel, returning logsums in the same precision as the utilities"""
+    n_rows = utilities.shape[0]
+    ls_array = np.zeros(n_rows, dtype=utilities.dtype)
+    for i in prange(n_rows):
+        ls_array[i] = multinomial_logsum(utilities[i, :])
+    return ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_logsums(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                          scale_utilities=True, keep_nests=False) -> Tuple[ndarray, ndarray]:
+    """
+    Runs nested_logsums_inplace in parallel. Returns the top-level logsums, and the (n_rows, n_nodes) logsums of every
+    nest if `keep_nests` is True (otherwise an empty table). Logsums are returned in the same precision as the
+    utilities.
+    """
+    n_rows, n_cols = utilities.shape
+    ls_array = np.zeros(n_rows, dtype=utilities.dtype)
+    nest_logsums = np.full((n_rows if keep_nests else 0, n_cols), np.nan, dtype=utilities.dtype)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        scratch = np.full(n_cols, np.nan, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            ls_array[i] = nested_logsums_inplace(utilities[i, :], scratch, parent_order, child_offsets, children,
+                                                 ls_scales, bottom_flags, scale_utilities)
+            if keep_nests: nest_logsums[i, :] = scratch
+    return ls_array, nest_logsums
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_multinomial_logsums_sparse(indptr: ndarray, utilities: ndarray) -> ndarray:
+    """worker_multinomial_logsums() for utilities of the available choices only, in CSR format"""
+    n_rows = len(indptr) - 1
+    ls_array = np.zeros(n_rows, dtype=utilities.dtype)
+    for i in prange(n_rows):
+        ls_array[i] = multinomial_logsum(utilities[indptr[i]: indptr[i + 1]])
+    return ls_array
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def worker_nested_logsums_sparse(indptr: ndarray, indices: ndarray, utilities: ndarray, parent_order, child_offsets,
+                                 children, ls_scales, bottom_flags, scale_utilities=True, keep_nests=False
+                                 ) -> Tuple[ndarray, ndarray]:
+    """worker_nested_logsums() for utilities of the available nodes only, in CSR format"""
+    n_rows = len(indptr) - 1
+    n_nodes = len(bottom_flags)
+    ls_array = np.zeros(n_rows, dtype=utilities.dtype)
+    nest_logsums = np.full((n_rows if keep_nests else 0, n_nodes), np.nan, dtype=utilities.dtype)
+
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        dense = np.empty(n_nodes, dtype=np.float64)
+        scratch = np.full(n_nodes, np.nan, dtype=np.float64)
+        for i in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            _scatter_nested_row(utilities[indptr[i]: indptr[i + 1]], indices[indptr[i]: indptr[i + 1]], dense)
+            ls_array[i] = nested_logsums_inplace(dense, scratch, parent_order, child_offsets, children, ls_scales,
+                                                 bottom_flags, scale_utilities)
+            if keep_nests: nest_logsums[i, :] = scratch
+    return ls_array, nest_logsums
+
+
+# endregion
+
+# region Batched kernels
+# These process a batch of BATCH_SIZE rows at a time, copied into column-major working space so that each inner loop
+# runs across the rows of the batch. The rows are independent, so LLVM can vectorize the exponentials and the
+# reductions without re-ordering any floating-point operations; results are identical to the row-at-a-time kernels.
+# Each worker is also compiled with FASTMATH_FLAGS, which allows further vectorization (and, where available, the
+# SVML vector math library) at the cost of bit-for-bit reproducibility.
+
+
+@njit(nogil=True, inline='always', cache=True)
+def _load_batch(utilities: ndarray, start: int, block: ndarray) -> int:
+    """Copies a batch of rows into column-major working space, padding past the last row with zeros"""
+    n_rows, n_cols = utilities.shape
+    width = min(BATCH_SIZE, n_rows - start)
+    for r in range(BATCH_SIZE):
+        if r < width:
+            for j in range(n_cols):
+                block[j, r] = utilities[start + r, j]
+        else:
+            for j in range(n_cols):
+                block[j, r] = 0.0
+    return width
+
+
+@njit(nogil=True, inline='always', cache=True)
+def _multinomial_batch(block: ndarray, width: int, maxes: ndarray, sums: ndarray) -> bool:
+    """
+    Overwrites a batch of utilities with multinomial logit probabilities, storing the (unshifted) sum of exponentiated
+    utilities for each row in `sums`. Returns False if any row has all utilities of -inf.
+    """
+    n_cols = block.shape[0]
+
+    for r in range(BATCH_SIZE):
+        maxes[r] = -np.inf
+        sums[r] = 0.0
+    for j in range(n_cols):
+        for r in range(BATCH_SIZE):
+            maxes[r] = max(maxes[r], block[j, r])
+
+    valid = True
+    for r in range(width):
+        if maxes[r] == -np.inf: valid = False
+
+    for j in range(n_cols):
+        for r in range(BATCH_SIZE):
+            expu = np.exp(block[j, r] - maxes[r])
+            block[j, r] = expu
+            sums[r] += expu
+
+    for j in range(n_cols):
+        for r in range(BATCH_SIZE):
+            block[j, r] = block[j, r] / sums[r]
+
+    for r in range(BATCH_SIZE):
+        sums[r] = sums[r] * np.exp(maxes[r])
+    return valid
+
+
+@njit(nogil=True, inline='always', cache=True)
+def _nested_batch(block: ndarray, width: int, out: ndarray, logsums: ndarray, maxes: ndarray, sums: ndarray,
+                  parent_order, child_offsets, children, logsum_scales, bottom_flags, scale_utilities) -> bool:
+    """
+    Writes nested logit probabilities for a batch of utilities into `out`, storing the top-level sum of exponentiated
+    utilities for each row in `sums`. Follows the same steps as nested_probabilities_inplace(), one batch at a time.
+    Returns False if any row has a top-level logsum of -inf.
+    """
+    n_parents = len(parent_order)
+    top_logsums = logsums[-1, :]  # The last row is reserved for the root
+
+    # Step 1: Compute the scaled utility of each node, and collect logsums from the bottom of the tree.
+    for k in range(n_parents):
+        parent = parent_order[k]
+        start, stop = child_offsets[k], child_offsets[k + 1]
+        parent_ls_scale = 1.0 if not scale_utilities or parent < 0 else logsum_scales[parent]
+
+        for r in range(BATCH_SIZE):
+            maxes[r] = -np.inf
+            sums[r] = 0.0
+        for position in range(start, stop):
+            index = children[position]
+            if bottom_flags[index]:
+                for r in range(BATCH_SIZE):
+                    v = block[index, r] / parent_ls_scale
+                    out[index, r] = v
+                    maxes[r] = max(maxes[r], v)
+            else:
+                ls_scale = logsum_scales[index]
+                for r in range(BATCH_SIZE):
+                    v = (block[index, r] + ls_scale * logsums[index, r]) / parent_ls_scale
+                    out[index, r] = v
+                    maxes[r] = max(maxes[r], v)
+
+        for position in range(start, stop):
+            index = children[position]
+            for r in range(BATCH_SIZE):
+                sums[r] += np.exp(out[index, r] - maxes[r])
+
+        target = logsums[parent, :] if parent >= 0 else top_logsums
+        for r in range(BATCH_SIZE):
+            target[r] = maxes[r] + np.log(sums[r]) if maxes[r] > -np.inf else -np.inf
+
+    valid = True
+    for r in range(width):
+        if top_logsums[r] == -np.inf: valid = False
+
+    # Step 2: Compute absolute probabilities from the top down. Here `maxes` holds the probability of the parent and
+    # `sums` holds its logsum.
+    for k in range(n_parents - 1, -1, -1):
+        parent = parent_order[k]
+        if parent >= 0:
+            for r in range(BATCH_SIZE):
+                maxes[r], sums[r] = out[parent, r], logsums[parent, r]
+                out[parent, r] = 0.0
+        else:
+            for r in range(BATCH_SIZE):
+                maxes[r], sums[r] = 1.0, top_logsums[r]
+
+        for position in range(child_offsets[k], child_offsets[k + 1]):
+            index = children[position]
+            for r in range(BATCH_SIZE):
+                out[index, r] = 0.0 if sums[r] == -np.inf else maxes[r] * np.exp(out[index, r] - sums[r])
+
+    for r in range(BATCH_SIZE):
+        sums[r] = np.exp(top_logsums[r])
+    return valid
+
+
+@njit(nogil=True, inline='always', cache=True)
+def _search_batch(p_block: ndarray, width: int, start: int, draws: ndarray, result: ndarray):
+    """Converts a batch of probabilities to cumulative probabilities, and samples each row using binary search"""
+    n_cols = p_block.shape[0]
+    for j in range(1, n_cols):
+        for r in range(BATCH_SIZE):
+            p_block[j, r] += p_block[j - 1, r]
+
+    n = draws.shape[1]
+    for r in range(width):
+        cps = p_block[:, r]
+        for k in range(n):
+            result[start + r, k] = logarithmic_search(draws[start + r, k], cps)
+
+
+def _multinomial_probabilities_batched(utilities: ndarray) -> Tuple[ndarray, ndarray]:
+    """Computes multinomial logit probabilities in parallel, one batch of rows at a time"""
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, n_cols), dtype=utilities.dtype)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_batches = (n_rows + BATCH_SIZE - 1) // BATCH_SIZE
+    invalid = np.zeros(n_batches, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for batch in prange(n_batches):
+        start = batch * BATCH_SIZE
+        block = np.empty((n_cols, BATCH_SIZE), dtype=np.float64)
+        maxes = np.empty(BATCH_SIZE, dtype=np.float64)
+        sums = np.empty(BATCH_SIZE, dtype=np.float64)
+
+        width = _load_batch(utilities, start, block)
+        invalid[batch] = not _multinomial_batch(block, width, maxes, sums)
+        for r in range(width):
+            result[start + r, :] = block[:, r]
+            ls_array[start + r] = sums[r]
+
+    if invalid.any():
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return result, ls_array
+
+
+def _multinomial_sample_batched(utilities: ndarray, draws: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from multinomial logit utilities in parallel, one batch of rows at a time. Takes one column of pre-computed
+    random draws per sample.
+    """
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, draws.shape[1]), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_batches = (n_rows + BATCH_SIZE - 1) // BATCH_SIZE
+    invalid = np.zeros(n_batches, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for batch in prange(n_batches):
+        start = batch * BATCH_SIZE
+        block = np.empty((n_cols, BATCH_SIZE), dtype=np.float64)
+        maxes = np.empty(BATCH_SIZE, dtype=np.float64)
+        sums = np.empty(BATCH_SIZE, dtype=np.float64)
+
+        width = _load_batch(utilities, start, block)
+        invalid[batch] = not _multinomial_batch(block, width, maxes, sums)
+        _search_batch(block, width, start, draws, result)
+        for r in range(width):
+            ls_array[start + r] = sums[r]
+
+    if invalid.any():
+        raise UtilityBoundsError("MNL utilities all exceeded minimum value (Logsum == 0.0)")
+    return result, ls_array
+
+
+def _nested_probabilities_batched(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                                  scale_utilities=True) -> Tuple[ndarray, ndarray]:
+    """Computes nested logit probabilities in parallel, one batch of rows at a time"""
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, n_cols), dtype=utilities.dtype)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_batches = (n_rows + BATCH_SIZE - 1) // BATCH_SIZE
+    invalid = np.zeros(n_batches, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for batch in prange(n_batches):
+        start = batch * BATCH_SIZE
+        block = np.empty((n_cols, BATCH_SIZE), dtype=np.float64)
+        out = np.empty((n_cols, BATCH_SIZE), dtype=np.float64)
+        logsums = np.empty((n_cols + 1, BATCH_SIZE), dtype=np.float64)
+        maxes = np.empty(BATCH_SIZE, dtype=np.float64)
+        sums = np.empty(BATCH_SIZE, dtype=np.float64)
+
+        width = _load_batch(utilities, start, block)
+        invalid[batch] = not _nested_batch(block, width, out, logsums, maxes, sums, parent_order, child_offsets,
+                                           children, ls_scales, bottom_flags, scale_utilities)
+        for r in range(width):
+            result[start + r, :] = out[:, r]
+            ls_array[start + r] = sums[r]
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return result, ls_array
+
+
+def _nested_sample_batched(utilities: ndarray, parent_order, child_offsets, children, ls_scales, bottom_flags,
+                           draws: ndarray, scale_utilities=True) -> Tuple[ndarray, ndarray]:
+    """
+    Samples from nested logit utilities in parallel, one batch of rows at a time. Takes one column of pre-computed
+    random draws per sample.
+    """
+    n_rows, n_cols = utilities.shape
+    result = np.zeros((n_rows, draws.shape[1]), dtype=np.int64)
+    ls_array = np.zeros(n_rows, dtype=np.float64)
+
+    n_batches = (n_rows + BATCH_SIZE - 1) // BATCH_SIZE
+    invalid = np.zeros(n_batches, dtype=np.bool_)  # Errors can't be raised inside a parallel loop
+    for batch in prange(n_batches):
+        start = batch * BATCH_SIZE
+        block = np.empty((n_cols, BATCH_SIZE), dtype=np.float64)
+        out = np.empty((n_cols, BATCH_SIZE), dtype=np.float64)
+        logsums = np.empty((n_cols + 1, BATCH_SIZE), dtype=np.float64)
+        maxes = np.empty(BATCH_SIZE, dtype=np.float64)
+        sums = np.empty(BATCH_SIZE, dtype=np.float64)
+
+        width = _load_batch(utilities, start, block)
+        invalid[batch] = not _nested_batch(block, width, out, logsums, maxes, sums, parent_order, child_offsets,
+                                           children, ls_scales, bottom_flags, scale_utilities)
+        _search_batch(out, width, start, draws, result)
+        for r in range(width):
+            ls_array[start + r] = sums[r]
+
+    if invalid.any():
+        raise UtilityBoundsError("Nested logit top-level logsum is 0.0")
+    return result, ls_array
+
+
+worker_multinomial_probabilities_batched = njit(parallel=True, nogil=True, cache=True)(
+    _multinomial_probabilities_batched)
+worker_multinomial_sample_batched = njit(parallel=True, nogil=True, cache=True)(_multinomial_sample_batched)
+worker_nested_probabilities_batched = njit(parallel=True, nogil=True, cache=True)(_nested_probabilities_batched)
+worker_nested_sample_batched = njit(parallel=True, nogil=True, cache=True)(_nested_sample_batched)
+
+# Numba's cache is keyed on the Python function and not the compiler flags, so the fast-math variants aren't cached
+# (they would otherwise load the strict variants' machine code, or vice-versa)
+worker_multinomial_probabilities_fastmath = njit(parallel=True, nogil=True, fastmath=FASTMATH_FLAGS)(
+    _multinomial_probabilities_batched)
+worker_multinomial_sample_fastmath = njit(parallel=True, nogil=True, fastmath=FASTMATH_FLAGS)(
+    _multinomial_sample_batched)
+worker_nested_probabilities_fastmath = njit(parallel=True, nogil=True, fastmath=FASTMATH_FLAGS)(
+    _nested_probabilities_batched)
+worker_nested_sample_fastmath = njit(parallel=True, nogil=True, fastmath=FASTMATH_FLAGS)(_nested_sample_batched)
+
 # endregion
 
 # region Misc functions
 
+
+def warmup(precisions: Tuple[int, ...] = (8, 4)):
+    """
+    Compiles (or loads from Numba's on-disk cache) the kernels used by ChoiceModel.run_stochastic() and
+    ChoiceModel.run_discrete() with their default options, for multinomial and nested models. Kernels are otherwise
+    compiled the first time they're used, which can add several seconds to the first model run in a new process.
+
+    Args:
+        precisions: The floating-point precisions (in bytes) to compile for, i.e. ChoiceModel.precision values.
+    """
+    # A small tree with one nest: root -> [nest 0 -> [1, 2], 3]. The types match those of ChoiceModel._flatten(), since
+    # the default integer type depends on the platform (e.g. 32 bits on Windows).
+    plan = (np.array([0, -1], dtype=np.int64), np.array([0, 2, 4], dtype=np.int64),
+            np.array([1, 2, 0, 3], dtype=np.int64), np.array([0.5, 1.0, 1.0, 1.0], dtype=np.float64),
+            np.array([False, True, True, True], dtype=np.bool_))
+    for precision in precisions:
+        utilities = np.zeros((2, 4), dtype=np.dtype(f"f{precision}"))
+        worker_multinomial_probabilities(utilities)
+        worker_nested_probabilities(utilities, *plan, True)
+        for n, use_alias in [(1, False), (2, False), (2, True)]:
+            worker_multinomial_sample(utilities, n, 1, use_alias)
+            worker_nested_sample(utilities, *plan, n, 1, True, use_alias)
+
+
 def fast_indexed_add(out: ndarray, addition: ndarray, row_index: ndarray = None, col_index: ndarray = None):
-    """Parallel "a += b" function for large matrices. Also allows "a[:, indexer] += b" for partial tables."""
+    """
+    Parallel "a += b" function for large matrices. Also allows "a[row_index, :][:, col_index] += b" for partial
+    tables, where repeated indices are summed (like np.add.at). Work is split between threads by rows of `out`, so no
+    two threads ever update the same cell.
+    """
     rows_a, cols_a = addition.shape
     rows_o, cols_o = out.shape
 
@@ -420,55 +1971,109 @@ def fast_indexed_add(out: ndarray, addition: ndarray, row_index: ndarray = None,
         assert len(col_index) == cols_a
         assert col_index.min() >= 0 and col_index.max() < cols_o
 
-    ri_is_none, ci_is_none = row_index is None, col_index is None
-
-    if ri_is_none and ci_is_none:
-        _fast_indexed_add_n_n(out, addition)
-    elif ri_is_none:
-        _fast_indexed_add_n_i(out, addition, col_index)
-    elif ci_is_none:
-        _fast_indexed_add_i_n(out, addition, row_index)
+    if row_index is not None and _has_duplicates(row_index):
+        # Rows of the addition which target the same row of the output are grouped together, so that each group gets
+        # reduced by a single thread
+        order = np.argsort(row_index, kind='mergesort')
+        offsets = _segment_offsets(row_index[order])
+        _indexed_add_segments(out, addition, order, offsets, row_index, _as_indexer(col_index, cols_a))
     else:
-        _fast_indexed_add_i_i(out, addition, row_index, col_index)
+        _indexed_add_rows(out, addition, _as_indexer(row_index, rows_a), _as_indexer(col_index, cols_a))
 
 
-@njit(parallel=True)
-def _fast_indexed_add_n_n(out, addition):
-    rows_a, cols_a = addition.shape
-    for offset in prange(rows_a * cols_a):
-        row, col = divmod(offset, cols_a)
-        rowi, coli = int(row), int(col)
-        out[rowi, coli] += addition[rowi, coli]
+def sparse_indexed_add(out: ndarray, data: ndarray, rows: ndarray, cols: ndarray, row_index: ndarray = None,
+                       col_index: ndarray = None):
+    """
+    Parallel "a += b" function for a sparse table b in coordinate (COO) format, i.e. `data[k]` gets added to cell
+    (rows[k], cols[k]). Optionally, the row and column numbers are mapped through `row_index` and `col_index` to
+    positions in `out`. Repeated coordinates are summed. Entries are sorted by output row, and then reduced one row at
+    a time in parallel.
+    """
+    assert len(data) == len(rows) == len(cols)
+    rows_o, cols_o = out.shape
+    if len(data) == 0: return
 
+    target_rows = rows if row_index is None else row_index[rows]
+    target_cols = cols if col_index is None else col_index[cols]
+    assert target_rows.min() >= 0 and target_rows.max() < rows_o
+    assert target_cols.min() >= 0 and target_cols.max() < cols_o
 
-@njit(parallel=True)
-def _fast_indexed_add_n_i(out, addition, col_index):
-    rows_a, cols_a = addition.shape
-    for offset in prange(0, rows_a * cols_a):
-        row, col = divmod(offset, cols_a)
-        rowi, coli = int(row), int(col)
-        target_col = col_index[coli]
-        out[rowi, target_col] += addition[rowi, coli]
+    order = np.argsort(target_rows, kind='mergesort')
+    indptr = np.zeros(rows_o + 1, dtype=np.int64)
+    np.cumsum(np.bincount(target_rows, minlength=rows_o), out=indptr[1:])
+    _csr_add_rows(out, indptr, target_cols[order].astype(np.int64), data[order], np.arange(rows_o))
 
 
-@njit(parallel=True)
-def _fast_indexed_add_i_n(out, addition, row_index):
-    rows_a, cols_a = addition.shape
-    for offset in prange(rows_a * cols_a):
-        row, col = divmod(offset, cols_a)
-        rowi, coli = int(row), int(col)
-        target_row = row_index[rowi]
-        out[target_row, coli] += addition[rowi, coli]
+def csr_indexed_add(out: ndarray, indptr: ndarray, indices: ndarray, data: ndarray, row_index: ndarray = None,
+                    col_index: ndarray = None):
+    """
+    Parallel "a += b" function for a sparse table b in compressed sparse row (CSR) format. Optionally, the row and
+    column numbers are mapped through `row_index` and `col_index` to positions in `out`. Repeated coordinates are
+    summed.
+    """
+    rows_o, cols_o = out.shape
+    n_rows = len(indptr) - 1
+
+    if row_index is not None and _has_duplicates(row_index):
+        rows = np.repeat(np.arange(n_rows), np.diff(indptr))
+        sparse_indexed_add(out, data, rows, indices, row_index, col_index)
+        return
+
+    target_cols = indices if col_index is None else col_index[indices]
+    if len(target_cols) > 0:
+        assert target_cols.min() >= 0 and target_cols.max() < cols_o
+    target_rows = _as_indexer(row_index, n_rows)
+    assert n_rows == 0 or (target_rows.min() >= 0 and target_rows.max() < rows_o)
+    _csr_add_rows(out, indptr.astype(np.int64), target_cols.astype(np.int64), data, target_rows)
+
+
+def _has_duplicates(index: ndarray) -> bool:
+    return len(np.unique(index)) < len(index)
+
+
+def _as_indexer(index: ndarray, n: int) -> ndarray:
+    return np.arange(n) if index is None else index.astype(np.int64)
+
+
+def _segment_offsets(sorted_values: ndarray) -> ndarray:
+    """Start positions of each run of equal values, plus the end position"""
+    starts = np.flatnonzero(sorted_values[1:] != sorted_values[:-1]) + 1
+    return np.concatenate(([0], starts, [len(sorted_values)])).astype(np.int64)
 
 
-@njit(parallel=True)
-def _fast_indexed_add_i_i(out, addition, row_index, col_index):
+@njit(parallel=True, nogil=True, cache=True)
+def _indexed_add_rows(out, addition, row_index, col_index):
+    """Dense scatter-add, when each row of `addition` targets a different row of `out`"""
     rows_a, cols_a = addition.shape
-    for offset in prange(rows_a * cols_a):
-        row, col = divmod(offset, cols_a)
-        rowi, coli = int(row), int(col)
-        target_row = row_index[rowi]
-        target_col = col_index[coli]
-        out[target_row, target_col] += addition[rowi, coli]
+    n_blocks = (rows_a + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        for row in range(block * ROW_BLOCK_SIZE, min(rows_a, (block + 1) * ROW_BLOCK_SIZE)):
+            target_row = row_index[row]
+            for col in range(cols_a):
+                out[target_row, col_index[col]] += addition[row, col]
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _indexed_add_segments(out, addition, order, offsets, row_index, col_index):
+    """Dense scatter-add, reducing each group of `addition` rows which target the same row of `out` in one thread"""
+    cols_a = addition.shape[1]
+    for segment in prange(len(offsets) - 1):
+        target_row = row_index[order[offsets[segment]]]
+        for position in range(offsets[segment], offsets[segment + 1]):
+            row = order[position]
+            for col in range(cols_a):
+                out[target_row, col_index[col]] += addition[row, col]
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _csr_add_rows(out, indptr, indices, data, row_index):
+    """Sparse (CSR) scatter-add, when each row targets a different row of `out`"""
+    n_rows = len(indptr) - 1
+    n_blocks = (n_rows + ROW_BLOCK_SIZE - 1) // ROW_BLOCK_SIZE
+    for block in prange(n_blocks):
+        for row in range(block * ROW_BLOCK_SIZE, min(n_rows, (block + 1) * ROW_BLOCK_SIZE)):
+            target_row = row_index[row]
+            for position in range(indptr[row], indptr[row + 1]):
+                out[target_row, indices[position]] += data[position]
 
 # endregion
@@ -0,0 +1,223 @@
+"""Control over the threads used by Numba and NumExpr when evaluating models"""
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from contextlib import contextmanager
+from threading import local, Lock
+
+import numpy as np
+import numexpr as ne
+import numba as nb
+
+try:
+    from numexpr.necompiler import NumExpr, getExprNames, getType
+except ImportError:
+    # These are private to NumExpr, so without them, programs aren't kept and numexpr.evaluate() is used instead
+    NumExpr = getExprNames = getType = None
+
+THREADING_LAYERS = {'default', 'safe', 'forksafe', 'threadsafe', 'tbb', 'omp', 'workqueue'}
+
+_active = local()  # Stack of entered ExecutionContexts (and the settings they replaced), for each Python thread
+_numexpr_lock = Lock()  # NumExpr's thread count is global to the process, so it's only changed under this lock
+_numexpr_get_threads = getattr(ne, 'get_num_threads', None)  # Not available in older versions of NumExpr
+
+# Settings for compiling NumExpr programs, matching those used by numexpr.evaluate()
+_NUMEXPR_CONTEXT = {'optimization': 'aggressive', 'truediv': False}
+_program_stats = {'hits': 0, 'misses': 0}
+_stats_lock = Lock()
+
+
+class ProgramCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+
+
+def program_cache_info(reset: bool = False) -> ProgramCacheInfo:
+    """
+    The number of times that a compiled NumExpr program was re-used (hits) or had to be compiled (misses), over all
+    expressions. If `reset` is True, the counts are set back to zero afterwards.
+    """
+    with _stats_lock:
+        info = ProgramCacheInfo(_program_stats['hits'], _program_stats['misses'])
+        if reset: _program_stats.update(hits=0, misses=0)
+    return info
+
+
+def threading_layer() -> Optional[str]:
+    """The name of the threading layer used by Numba, or None if no parallel kernel has been run yet"""
+    try:
+        return nb.threading_layer()
+    except ValueError:
+        return None
+
+
+def set_threading_layer(layer: str):
+    """
+    Selects the threading layer used by Numba for parallel kernels. This must be done before any parallel kernel is
+    run; afterwards, the threading layer can no longer be changed.
+
+    Args:
+        layer: One of 'default', 'safe', 'forksafe', 'threadsafe', 'tbb', 'omp' or 'workqueue'. See the Numba
+            documentation for details.
+    """
+    assert layer in THREADING_LAYERS, f"Unknown threading layer '{layer}'"
+    current = threading_layer()
+    if current is not None and layer not in {current, 'default'}:
+        raise RuntimeError(f"Numba has already started the '{current}' threading layer, which cannot be changed")
+    nb.config.THREADING_LAYER = layer
+
+
+def max_threads() -> int:
+    """The maximum number of threads that can be used, set by the NUMBA_NUM_THREADS environment variable"""
+    return nb.config.NUMBA_NUM_THREADS
+
+
+class ExecutionContext(object):
+    """
+    Sets the number of threads used by cheval, and restores the previous settings afterwards. Can be used as a context
+    manager around any number of model runs, for example::
+
+        with ExecutionContext(n_threads=4):
+            model.run_stochastic()
+
+    Or assigned to ChoiceModel.execution, to apply to every run of that model.
+
+    The Numba thread count is set with numba.set_num_threads(), which only applies to the calling Python thread; so
+    models running in different Python threads don't affect each other. NumExpr only has a process-wide thread count,
+    so when it differs from the requested count, it is set (under a lock) just before each expression is evaluated and
+    restored immediately afterwards. Evaluations which find the requested count already set don't wait for the lock, so
+    the NumExpr count is best-effort when Python threads request different counts at the same time: an expression can
+    run with another thread's count. This only affects the speed of the evaluation, not its results.
+    """
+
+    def __init__(self, n_threads: int = None, *, numexpr_threads: int = None, threading_layer: str = None):
+        """
+        Args:
+            n_threads: The number of threads for Numba kernels. Values larger than max_threads() are reduced to that
+                number. If None, the current setting is kept.
+            numexpr_threads: The number of threads for NumExpr evaluation. Defaults to `n_threads`.
+            threading_layer: Optionally, the threading layer to select when the context is entered. See
+                set_threading_layer().
+        """
+        assert n_threads is None or n_threads >= 1, "n_threads must be >= 1"
+        assert numexpr_threads is None or numexpr_threads >= 1, "numexpr_threads must be >= 1"
+        self.n_threads = n_threads
+        self.numexpr_threads = numexpr_threads
+        self.threading_layer = threading_layer
+
+    def __repr__(self):
+        return f"ExecutionContext(n_threads={self.n_threads}, numexpr_threads={self.numexpr_threads})"
+
+    def __enter__(self) -> 'ExecutionContext':
+        if self.threading_layer is not None: set_threading_layer(self.threading_layer)
+
+        _stack().append((self, nb.get_num_threads()))
+        if self.n_threads is not None: nb.set_num_threads(min(self.n_threads, max_threads()))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _, saved_threads = _stack().pop()
+        nb.set_num_threads(saved_threads)
+
+    @staticmethod
+    def current() -> Optional['ExecutionContext']:
+        """The innermost context entered in this Python thread, if any"""
+        stack = _stack()
+        return stack[-1][0] if stack else None
+
+    @staticmethod
+    def resolve_threads(n_threads: Optional[int], default: int) -> int:
+        """
+        Returns `n_threads` if given, otherwise the setting of the innermost active context, otherwise `default`
+        """
+        if n_threads is not None: return n_threads
+        for context, _ in reversed(_stack()):
+            if context.n_threads is not None: return context.n_threads
+        return default
+
+    @staticmethod
+    def resolve_numexpr_threads(n_threads: int) -> int:
+        """The number of NumExpr threads to use, for a run with `n_threads` Numba threads"""
+        for context, _ in reversed(_stack()):
+            if context.numexpr_threads is not None: return context.numexpr_threads
+        return n_threads
+
+
+def _stack() -> List[Tuple[ExecutionContext, int]]:
+    if not hasattr(_active, 'stack'): _active.stack = []
+    return _active.stack
+
+
+@contextmanager
+def _numexpr_threads(n_threads: int):
+    # Sets NumExpr's thread count for one call, restoring the previous count afterwards. Calls which use the current
+    # count run without the lock, so that models running in different Python threads can evaluate at the same time;
+    # another thread can change the count while they run, so it's only best-effort (see ExecutionContext).
+    if _numexpr_get_threads is not None and _numexpr_get_threads() == n_threads:
+        yield
+        return
+    with _numexpr_lock:
+        previous = ne.set_num_threads(n_threads)
+        try:
+            yield
+        finally:
+            ne.set_num_threads(previous)
+
+
+def evaluate_numexpr(expr: str, local_dict: dict, out: np.ndarray, casting: str, n_threads: int):
+    """Runs numexpr.evaluate() with the given number of threads, restoring the previous number afterwards"""
+    with _numexpr_threads(n_threads):
+        ne.evaluate(expr, local_dict=local_dict, out=out, casting=casting)
+
+
+def compile_program(programs: Dict[str, tuple], expr: str, local_dict: dict) -> Tuple[NumExpr, list, bool]:
+    """
+    Gets the compiled NumExpr program for an expression and the inputs in `local_dict`, compiling it if necessary. The
+    program is kept in `programs` (a dict owned by the caller, e.g. an Expression), keyed by the expression string and
+    the types of its inputs. Programs don't depend on the shapes of the inputs, so each is only parsed and compiled once
+    for any number of decision units and choices. (NumExpr's own cache only holds the 256 most recent programs for each
+    thread, which models with many expressions quickly exceed.)
+
+    If NumExpr's compiler can't be imported, nothing is compiled, and run_program() falls back to numexpr.evaluate().
+
+    Returns:
+        The program, its arguments (in order), and whether it uses VML functions.
+    """
+    if NumExpr is None: return None, [expr, local_dict], False
+
+    entry = programs.get(expr)
+    if entry is None:
+        names, uses_vml = getExprNames(expr, _NUMEXPR_CONTEXT)
+        entry = programs[expr] = names, uses_vml, {}
+    names, uses_vml, compiled = entry
+
+    args = [np.asarray(local_dict[name]) for name in names]
+    signature = tuple((name, getType(arg)) for name, arg in zip(names, args))
+    program = compiled.get(signature)
+    if program is None:
+        program = NumExpr(expr, signature, **_NUMEXPR_CONTEXT)  # Raises ValueError if the program is too large
+        compiled[signature] = program
+        hit = False
+    else: hit = True
+
+    with _stats_lock:
+        _program_stats['hits' if hit else 'misses'] += 1
+    return program, args, uses_vml
+
+
+def evaluate_program(programs: Dict[str, tuple], expr: str, local_dict: dict, out: Optional[np.ndarray], casting: str,
+                     n_threads: int) -> np.ndarray:
+    """Like evaluate_numexpr(), but re-uses the compiled program kept in `programs` (see compile_program())"""
+    return run_program(compile_program(programs, expr, local_dict), out, casting, n_threads)
+
+
+def run_program(compiled: Tuple[NumExpr, list, bool], out: Optional[np.ndarray], casting: str, n_threads: int
+                ) -> np.ndarray:
+    """
+    Runs a program from compile_program() with the given number of threads, writing the result to `out`. If `out` is
+    None, the result is returned in a new array, with the type and shape that NumExpr gives it.
+    """
+    program, args, uses_vml = compiled
+    with _numexpr_threads(n_threads):
+        if program is None:
+            expr, local_dict = args
+            return ne.evaluate(expr, local_dict=local_dict, out=out, order='K', casting=casting)
+        return program(*args, out=out, order='K', casting=casting, ex_uses_vml=uses_vml)
@@ -0,0 +1,165 @@
+"""Storage for incremental evaluation of utility expressions"""
+from typing import Dict, Iterable, Optional, Set, Tuple
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from .parsing.expressions import Expression
+
+
+class Contribution(object):
+    """The values added to the utility table by one expression, at their un-broadcast shape"""
+
+    def __init__(self, expr: Expression, column_index, values: np.ndarray, path: str = None):
+        self.expr = expr  # Keeps the expression alive, so that its id() stays unique
+        self.column_index = column_index
+        self.values = values
+        self.path = path  # File backing the values, if they were spilled to disk
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.path is not None else self.values.nbytes
+
+
+class ContributionStore(object):
+    """
+    Keeps the contribution of each expression to the utility table, so that only the expressions which depend on
+    re-assigned symbols need to be evaluated again. Contributions are stored at the shape that the expression broadcasts
+    to (e.g. a vector for an expression that only uses row vectors), so they often use much less memory than the
+    utility table.
+
+    Contributions are kept in memory up to `memory_limit` bytes; the rest are spilled to NumPy memmap files in
+    `spill_directory` (by default, a temporary directory that is deleted when the store is).
+    """
+
+    def __init__(self, shape: Tuple[int, int], dtype: np.dtype, memory_limit: int = None, spill_directory: str = None):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.memory_limit = memory_limit
+        self._spill_directory = spill_directory
+        self._owns_directory = False
+
+        self._contributions: Dict[int, Contribution] = {}
+        self._dependents: Dict[str, Set[int]] = {}  # Symbol name -> ids of the expressions that use it
+        self._memory_used = 0
+
+        self.version = 0  # Latest symbol version included in the stored contributions
+        self._total: np.ndarray = None  # Sum of the contributions of _total_key
+        self._total_key: Tuple[int, ...] = None
+
+        self.n_evaluated = 0  # Number of expressions evaluated in the latest update, for reporting
+
+    def __contains__(self, expr: Expression) -> bool:
+        return id(expr) in self._contributions
+
+    @property
+    def memory_used(self) -> int:
+        """The number of bytes of contributions held in memory"""
+        return self._memory_used
+
+    def stale(self, changed_symbols: Iterable[str]) -> Set[int]:
+        """The ids of the stored expressions which depend on any of the given symbols"""
+        retval = set()
+        for name in changed_symbols: retval |= self._dependents.get(name, set())
+        return retval
+
+    def put(self, expr: Expression, column_index, values: np.ndarray):
+        """Stores (or replaces) the contribution of an expression, updating the current total if it includes it"""
+        key = id(expr)
+        old = self._contributions.get(key)
+
+        if self._total is not None and key in self._total_key:
+            if not np.isfinite(values).all() or (old is not None and not np.isfinite(old.values).all()):
+                # Subtracting infinite values (e.g. -inf for unavailable choices) gives NaN, so re-build the total
+                self._total, self._total_key = None, None
+            else:
+                # Parsed expressions are shared, so the same expression can be in the total more than once
+                for _ in range(self._total_key.count(key)):
+                    if old is not None: _add(self._total, old.column_index, old.values, negative=True)
+                    _add(self._total, column_index, values)
+
+        if old is not None and old.path is not None and old.values.shape == values.shape:
+            old.values[...] = values  # Re-use the memmap file
+            old.values.flush()
+            return
+        if old is not None: self._release(key)
+
+        path = None
+        if self.memory_limit is not None and self._memory_used + values.nbytes > self.memory_limit:
+            path, values = self._spill(values)
+        contribution = Contribution(expr, column_index, values, path=path)
+        self._contributions[key] = contribution
+        self._memory_used += contribution.nbytes
+        for name in expr.all_symbols: self._dependents.setdefault(name, set()).add(key)
+
+    def discard(self, keys: Iterable[int]):
+        """Drops the contributions of the given expression ids"""
+        for key in list(keys):
+            if key in self._contributions: self._release(key)
+            if self._total_key is not None and key in self._total_key: self._total, self._total_key = None, None
+
+    def prune(self, expressions: Iterable[Expression]):
+        """Drops the contributions of any expressions not in `expressions`"""
+        keep = {id(expr) for expr in expressions}
+        self.discard([key for key in self._contributions if key not in keep])
+
+    def total(self, expressions: Iterable[Expression]) -> np.ndarray:
+        """
+        The sum of the contributions of the given expressions, which must all be stored. The sum is kept between calls
+        and updated as contributions are replaced, and only re-built from the contributions when the set of expressions
+        changes.
+        """
+        key = tuple(sorted(id(expr) for expr in expressions))
+        if self._total_key != key:
+            total = np.zeros(self.shape, dtype=self.dtype)
+            for k in key:
+                contribution = self._contributions[k]
+                _add(total, contribution.column_index, contribution.values)
+            self._total, self._total_key = total, key
+        return self._total
+
+    def close(self):
+        """Deletes all contributions, including any spill files"""
+        self.discard(list(self._contributions))
+        if self._owns_directory:
+            shutil.rmtree(self._spill_directory, ignore_errors=True)
+            self._owns_directory, self._spill_directory = False, None
+
+    def _spill(self, values: np.ndarray) -> Tuple[str, np.ndarray]:
+        if self._spill_directory is None:
+            self._spill_directory = tempfile.mkdtemp(prefix='cheval_')
+            self._owns_directory = True
+            weakref.finalize(self, shutil.rmtree, self._spill_directory, True)
+        handle, path = tempfile.mkstemp(suffix='.npy', prefix='contribution_', dir=self._spill_directory)
+        os.close(handle)
+
+        mapped = np.lib.format.open_memmap(path, mode='w+', dtype=values.dtype, shape=values.shape)
+        mapped[...] = values
+        mapped.flush()
+        return path, mapped
+
+    def _release(self, key: int):
+        contribution = self._contributions.pop(key)
+        self._memory_used -= contribution.nbytes
+        for name in contribution.expr.all_symbols:
+            dependents = self._dependents.get(name)
+            if dependents is not None: dependents.discard(key)
+        if contribution.path is not None:
+            contribution.values = None  # Closes the memmap before its file is deleted
+            try:
+                os.remove(contribution.path)
+            except OSError:
+                pass
+
+
+def _add(out: np.ndarray, column_index: Optional[object], values: np.ndarray, negative=False):
+    # Adds (or subtracts) a contribution to a utility table, broadcasting it over the rows and columns it applies to
+    if column_index is None:
+        if negative: out -= values
+        else: out += values
+    else:
+        if negative: out[:, column_index] -= values
+        else: out[:, column_index] += values
@@ -1,4 +1,5 @@
-from typing import Iterable, Dict, Union, Tuple, Set, Hashable
+from typing import Iterable, Iterator, Dict, Union, Tuple, Set, Hashable, Optional
+from collections import ChainMap
 from itertools import chain as iter_chain
 from multiprocessing import cpu_count
 from logging import Logger
@@ -7,15 +8,43 @@ from pandas import Series, DataFrame, Index, MultiIndex
 import pandas as pd
 from numpy import ndarray
 import numpy as np
-import numexpr as ne
-import numba as nb
+from numba import get_num_threads
 
 from .api import AbstractSymbol, ExpressionGroup, ChoiceNode, NumberSymbol, VectorSymbol, TableSymbol, MatrixSymbol, \
-    ExpressionSubGroup
+    ExpressionSubGroup, CoefficientTable
 from .exceptions import ModelNotReadyError
-from .core import (worker_nested_probabilities, worker_nested_sample, worker_multinomial_probabilities,
-                   worker_multinomial_sample, fast_indexed_add, UtilityBoundsError)
+from .core import (worker_weighted_sample, worker_nested_probabilities, worker_nested_sample,
+                   worker_multinomial_probabilities, worker_multinomial_sample, worker_multinomial_sample_counter,
+                   worker_nested_sample_counter,
+                   worker_multinomial_sample_fused, worker_nested_sample_fused, worker_nested_sample_draws,
+                   worker_sequential_uniforms, generate_rand_ints_for_parallel,
+                   worker_counter_uniforms, worker_multinomial_probabilities_batched, worker_multinomial_sample_batched,
+                   worker_nested_probabilities_batched, worker_nested_sample_batched,
+                   worker_multinomial_probabilities_fastmath, worker_multinomial_sample_fastmath,
+                   worker_nested_probabilities_fastmath, worker_nested_sample_fastmath,
+                   worker_multinomial_sample_without_replacement, worker_nested_sample_without_replacement,
+                   worker_multinomial_probabilities_sparse, worker_multinomial_sample_sparse,
+                   worker_nested_probabilities_sparse, worker_nested_sample_sparse,
+                   worker_multinomial_sample_sparse_without_replacement,
+                   worker_nested_sample_sparse_without_replacement,
+                   worker_multinomial_aggregate, worker_nested_aggregate, worker_multinomial_aggregate_sparse,
+                   worker_nested_aggregate_sparse, worker_multinomial_logsums, worker_nested_logsums,
+                   worker_multinomial_logsums_sparse, worker_nested_logsums_sparse,
+                   fast_indexed_add, sparse_indexed_add, csr_indexed_add,
+                   UtilityBoundsError, ALIAS_THRESHOLD, ALIAS_COLUMN_RATIO)
 from .parsing.constants import *
+from .parsing.expressions import Expression
+from .parsing.optimizer import ExpressionPlan, OptimizationReport, optimize
+from .execution import ExecutionContext, evaluate_numexpr, evaluate_program, compile_program, run_program
+from .incremental import ContributionStore
+from .codegen import KernelBuilder
+
+MAX_FUSED_EXPRESSIONS = 32  # Maximum number of expressions in one program of the 'fused' engine
+# NumExpr programs are limited to NumPy's maximum number of iterator operands (32 before NumPy 2, 64 since), which also
+# counts the output, so chunks of expressions stay well below that
+NUMPY_MAX_ARGS = 64 if int(np.__version__.split('.')[0]) >= 2 else 32
+MAX_FUSED_INPUTS = NUMPY_MAX_ARGS * 3 // 4
+MAX_PLANS = 8  # Number of optimized sets of expressions kept by each model (and its copies)
 
 
 class ChoiceModel(object):
@@ -34,14 +63,32 @@ class ChoiceModel(object):
         # Index objects
         self._decision_units: Index = None
 
+        # Available choices of each decision unit in CSR format (indptr, indices), or None if all choices are available
+        self._choice_sets: Tuple[ndarray, ndarray] = None
+        self._sampling_correction: ndarray = None  # Utility correction for each sampled choice (long format)
+
         # Cached items
         self._cached_cols: Index = None
         self._cached_utils: DataFrame = None
+        self._cached_tree: Tuple[ndarray, ndarray, ndarray, ndarray, ndarray] = None
+
+        # Incremental evaluation: the version of each symbol is the count of assignments when it was last assigned
+        self._incremental: Dict[str, object] = None  # Options of the ContributionStore, if enabled
+        self._contributions: ContributionStore = None
+        self._symbol_versions: Dict[str, int] = {}
+        self._n_assignments: int = 0
 
         # Other
         self._precision: int = 0
         self.precision = precision
         
+        # Thread settings for every run of this model. Explicit n_threads arguments take precedence.
+        self.execution: ExecutionContext = None
+        self._engine: str = 'numexpr'
+        self._programs: Dict[str, tuple] = {}  # Compiled programs of fused expressions
+        self._optimize = False
+        self._plans: Dict[tuple, Tuple[list, ExpressionPlan]] = {}  # Optimized expressions, see _expression_plan()
+
         self.debug_id = debug_id  # note that debug_id needs to be a valid label that can used to search a Pandas index
         self.debug_results: DataFrame = None
 
@@ -55,6 +102,32 @@ class ChoiceModel(object):
         assert i in {4, 8}, f"Only precision values of 4 or 8 are allowed (got {i})"
         self._precision = i
 
+    @property
+    def engine(self) -> str:
+        """
+        How utility expressions are evaluated. 'numexpr' (the default) evaluates each expression in turn, with a full
+        pass over the utility table. 'fused' combines the expressions which have the same filter into NumExpr programs
+        of up to MAX_FUSED_EXPRESSIONS expressions each, so each program makes one pass over the table (which NumExpr
+        processes in cache-sized blocks). 'numba' translates the expressions into one generated Numba kernel, which
+        loops over the rows in parallel and adds every expression to each cell of the row before moving on. Kernels are
+        compiled on first use and kept for other models with the same expressions and data layout; expressions which
+        can't be translated (e.g. using text data or unsupported functions) are evaluated with NumExpr instead.
+
+        With any engine, expressions which only vary by decision unit (using only numbers and vectors or tables of
+        decision units) are first summed into one vector of decision units, and those which only vary by choice into
+        one vector of choices. Each vector is then added to the utility table in a single pass.
+
+        All engines give the same results apart from rounding, since expressions are added up in a different order.
+        The 'fused' and 'numba' engines, and the summing of vectors, are not used when `debug_id` is set, since the
+        result of each expression is needed for debugging.
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, value: str):
+        assert value in {'numexpr', 'fused', 'numba'}, f"Unknown engine '{value}'"
+        self._engine = value
+
     @property
     def _partial_utilities(self) -> DataFrame:
         self.validate(expressions=False, assignment=False)
@@ -69,6 +142,10 @@ class ChoiceModel(object):
     # region Tree operations
 
     def _create_node(self, name: str, logsum_scale: float, parent: ChoiceNode = None) -> ChoiceNode:
+        self._cached_tree = None
+        self._reset_contributions()
+        self._choice_sets = None  # Column positions are about to change
+        self._sampling_correction = None
         expected_namespace = name
         if parent is None and name in self._all_nodes:
             old_node = self._all_nodes.pop(name)  # Remove from model dictionary
@@ -176,32 +253,63 @@ class ChoiceModel(object):
         """The maximum number of levels in a nested logit model. By definition, multinomial models have a depth of 1"""
         return max(node.level for node in self._all_nodes.values())
 
-    def _flatten(self) -> Tuple[ndarray, ndarray, ndarray, ndarray]:
-        """Converts nested structure to arrays for Numba-based processing"""
+    def _flatten(self) -> Tuple[ndarray, ndarray, ndarray, ndarray, ndarray]:
+        """
+        Converts nested structure to arrays for Numba-based processing. The arrays form a traversal plan which lets the
+        nested logit kernels visit each node once per row, with contiguous access:
+            - parent_order: Positions of each nest, from the bottom of the tree to the top, ending with -1 for the root.
+            - child_offsets: Offsets into `children` for each entry in `parent_order` (CSR format).
+            - children: Positions of the child nodes of each nest, grouped in the same order as `parent_order`.
+            - logsum_scales: The logsum scale of each node (1 for nodes without children).
+            - bottom_flags: True for nodes at the bottom of the tree (i.e. without children).
+
+        The plan is cached until the tree is changed.
+        """
+        if self._cached_tree is not None and self._tree_scales_current(): return self._cached_tree
+
         max_level = self.depth
         assert max_level > 1
         n_nodes = len(self._all_nodes)
 
-        hierarchy = np.full(n_nodes, -1, dtype='i8')
-        levels = np.zeros(n_nodes, dtype='i8')
         logsum_scales = np.ones(n_nodes, dtype='f8')
         bottom_flags = np.full(n_nodes, True, dtype='?')
 
         node_positions = {node.full_name: i for i, node in enumerate(self._all_nodes.values())}
+        nest_children: Dict[int, list] = {-1: []}
+        nest_levels: Dict[int, int] = {-1: 0}
 
         for node in self._all_nodes.values():
             position = node_positions[node.full_name]
-            levels[position] = node.level - 1  # Internal levels start at 1.
-
-            if node.parent is not None:
-                parent_position = node_positions[node.parent.full_name]
-                hierarchy[position] = parent_position
+            parent_position = -1 if node.parent is None else node_positions[node.parent.full_name]
+            nest_children.setdefault(parent_position, []).append(position)
 
             if node.is_parent:
                 logsum_scales[position] = node.logsum_scale
                 bottom_flags[position] = False
-
-        return hierarchy, levels, logsum_scales, bottom_flags
+                nest_levels[position] = node.level
+
+        # Deepest nests first, so that all children are visited before their parent. The sort is stable, so the order
+        # of insertion is otherwise preserved
+        parent_order = sorted(nest_children.keys(), key=lambda nest: -nest_levels[nest])
+
+        child_offsets = np.zeros(len(parent_order) + 1, dtype='i8')
+        children = np.zeros(n_nodes, dtype='i8')
+        offset = 0
+        for i, nest in enumerate(parent_order):
+            nest_size = len(nest_children[nest])
+            children[offset: offset + nest_size] = nest_children[nest]
+            offset += nest_size
+            child_offsets[i + 1] = offset
+
+        self._cached_tree = np.array(parent_order, dtype='i8'), child_offsets, children, logsum_scales, bottom_flags
+        return self._cached_tree
+
+    def _tree_scales_current(self) -> bool:
+        # Copies of a model share its ChoiceNodes, but changing a node's logsum scale only resets the cached tree of the
+        # model which created it, so the cached scales are checked against the nodes
+        logsum_scales = self._cached_tree[3]
+        return all(logsum_scales[i] == node.logsum_scale for i, node in enumerate(self._all_nodes.values())
+                   if node.is_parent)
 
     # endregion
     # region Expressions and scope operations
@@ -231,6 +339,9 @@ class ChoiceModel(object):
             self._decision_units = item
         else:
             self._decision_units = Index(item)
+        self._choice_sets = None
+        self._sampling_correction = None
+        self._reset_contributions()
 
     @staticmethod
     def _check_symbol_name(name: str):
@@ -300,6 +411,63 @@ class ChoiceModel(object):
     def clear_scope(self):
         self._scope.clear()
 
+    def _symbol_assigned(self, name: str):
+        self._n_assignments += 1
+        self._symbol_versions[name] = self._n_assignments
+
+    def set_incremental(self, enabled: bool = True, *, memory_limit: int = None, spill_directory: str = None):
+        """
+        Turns incremental evaluation of utilities on or off. When on, the contribution of each expression to the
+        utility table is kept between runs, and later runs only re-evaluate the expressions which use symbols that have
+        been assigned since (or that are new). This is useful when iterating a model where only some of the data
+        changes (e.g. skims in a feedback loop); runs need to be made with clear_scope=False to keep the other symbols.
+
+        Contributions are stored at the shape of the data they were computed from: for example, an expression which
+        only uses row vectors stores one value per decision unit. Updated contributions are subtracted from and added
+        to a running total, so results can differ from a full evaluation by rounding error.
+
+        Incremental evaluation is not used when `debug_id` is set, or with choice sets. Changing the choices or the
+        decision units discards all stored contributions.
+
+        Args:
+            enabled: Turns incremental evaluation on, or off (discarding all stored contributions).
+            memory_limit: The maximum number of bytes of contributions to keep in memory. Contributions beyond this
+                limit are spilled to memory-mapped files. If None, all contributions are kept in memory.
+            spill_directory: The directory for memory-mapped files. Defaults to a temporary directory, which is
+                deleted when the contributions are discarded.
+        """
+        self._reset_contributions()
+        self._incremental = {'memory_limit': memory_limit, 'spill_directory': spill_directory} if enabled else None
+
+    def _reset_contributions(self):
+        if self._contributions is not None: self._contributions.close()
+        self._contributions = None
+
+    def set_optimization(self, enabled: bool = True):
+        """
+        Turns the optimization of utility expressions on or off. When on, the expressions being evaluated are first
+        optimized as a whole: constants are folded, terms which apply the same data to the same choices are merged into
+        one (dropping any whose coefficients add up to zero), and subexpressions used by several terms (e.g.
+        `log(zones.emp + 1)` with a different coefficient for each choice) are computed once. See
+        optimization_report() for what this does to the current expressions.
+
+        Results can differ from unoptimized evaluation by rounding error, and terms with a zero coefficient are dropped
+        even where their data is NaN. Optimization is not used when `debug_id` is set, with incremental evaluation, or
+        with choice sets.
+        """
+        self._optimize = enabled
+
+    def optimization_report(self, group: Hashable = None) -> OptimizationReport:
+        """
+        Optimizes the expressions without evaluating them, reporting which terms are merged or dropped and which
+        subexpressions are shared (see set_optimization()). Print the report for a readable summary.
+
+        Args:
+            group: Only optimize the expressions in this group. By default, all expressions are optimized.
+        """
+        expressions = self._expressions if group is None else self._expressions.get_group(group)
+        return self._expression_plan(expressions).report
+
     @property
     def expressions(self) -> ExpressionGroup:
         return self._expressions
@@ -309,6 +477,204 @@ class ChoiceModel(object):
         for expr in item:
             self._expressions.append(expr)
 
+    def load_coefficients(self, table: Union[str, DataFrame], *, expression_column: str = None, group: Hashable = None,
+                          **kwargs):
+        """
+        Adds a table of linear-in-parameters utility terms, as used by many model specifications: one row for each
+        expression, and one column of coefficients for each choice (or nest). Each cell adds the expression times the
+        coefficient to the utility of that choice; blank cells are zero. The choices must be added beforehand. For
+        nested models, columns are named by the full name of the choice, e.g. 'auto.drive'.
+
+        This is equivalent to an expression like `expr * {choice1: coefficient1, choice2: coefficient2}` for each row,
+        but much faster for large tables. Each expression is evaluated once, and expressions which only vary by decision
+        unit (e.g. household attributes) form the columns of a design matrix X, so their utilities are computed as a
+        single matrix product X @ B with the table of coefficients B. Other expressions (e.g. skims) are multiplied by
+        their row of coefficients in one pass over the utility table each. X takes one column of memory (the size of
+        one decision-unit vector) for each expression which only varies by decision unit.
+
+        Rows with the same expression are added together. Expressions can use filters (`@`), in which case only the
+        coefficients of the filtered choices are used. With choice sets (see set_availability()), the terms are only
+        computed for the available choices, including the product X @ B.
+
+        Args:
+            table: A DataFrame, or the path to a CSV file which is read with pandas.read_csv().
+            expression_column: The column containing the expressions. By default, the expressions are the index of the
+                DataFrame, or the first column of the CSV file.
+            group: The name of the expression group to add the terms to. By default, the terms are ungrouped.
+            **kwargs: Passed to pandas.read_csv().
+        """
+        if isinstance(table, str):
+            table = pd.read_csv(table, index_col=None if expression_column is not None else 0, **kwargs)
+        if expression_column is not None: table = table.set_index(expression_column)
+
+        coefficients = table.astype(np.float64).fillna(0.0)
+        coefficients.index = coefficients.index.astype(str).str.strip()
+        coefficients = coefficients.groupby(level=0, sort=False).sum()
+        coefficients.columns = coefficients.columns.astype(str)
+        for label in coefficients.columns:
+            try:
+                self._make_column_mask(label)
+            except (KeyError, AssertionError):
+                raise KeyError(f"Coefficient column '{label}' does not match a choice in the model")
+
+        self._expressions.append_table(list(coefficients.index), coefficients, group=group)
+
+    # endregion
+    # region Choice sets
+
+    @property
+    def choice_sets(self) -> Optional[Tuple[ndarray, ndarray]]:
+        """
+        The choices available to each decision unit, in CSR format: the positions (in the choices Index) of the choices
+        available to decision unit i are ``indices[indptr[i]: indptr[i + 1]]``. None if all choices are available to
+        all decision units.
+        """
+        return self._choice_sets
+
+    def set_availability(self, availability: Union[DataFrame, ndarray, None]):
+        """
+        Restricts the choices available to each decision unit, for models where each decision unit can only choose from
+        a small subset of the choices. Utility expressions then only get evaluated for the available choices, and
+        run_stochastic() returns the probabilities in long format. Set to None to make all choices available again.
+
+        Args:
+            availability: Boolean table with one row per decision unit and one column per choice, True where the choice
+                is available. DataFrames get aligned to the decision units and choices, with missing cells treated as
+                unavailable. For nested models, the parent nests of any available choice are made available too.
+                Decision units without any available choices make the run methods raise a UtilityBoundsError, except
+                run_logsums(), which gives them a logsum of -inf.
+        """
+        if availability is None:
+            self._choice_sets = None
+            self._sampling_correction = None
+            return
+
+        self.validate(expressions=False, assignment=False)
+        if isinstance(availability, DataFrame):
+            availability = availability.reindex(index=self.decision_units, columns=self.choices, fill_value=False)
+            availability = availability.values
+        n_rows, n_cols = len(self.decision_units), len(self.choices)
+        assert availability.shape == (n_rows, n_cols), "Availability does not match the decision units and choices"
+
+        rows, cols = np.nonzero(availability)
+        self._set_coordinates(rows, cols)
+
+    def set_choice_sets(self, indptr: ndarray, indices: ndarray):
+        """
+        Restricts the choices available to each decision unit, the same as set_availability() but from a CSR-format
+        choice set, which avoids building a dense table of decision units by choices.
+
+        Args:
+            indptr: Offsets into `indices` for each decision unit, of length n_decision_units + 1.
+            indices: Positions in the choices Index of the choices available to each decision unit. They do not need to
+                be sorted, and duplicates are ignored.
+        """
+        self.validate(expressions=False, assignment=False)
+        indptr, indices = np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64)
+        n_rows = len(self.decision_units)
+        assert len(indptr) == n_rows + 1, "indptr must have one more element than the number of decision units"
+        assert indptr[0] == 0 and indptr[-1] == len(indices) and np.all(np.diff(indptr) >= 0), "Invalid indptr"
+
+        rows = np.repeat(np.arange(n_rows), np.diff(indptr))
+        self._set_coordinates(rows, indices)
+
+    def _set_coordinates(self, rows: ndarray, cols: ndarray):
+        # Stores the available (row, column) cells as sorted and de-duplicated CSR arrays
+        n_rows, n_cols = len(self.decision_units), len(self.choices)
+        if len(cols) > 0:
+            assert cols.min() >= 0 and cols.max() < n_cols, "Choice positions out of range"
+        rows, cols = rows.astype(np.int64), cols.astype(np.int64)
+
+        if self.depth > 1:
+            # Parent nests must be available for the nested logit kernels to reach their children
+            node_positions = {node.full_name: i for i, node in enumerate(self._all_nodes.values())}
+            parents = np.array([-1 if node.parent is None else node_positions[node.parent.full_name]
+                                for node in self._all_nodes.values()], dtype=np.int64)
+            all_rows, all_cols = [rows], [cols]
+            current_rows, current_cols = rows, cols
+            for _ in range(self.depth - 1):
+                parent_cols = parents[current_cols]
+                has_parent = parent_cols >= 0
+                current_rows, current_cols = current_rows[has_parent], parent_cols[has_parent]
+                all_rows.append(current_rows)
+                all_cols.append(current_cols)
+            rows, cols = np.concatenate(all_rows), np.concatenate(all_cols)
+
+        keys = np.unique(rows * n_cols + cols)  # Sorts by row, then by column
+        rows, cols = np.divmod(keys, n_cols)
+
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+        self._choice_sets = indptr, cols
+        self._sampling_correction = None
+
+    def sample_alternatives(self, proposal: Union[DataFrame, Series, ndarray], n_samples: int, *,
+                            random_seed: int = None, n_threads: int = None):
+        """
+        Importance sampling of alternatives, for multinomial models with too many choices to evaluate in full (e.g.
+        destination choice). For each decision unit, `n_samples` choices are drawn (with replacement) from a cheap
+        proposal distribution, and become that decision unit's choice set (see set_availability()). Subsequent calls to
+        run_stochastic() and run_discrete() then only evaluate utilities for the sampled choices, with the sampling
+        correction ``ln(k_j / (n_samples * q_j))`` added to each, where k_j is the number of times choice j was drawn
+        and q_j its proposal probability. The logsum term returned by those methods is the corrected sum of
+        exponentiated utilities, which is an unbiased estimate of the sum over all choices. Its natural log (the logsum
+        returned by run_logsums()) is only a consistent estimate of the full logsum: it is biased downward (by Jensen's
+        inequality), more so for small `n_samples`.
+
+        Any existing choice sets are replaced. Call set_availability(None) to stop sampling.
+
+        Args:
+            proposal: The (unnormalized, non-negative) proposal weights. Either a table with one row per decision unit
+                and one column per choice, or a Series or 1D array with one weight per choice, shared by all decision
+                units. DataFrames and Series get aligned to the choices (and decision units), with missing weights of 0.
+            n_samples: The number of draws for each decision unit. Must be >= 1.
+            random_seed: The random seed for the draws.
+            n_threads: The number of threads used to draw the samples. If None, the number is taken from this model's
+                `execution` setting or the active ExecutionContext; otherwise Numba's own setting is kept, with 1
+                NumExpr thread.
+        """
+        self.validate(expressions=False, assignment=False)
+        if self.depth > 1: raise NotImplementedError("Sampling of alternatives is only supported for MNL models")
+        assert n_samples >= 1
+        if random_seed is None:
+            random_seed = np.random.randint(1, 1000)
+
+        n_rows, n_cols = len(self.decision_units), len(self.choices)
+        if isinstance(proposal, DataFrame):
+            proposal = proposal.reindex(index=self.decision_units, columns=self.choices, fill_value=0).values
+        elif isinstance(proposal, Series):
+            proposal = proposal.reindex(self.choices, fill_value=0).values
+        weights = np.asarray(proposal, dtype=np.float64)
+        if weights.ndim == 1:
+            assert len(weights) == n_cols, "Proposal weights do not match the choices"
+            weights = np.broadcast_to(weights, (n_rows, n_cols))  # Avoids copying the weights for every row
+        assert weights.shape == (n_rows, n_cols), "Proposal weights do not match the decision units and choices"
+        if np.any(weights < 0): raise ValueError("Proposal weights cannot be negative")
+        row_totals = weights.sum(axis=1)
+        if np.any(row_totals <= 0): raise ValueError("Proposal weights must have a positive total for each row")
+
+        with self._execution_context(n_threads, default=1):
+            draws = worker_weighted_sample(weights, n_samples, random_seed)
+
+        # Count repeated draws of the same choice, which also sorts the sampled choices of each row
+        keys, counts = np.unique(np.repeat(np.arange(n_rows), n_samples) * n_cols + draws.ravel(), return_counts=True)
+        rows, cols = np.divmod(keys, n_cols)
+        self._set_coordinates(rows, cols)
+
+        q = weights[rows, cols] / row_totals[rows]
+        self._sampling_correction = np.log(counts / (n_samples * q))
+
+    def _long_index(self, positions: ndarray = None) -> MultiIndex:
+        # Labels of each available cell, in the order of the choice sets
+        indptr, indices = self._choice_sets
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        cols = indices
+        if positions is not None: rows, cols = rows[positions], cols[positions]
+
+        row_index, col_index = self.decision_units, self.choices
+        arrays = [row_index.take(rows)] + [col_index.get_level_values(i).take(cols) for i in range(col_index.nlevels)]
+        return MultiIndex.from_arrays(arrays, names=[row_index.name] + list(col_index.names))
+
     # endregion
     # region Run methods
 
@@ -355,11 +721,14 @@ class ChoiceModel(object):
             if assignment: assert_valid(self._scope[name].filled, f"Symbol '{name}' is declared but never assigned")
 
     def run_discrete(self, *, random_seed: int = None, n_draws: int = 1,
-                     astype: Union[str, np.dtype] = 'category', squeeze: bool = True, n_threads: int = 1,
-                     clear_scope: bool = True, result_name: str = None, logger: Logger = None, scale_utilities=True
-                     ) -> Tuple[Union[DataFrame, Series], Series]:
+                     astype: Union[str, np.dtype] = 'category', squeeze: bool = True, n_threads: int = None,
+                     clear_scope: bool = True, result_name: str = None, logger: Logger = None, scale_utilities=True,
+                     sampler: str = 'auto', rng: str = 'sequential', kernel: str = 'row', replace: bool = True,
+                     return_log_q: bool = False, block_size: int = None, memory_limit: int = None
+                     ) -> Union[Tuple[Union[DataFrame, Series], Series],
+                                Tuple[Union[DataFrame, Series], Series, Union[DataFrame, Series]]]:
         """
-        For each decision unit, discretely sample one or more times (with replacement) from the probability
+        For each decision unit, discretely sample one or more times (with or without replacement) from the probability
         distribution.
 
         Args:
@@ -371,7 +740,9 @@ class ChoiceModel(object):
                 The special value 'index' returns the positional index in the sorted array of node names.
             squeeze: Only used when n_draws == 1. If True, then a Series will be returned, otherwise a DataFrame
                 with one column will be returned.
-            n_threads: The number of threads to uses in the computation. Must be >= 1
+            n_threads: The number of threads to uses in the computation. Must be >= 1. If None, the number is taken from
+                this model's `execution` setting or the active ExecutionContext; otherwise Numba's own setting is
+                kept, with 1 NumExpr thread.
             clear_scope: If True and override_utilities not provided, data stored in the scope for
                 utility computation will be released, freeing up memory. Turning this off is of limited use.
             result_name: Name for the result Series or name of the columns of the result DataFrame. Purely aesthetic.
@@ -379,12 +750,47 @@ class ChoiceModel(object):
             scale_utilities: For a nested model, if True then lower-level utilities will be divided by the logsum scale
                 of the parent nest. If False, no scaling is performed. This is entirely dependant on the reported form
                 of estimated model parameters.
+            sampler: The algorithm used to make multiple draws per decision unit. 'search' uses a binary search over the
+                cumulative probabilities for each draw. 'alias' builds a Walker alias table for each decision unit,
+                which costs more to set up but makes each draw O(1). 'auto' uses the alias method when n_draws is large
+                enough to amortize the setup, relative to the number of choices. Note that the two methods give
+                different (but equally valid) results for the same random seed. 'fused' does not compute a row of
+                probabilities: for multinomial models, it makes a single pass over each row of utilities and then uses
+                binary search, giving the same results as 'search' for the same random seed. For nested models, it
+                only collects the logsum of each nest, and each draw then descends the tree, choosing among the
+                children of one nest at a time; this can give different (but equally valid) results than 'search'.
+            rng: The source of random draws. 'sequential' draws from a single random sequence in the order of the
+                decision units. 'counter' uses a counter-based generator keyed on the random seed, the (hashed) label
+                of each decision unit, and the draw number; so each decision unit gets the same draws regardless of
+                the order or subset of decision units, the number of threads, or how the run is split into chunks or
+                processes. Labels must have the same values and dtype between runs to be reproducible.
+            kernel: The probability kernel. 'row' processes one decision unit at a time. 'batched' processes blocks of
+                decision units together, which allows the CPU to vectorize the computation across rows, and gives the
+                same results as 'row'. 'fastmath' is 'batched' with relaxed floating-point rules, which can be faster
+                still but results can differ in the last few bits. The batched kernels always sample using binary
+                search, so they can only be used with sampler='auto' or 'search'. Only 'row' is supported with choice
+                sets.
+            replace: If False, each decision unit samples n_draws distinct choices (a choice set), in the order they
+                would be drawn one at a time; so the first draw is a regular sample. Uses the Gumbel top-k method,
+                ignoring the `sampler` and `kernel` options. If fewer than n_draws choices are available (i.e. have
+                non-zero probability), the extra cells are set to -1 (or NaN for non-index results). For
+                astype='index', results use the smallest signed integer dtype that fits.
+            return_log_q: If True (only with replace=False), a third item is also returned: the log inclusion
+                probability of each sampled choice, conditional on the (n_draws + 1)-th largest key, for correcting
+                utilities when modelling with sampled choice sets. It has the same shape as the results.
+            block_size: If given, the decision units are evaluated and sampled in consecutive blocks of this many rows
+                (see iter_blocks()), so that only one block of utilities is held in memory at a time. Results are the
+                same as an unblocked run. With rng='sequential', the draws for every decision unit are generated up
+                front.
+            memory_limit: If `block_size` is not given, the number of bytes to allow for each block (see
+                iter_blocks()).
 
         Returns:
             Tuple[DataFrame or Series, Series]: The first item returned is always the results of the model evaluation,
                 representing the choice(s) made by each decision unit. If n_draws > 1, the result is a DataFrame, with
                 n_draws columns, otherwise a Series. The second item is the top-level logsum term from the logit model,
                 for each decision unit. This is always a Series, as its value doesn't change with the number of draws.
+                If `return_log_q` is True, the log inclusion probabilities are returned as a third item.
 
         """
         self.validate()
@@ -392,26 +798,211 @@ class ChoiceModel(object):
             random_seed = np.random.randint(1, 1000)
 
         assert n_draws >= 1
+        assert sampler in {'auto', 'search', 'alias', 'fused'}, f"Unknown sampler '{sampler}'"
+        assert rng in {'sequential', 'counter'}, f"Unknown random number generator '{rng}'"
+        assert kernel in {'row', 'batched', 'fastmath'}, f"Unknown kernel '{kernel}'"
+        assert kernel == 'row' or sampler in {'auto', 'search'}, f"The '{kernel}' kernel only supports binary search"
+
+        assert not (replace and return_log_q), "Inclusion probabilities are only returned without replacement"
+        if self._choice_sets is not None:
+            assert kernel == 'row', "Only the 'row' kernel is supported with choice sets"
+
+        if block_size is not None or memory_limit is not None:
+            results = self._run_discrete_blocks(block_size, memory_limit, random_seed, n_draws, astype, squeeze,
+                                                n_threads, clear_scope, result_name, logger, scale_utilities, sampler,
+                                                rng, kernel, replace)
+        elif self._choice_sets is not None:
+            results = self._run_discrete_sparse(random_seed, n_draws, astype, squeeze, n_threads, clear_scope,
+                                                result_name, logger, scale_utilities, sampler, rng, replace)
+        else:
+            results = self._run_discrete_dense(random_seed, n_draws, astype, squeeze, n_threads, clear_scope,
+                                               result_name, logger, scale_utilities, sampler, rng, kernel, replace)
+        return results if return_log_q else results[:2]
+
+    def _run_discrete_dense(self, random_seed: int, n_draws: int, astype, squeeze: bool, n_threads: Optional[int],
+                            clear_scope: bool, result_name: str, logger: Logger, scale_utilities: bool, sampler: str,
+                            rng: str, kernel: str, replace: bool, draws: ndarray = None, row_seeds: ndarray = None):
+        # run_discrete() for models without choice sets. Pre-computed `draws` are sampled using binary search (or the
+        # alias method, or the tree descent of the 'fused' sampler for nested models), which gives the same results as
+        # the unblocked run with the seed they were generated from. Likewise, pre-computed `row_seeds` are used for
+        # sampling without replacement.
 
         # Utility computations
-        utility_table = self._evaluate_utilities(self._expressions, n_threads=n_threads, logger=logger).values
+        context = self._execution_context(n_threads, default=1)
+        utility_table = self._evaluate_utilities(self._expressions, n_threads=context.numexpr_threads,
+                                                 logger=logger).values
         if clear_scope: self.clear_scope()
 
+        alias_threshold = max(ALIAS_THRESHOLD, utility_table.shape[1] // ALIAS_COLUMN_RATIO)
+        use_alias = sampler == 'alias' or (sampler == 'auto' and n_draws >= alias_threshold and kernel == 'row')
+
         # Compute probabilities and sample
-        nb.config.NUMBA_NUM_THREADS = n_threads  # Set the number of threads for parallel execution
-        nested = self.depth > 1
-        if nested:
-            hierarchy, levels, logsum_scales, bottom_flags = self._flatten()
-            raw_result, logsum = worker_nested_sample(utility_table, hierarchy, levels, logsum_scales, bottom_flags,
-                                                      n_draws, random_seed, scale_utilities=scale_utilities)
-        else:
-            raw_result, logsum = worker_multinomial_sample(utility_table, n_draws, random_seed)
+        with context:
+            nested = self.depth > 1
+            if not replace:
+                use_counter = rng == 'counter'
+                unit_hashes = self._hash_decision_units() if use_counter else np.zeros(0, dtype=np.uint64)
+                if nested:
+                    raw_result, log_q, logsum = worker_nested_sample_without_replacement(
+                        utility_table, *self._flatten(), n_draws, random_seed, unit_hashes, use_counter,
+                        scale_utilities, row_seeds
+                    )
+                else:
+                    raw_result, log_q, logsum = worker_multinomial_sample_without_replacement(
+                        utility_table, n_draws, random_seed, unit_hashes, use_counter, row_seeds
+                    )
+
+                return self._convert_choice_set(raw_result, log_q, logsum, astype, squeeze, result_name)
+            elif use_alias and draws is not None:
+                if nested:
+                    raw_result, logsum = worker_nested_sample(utility_table, *self._flatten(), n_draws, random_seed,
+                                                              scale_utilities, True, draws)
+                else:
+                    raw_result, logsum = worker_multinomial_sample(utility_table, n_draws, random_seed, True, draws)
+            elif draws is not None and not nested and kernel == 'row' and sampler != 'fused':
+                # The same kernel as the unblocked run, which the 'fused' sampler can differ from in the last bit
+                raw_result, logsum = worker_multinomial_sample(utility_table, n_draws, random_seed, False, draws)
+            elif sampler == 'fused' or kernel != 'row' or draws is not None:
+                if draws is None and rng == 'counter':
+                    draws = worker_counter_uniforms(np.uint64(random_seed), self._hash_decision_units(), n_draws)
+                elif draws is None:
+                    draws = worker_sequential_uniforms(random_seed, utility_table.shape[0], n_draws)
+
+                if kernel == 'batched':
+                    nested_worker, mnl_worker = worker_nested_sample_batched, worker_multinomial_sample_batched
+                elif kernel == 'fastmath':
+                    nested_worker, mnl_worker = worker_nested_sample_fastmath, worker_multinomial_sample_fastmath
+                elif sampler == 'fused':
+                    nested_worker, mnl_worker = worker_nested_sample_fused, worker_multinomial_sample_fused
+                else:
+                    nested_worker, mnl_worker = worker_nested_sample_draws, worker_multinomial_sample_fused
+
+                if nested:
+                    raw_result, logsum = nested_worker(utility_table, *self._flatten(), draws, scale_utilities)
+                else:
+                    raw_result, logsum = mnl_worker(utility_table, draws)
+            elif rng == 'counter':
+                unit_hashes = self._hash_decision_units()
+                seed = np.uint64(random_seed)
+                if nested:
+                    raw_result, logsum = worker_nested_sample_counter(utility_table, *self._flatten(), n_draws, seed,
+                                                                      unit_hashes, scale_utilities, use_alias)
+                else:
+                    raw_result, logsum = worker_multinomial_sample_counter(utility_table, n_draws, seed, unit_hashes,
+                                                                           use_alias)
+            elif nested:
+                raw_result, logsum = worker_nested_sample(utility_table, *self._flatten(), n_draws, random_seed,
+                                                          scale_utilities, use_alias)
+            else:
+                raw_result, logsum = worker_multinomial_sample(utility_table, n_draws, random_seed, use_alias)
 
         # Finalize results
         logsum = Series(logsum, index=self.decision_units)
         result = self._convert_result(raw_result, astype, squeeze, result_name)
         return result, logsum
 
+    def _run_discrete_sparse(self, random_seed: int, n_draws: int, astype, squeeze: bool, n_threads: Optional[int],
+                             clear_scope: bool, result_name: str, logger: Logger, scale_utilities: bool, sampler: str,
+                             rng: str, replace: bool, draws: ndarray = None, row_seeds: ndarray = None) -> tuple:
+        # run_discrete() for models with choice sets. Random draws are pre-computed (unless given), so with binary
+        # search, each decision unit gets the same results as it would with unavailable choices set to -inf. The same
+        # goes for sampling without replacement, whose draws are made per choice (from the given `row_seeds`, if any).
+        context = self._execution_context(n_threads, default=1)
+        utilities = self._evaluate_utilities_long(self._expressions, n_threads=context.numexpr_threads, logger=logger)
+        if clear_scope: self.clear_scope()
+
+        indptr, indices = self._choice_sets
+        max_width = np.diff(indptr).max() if len(indptr) > 1 else 0
+        alias_threshold = max(ALIAS_THRESHOLD, max_width // ALIAS_COLUMN_RATIO)
+        use_alias = sampler == 'alias' or (sampler == 'auto' and n_draws >= alias_threshold)
+
+        with context:
+            if not replace:
+                use_counter = rng == 'counter'
+                unit_hashes = self._hash_decision_units() if use_counter else np.zeros(0, dtype=np.uint64)
+                if self.depth > 1:
+                    raw_result, log_q, logsum = worker_nested_sample_sparse_without_replacement(
+                        indptr, indices, utilities, *self._flatten(), n_draws, random_seed, unit_hashes, use_counter,
+                        scale_utilities, row_seeds
+                    )
+                else:
+                    raw_result, log_q, logsum = worker_multinomial_sample_sparse_without_replacement(
+                        indptr, indices, utilities, n_draws, random_seed, unit_hashes, use_counter, row_seeds
+                    )
+                return self._convert_choice_set(raw_result, log_q, logsum, astype, squeeze, result_name)
+
+            if draws is None and rng == 'counter':
+                draws = worker_counter_uniforms(np.uint64(random_seed), self._hash_decision_units(), n_draws)
+            elif draws is None:
+                draws = worker_sequential_uniforms(random_seed, len(indptr) - 1, n_draws)
+
+            if self.depth > 1:
+                raw_result, logsum = worker_nested_sample_sparse(indptr, indices, utilities, *self._flatten(), draws,
+                                                                 scale_utilities, use_alias)
+            else:
+                raw_result, logsum = worker_multinomial_sample_sparse(indptr, indices, utilities, draws, use_alias)
+
+        logsum = Series(logsum, index=self.decision_units)
+        result = self._convert_result(raw_result, astype, squeeze, result_name)
+        return result, logsum
+
+    def _run_discrete_blocks(self, block_size: Optional[int], memory_limit: Optional[int], random_seed: int,
+                             n_draws: int, astype, squeeze: bool, n_threads: Optional[int], clear_scope: bool,
+                             result_name: str, logger: Logger, scale_utilities: bool, sampler: str, rng: str,
+                             kernel: str, replace: bool) -> tuple:
+        # run_discrete() over blocks of decision units. Counter-based draws are keyed on each decision unit, so blocks
+        # get the same draws by themselves; sequential draws (or the row seeds for sampling without replacement) are
+        # generated for all decision units and sliced.
+        sparse = self._choice_sets is not None
+        if sparse and sampler == 'auto':
+            # Choose the sampler from the widest choice set of all decision units, rather than of each block
+            indptr = self._choice_sets[0]
+            max_width = np.diff(indptr).max() if len(indptr) > 1 else 0
+            sampler = 'alias' if n_draws >= max(ALIAS_THRESHOLD, max_width // ALIAS_COLUMN_RATIO) else 'search'
+
+        draws, row_seeds = None, None
+        if rng == 'sequential' and replace:
+            draws = worker_sequential_uniforms(random_seed, len(self.decision_units), n_draws)
+        elif rng == 'sequential':
+            row_seeds = generate_rand_ints_for_parallel(random_seed, len(self.decision_units))
+
+        results = []
+        for rows, block in self._iter_blocks(block_size, memory_limit):
+            block_draws = None if draws is None else draws[rows]
+            block_seeds = None if row_seeds is None else row_seeds[rows]
+            if sparse:
+                results.append(block._run_discrete_sparse(random_seed, n_draws, astype, squeeze, n_threads, True,
+                                                          result_name, logger, scale_utilities, sampler, rng,
+                                                          replace, draws=block_draws, row_seeds=block_seeds))
+            else:
+                results.append(block._run_discrete_dense(random_seed, n_draws, astype, squeeze, n_threads, True,
+                                                         result_name, logger, scale_utilities, sampler, rng, kernel,
+                                                         replace, draws=block_draws, row_seeds=block_seeds))
+        if clear_scope: self.clear_scope()
+
+        return tuple(pd.concat(items) for items in zip(*results))
+
+    def _execution_context(self, n_threads: Optional[int], default: int) -> ExecutionContext:
+        """
+        The ExecutionContext for a run. The number of threads is taken from the argument if given, otherwise from this
+        model's `execution` setting, otherwise from the innermost active ExecutionContext. If none of these are set,
+        Numba's own thread count is kept, and NumExpr uses the default.
+        """
+        model_context = self.execution if self.execution is not None else ExecutionContext()
+        if n_threads is None: n_threads = model_context.n_threads
+        n_threads = ExecutionContext.resolve_threads(n_threads, None)
+
+        numexpr_threads = model_context.numexpr_threads
+        if numexpr_threads is None:
+            numexpr_threads = ExecutionContext.resolve_numexpr_threads(default if n_threads is None else n_threads)
+
+        return ExecutionContext(n_threads, numexpr_threads=numexpr_threads,
+                                threading_layer=model_context.threading_layer)
+
+    def _hash_decision_units(self) -> ndarray:
+        """Stable 64-bit hashes of the decision unit labels, used to key counter-based random draws"""
+        return pd.util.hash_pandas_object(self.decision_units, index=False).values.astype(np.uint64)
+
     def _make_column_mask(self, filter_: str) -> Union[int, None]:
         if filter_ is None: return None
         col_index = self.choices
@@ -426,6 +1017,30 @@ class ChoiceModel(object):
             index_item = tuple(filter_parts + ['.'] * (column_depth - len(filter_parts)))
         return col_index.get_loc(index_item)  # Get the column number for the selected choice
 
+    def _shared_locals(self, expressions: Union[ExpressionGroup, ExpressionSubGroup], dtype: np.dtype,
+                       exclude: Set[str] = frozenset()) -> Dict[str, object]:
+        # Scalar, vector, and matrix variables that don't need any further processing. Python floats are converted to
+        # the utility dtype, to keep them from upcasting single-precision arrays.
+        scalar_type = np.dtype(dtype).type
+        shared_locals = {NAN_STR: scalar_type(np.nan), NEG_INF_STR: scalar_type(NEG_INF_VAL)}
+        for name in expressions.itersimple():
+            if name in shared_locals or name in exclude: continue
+            value = self._scope[name]._get()
+            shared_locals[name] = scalar_type(value) if isinstance(value, float) else value
+        return shared_locals
+
+    def _expression_locals(self, expr: Expression, shared_locals: Dict[str, object], dtype: np.dtype
+                           ) -> Dict[str, object]:
+        # Makes a shallow copy of the shared symbols, adding the dict literals (expanded to cover all choices) and the
+        # chained symbols (evaluated on-the-fly) of one expression
+        local_dict = shared_locals.copy()
+        expr._prepare_dict_literals(self.choices, local_dict, dtype=dtype)
+        for symbol_name, usages in expr.chains.items():
+            symbol = self._scope[symbol_name]
+            for substitution, chain_info in usages.items():
+                local_dict[substitution] = symbol._get(chain_info=chain_info)
+        return local_dict
+
     def _evaluate_utilities(self, expressions: Union[ExpressionGroup, ExpressionSubGroup],
                             n_threads: int = None, logger: Logger = None, allow_casting=True) -> DataFrame:
         if self._decision_units is None:
@@ -435,6 +1050,9 @@ class ChoiceModel(object):
         row_index = self._decision_units
         col_index = self.choices
 
+        if self._incremental is not None and not self.debug_id:
+            return self._evaluate_utilities_incremental(expressions, n_threads, logger, allow_casting)
+
         # if debug, get index location of corresponding id
         if self.debug_id:
             debug_label = row_index.get_loc(self.debug_id)
@@ -442,36 +1060,42 @@ class ChoiceModel(object):
             debug_results = []
 
         utilities = self._partial_utilities.values
+        single_precision = utilities.dtype == np.float32
 
         # Prepare locals, including scalar, vector, and matrix variables that don't need any further processing.
-        shared_locals = {NAN_STR: np.nan, OUT_STR: utilities, NEG_INF_STR: NEG_INF_VAL}
-        for name in expressions.itersimple():
-            if name in shared_locals: continue
-            symbol = self._scope[name]
-            shared_locals[name] = symbol._get()
+        shared_locals = self._shared_locals(expressions, utilities.dtype)
+        shared_locals[OUT_STR] = utilities
 
-        ne.set_num_threads(n_threads)
         casting_rule = 'same_kind' if allow_casting else 'safe'
 
+        if any(True for _ in expressions.itertables()):
+            self._evaluate_tables(expressions, shared_locals, utilities, casting_rule, n_threads, logger)
+            if self.debug_id:
+                debug_expr.append('(coefficient tables)')
+                debug_results.append(utilities[debug_label].copy())
+
+        if self._optimize and not self.debug_id:
+            expressions = self._evaluate_plan(expressions, shared_locals, utilities.dtype, casting_rule, n_threads,
+                                              logger)
+        if not self.debug_id:
+            expressions = self._evaluate_hoisted(expressions, shared_locals, utilities, casting_rule, n_threads, logger)
+        if self._engine == 'fused' and not self.debug_id:
+            self._evaluate_fused(expressions, shared_locals, utilities, casting_rule, n_threads, logger)
+            expressions = []
+        elif self._engine == 'numba' and not self.debug_id:
+            expressions = self._evaluate_numba(expressions, shared_locals, utilities, n_threads, logger)
+
         for expr in expressions:
             if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}'")
             # TODO: Add error handling
 
             choice_mask = self._make_column_mask(expr.filter_)
 
-            local_dict = shared_locals.copy()  # Make a shallow copy of the shared symbols
-
-            # Add in any dict literals, expanding them to cover all choices
-            expr._prepare_dict_literals(col_index, local_dict)
+            local_dict = self._expression_locals(expr, shared_locals, utilities.dtype)
+            transformed = expr._prepare_single_precision(local_dict) if single_precision else expr.transformed
 
-            # Evaluate any chains on-the-fly
-            for symbol_name, usages in expr.chains.items():
-                symbol = self._scope[symbol_name]
-                for substitution, chain_info in usages.items():
-                    data = symbol._get(chain_info=chain_info)
-                    local_dict[substitution] = data
-
-            self._kernel_eval(expr.transformed, local_dict, utilities, choice_mask, casting_rule=casting_rule)
+            self._kernel_eval(transformed, local_dict, utilities, choice_mask, casting_rule=casting_rule,
+                              n_threads=n_threads, programs=expr._programs)
 
             # save each expression and values for a specific od pair
             if self.debug_id:
@@ -488,20 +1112,490 @@ class ChoiceModel(object):
 
         return DataFrame(utilities, index=row_index, columns=col_index)
 
+    def _coefficient_matrix(self, table: CoefficientTable, dtype: np.dtype) -> ndarray:
+        # The coefficients of a table for each column of the utility table, with filtered choices applied
+        matrix = np.zeros([len(table.expressions), len(self.choices)], dtype=dtype)
+        for label, values in table.coefficients.items():
+            column_index = self._make_column_mask(label)
+            if isinstance(column_index, (int, np.integer)): matrix[:, column_index] += values.values
+            else: matrix[:, column_index] += values.values[:, np.newaxis]
+
+        for i, expr in enumerate(table.expressions):
+            if expr.filter_ is None: continue
+            keep = np.zeros(len(self.choices), dtype=np.bool_)
+            keep[self._make_column_mask(expr.filter_)] = True
+            matrix[i, ~keep] = 0
+        return matrix
+
+    def _evaluate_tables(self, expressions: Union[ExpressionGroup, ExpressionSubGroup],
+                         shared_locals: Dict[str, object], utilities: ndarray, casting_rule: str, n_threads: int,
+                         logger: Logger):
+        # Adds the terms of coefficient tables (see load_coefficients()) to the utility table. Unfiltered expressions
+        # which only vary by decision unit form a design matrix, which is multiplied by their coefficients in one matrix
+        # product.
+        n_rows, n_cols = utilities.shape
+        dtype = utilities.dtype
+        for table in expressions.itertables():
+            coefficients = self._coefficient_matrix(table, dtype)
+            orientations = [self._expression_orientation(expr, shared_locals) for expr in table.expressions]
+            design_rows = [i for i, (expr, orientation) in enumerate(zip(table.expressions, orientations))
+                           if orientation == 0 and expr.filter_ is None]
+            design_columns = {i: j for j, i in enumerate(design_rows)}
+            design = np.zeros([n_rows, len(design_rows)], dtype=dtype, order='F')
+            column_sum = np.zeros(n_cols, dtype=dtype)
+
+            for i, (expr, orientation) in enumerate(zip(table.expressions, orientations)):
+                if logger is not None: logger.debug(f"Evaluating coefficient table expression '{expr.raw}'")
+                local_dict = self._expression_locals(expr, shared_locals, dtype)
+                transformed = expr._prepare_single_precision(local_dict) if dtype == np.float32 else expr.transformed
+
+                if orientation is None:
+                    # Varies by decision unit and choice, so it's multiplied by the coefficients cell-by-cell. It's only
+                    # evaluated for its filtered choices (which also selects their coefficients), as it can be
+                    # undefined for the others.
+                    local_dict[COEFFICIENTS_STR] = coefficients[i].reshape(1, -1)
+                    self._kernel_eval(f"({transformed}) * {COEFFICIENTS_STR}", local_dict, utilities,
+                                      self._make_column_mask(expr.filter_), casting_rule=casting_rule,
+                                      n_threads=n_threads, programs=expr._programs)
+                    continue
+
+                values = evaluate_program(expr._programs, transformed, local_dict, None, casting_rule, n_threads)
+                column_index = self._make_column_mask(expr.filter_)
+                if orientation == 0 and column_index is None:
+                    design[:, design_columns[i]] = values.reshape(-1)
+                elif orientation == 0:
+                    # Filtered terms are only added to their own choices, as they can be undefined (e.g. -inf) for the
+                    # others, where a coefficient of 0 would give NaN
+                    values = np.reshape(values, [-1, 1])
+                    if isinstance(column_index, (int, np.integer)):
+                        utilities[:, column_index] += values[:, 0] * coefficients[i, column_index]
+                    else:
+                        utilities[:, column_index] += values * coefficients[i, column_index]
+                else:
+                    choice_mask = slice(None) if column_index is None else column_index
+                    values = np.broadcast_to(np.reshape(values, -1), [n_cols])
+                    column_sum[choice_mask] += values[choice_mask] * coefficients[i, choice_mask]
+
+            if design_rows:
+                product = design @ coefficients[design_rows]
+                product += column_sum
+                utilities += product
+            else:
+                utilities += column_sum
+
+    def _symbol_axes(self, name: str, values: Dict[str, object] = None) -> Set[int]:
+        # The axes of the utility table (0 for decision units, 1 for choices) which a symbol varies over. Other names
+        # (e.g. the shared subexpressions of optimized expressions) are classified by the shape of their `values`.
+        symbol = self._scope.get(name)
+        if symbol is None:
+            shape = np.shape(values[name]) if values is not None and name in values else ()
+            return {axis for axis in (0, 1) if shape[axis] > 1} if len(shape) == 2 else set()
+        if isinstance(symbol, NumberSymbol): return set()
+        if isinstance(symbol, (VectorSymbol, TableSymbol)): return {symbol._orientation}
+        return {0, 1}
+
+    def _expression_orientation(self, expr: Expression, values: Dict[str, object] = None) -> Optional[int]:
+        # 0 if the expression only varies by decision unit, 1 if it only varies by choice (or not at all), and None if
+        # it varies by both
+        axes = {1} if expr.dict_literals else set()
+        for name in expr.all_symbols: axes |= self._symbol_axes(name, values)
+        if axes == {0, 1}: return None
+        return 0 if axes == {0} else 1
+
+    def _expression_plan(self, expressions: Iterable[Expression]) -> ExpressionPlan:
+        # Optimizes the expressions, re-using the plan from an earlier evaluation if the same expressions use symbols of
+        # the same orientations
+        expressions = list(expressions)
+        axes = {name: frozenset(self._symbol_axes(name)) for expr in expressions for name in expr.all_symbols}
+        key = tuple(id(expr) for expr in expressions), frozenset(axes.items())
+        entry = self._plans.get(key)
+        if entry is None:
+            entry = self._plans[key] = expressions, optimize(expressions, lambda name: axes[name])
+            while len(self._plans) > MAX_PLANS: del self._plans[next(iter(self._plans))]
+        return entry[1]  # The expressions are kept in the entry, so that their ids stay unique
+
+    def _evaluate_plan(self, expressions: Union[ExpressionGroup, ExpressionSubGroup], shared_locals: Dict[str, object],
+                       dtype: np.dtype, casting_rule: str, n_threads: int, logger: Logger) -> list:
+        # Adds the variables and shared subexpressions of the optimized expressions to the shared locals, and returns
+        # the optimized terms to evaluate instead of the expressions
+        plan = self._expression_plan(expressions)
+
+        expression_locals = {}
+        for name, (expr, original_name) in plan.locals.items():
+            if id(expr) not in expression_locals: expression_locals[id(expr)] = self._expression_locals(expr, {}, dtype)
+            shared_locals[name] = expression_locals[id(expr)][original_name]
+
+        for name, temporary in plan.temporaries:
+            if logger is not None: logger.debug(f"Evaluating shared subexpression {name} = '{temporary.raw}'")
+            local_dict = shared_locals.copy()
+            transformed = temporary._prepare_single_precision(local_dict) if dtype == np.float32 else \
+                temporary.transformed
+            value = evaluate_program(temporary._programs, transformed, local_dict, None, casting_rule, n_threads)
+            shared_locals[name] = value[()] if value.ndim == 0 else value
+        return plan.terms
+
+    def _evaluate_hoisted(self, expressions: Union[ExpressionGroup, ExpressionSubGroup],
+                          shared_locals: Dict[str, object], utilities: ndarray, casting_rule: str, n_threads: int,
+                          logger: Logger) -> list:
+        # Sums the expressions which only vary by decision unit into vectors of decision units (one for each filter),
+        # and those which only vary by choice into one vector of choices, then adds these to the utility table. Returns
+        # the other expressions.
+        n_rows, n_cols = utilities.shape
+        single_precision = utilities.dtype == np.float32
+        row_sums: Dict[Optional[str], ndarray] = {}
+        column_sum = None
+
+        remaining = []
+        for expr in expressions:
+            orientation = self._expression_orientation(expr, shared_locals)
+            if orientation is None:
+                remaining.append(expr)
+                continue
+            if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}' as a vector")
+
+            if orientation == 0:
+                out = row_sums.get(expr.filter_)
+                if out is None: out = row_sums[expr.filter_] = np.zeros([n_rows, 1], dtype=utilities.dtype)
+                choice_mask = None  # Applied when the sum is added to the utility table
+            else:
+                if column_sum is None: column_sum = np.zeros([1, n_cols], dtype=utilities.dtype)
+                out, choice_mask = column_sum, self._make_column_mask(expr.filter_)
+
+            local_dict = self._expression_locals(expr, shared_locals, utilities.dtype)
+            transformed = expr._prepare_single_precision(local_dict) if single_precision else expr.transformed
+            local_dict[OUT_STR] = out
+            self._kernel_eval(transformed, local_dict, out, choice_mask, casting_rule=casting_rule,
+                              n_threads=n_threads, programs=expr._programs)
+
+        row_sum = row_sums.pop(None, None)
+        if row_sum is not None or column_sum is not None:
+            zero = utilities.dtype.type(0)
+            local_dict = {OUT_STR: utilities, '__rows': zero if row_sum is None else row_sum,
+                          '__columns': zero if column_sum is None else column_sum}
+            evaluate_numexpr(f"{OUT_STR} + __rows + __columns", local_dict, utilities, casting_rule, n_threads)
+        for filter_, row_sum in row_sums.items():
+            column_index = self._make_column_mask(filter_)
+            if isinstance(column_index, (int, np.integer)): utilities[:, column_index] += row_sum[:, 0]
+            else: utilities[:, column_index] += row_sum
+
+        return remaining
+
+    def _evaluate_fused(self, expressions: Union[ExpressionGroup, ExpressionSubGroup], shared_locals: Dict[str, object],
+                        utilities: ndarray, casting_rule: str, n_threads: int, logger: Logger):
+        # Groups the expressions by filter, then into chunks which fit into one NumExpr program
+        groups: Dict[Optional[str], list] = {}
+        for expr in expressions: groups.setdefault(expr.filter_, []).append(expr)
+
+        for filter_, group in groups.items():
+            column_index = self._make_column_mask(filter_)
+            masked_locals = shared_locals.copy()
+            if column_index is not None: self._mask_columns(masked_locals, column_index)
+            out = utilities if column_index is None else utilities[:, column_index]
+            single_precision = out.dtype == np.float32
+
+            chunk, shared_names, n_local_names = [], set(), 0
+            for expr in group:
+                if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}'")
+                constants = {}  # Single-precision constants are inputs of the program too
+                if single_precision: expr._prepare_single_precision(constants)
+                n_own_names = len(expr._local_names | set(constants))
+                new_shared_names = shared_names | expr.symbols
+                new_n_local_names = n_local_names + n_own_names
+                if chunk and (len(chunk) >= MAX_FUSED_EXPRESSIONS or
+                              len(new_shared_names) + new_n_local_names >= MAX_FUSED_INPUTS):
+                    self._evaluate_chunk(chunk, masked_locals, out, column_index, casting_rule, n_threads)
+                    chunk, new_shared_names, new_n_local_names = [], set(expr.symbols), n_own_names
+                chunk.append(expr)
+                shared_names, n_local_names = new_shared_names, new_n_local_names
+            if chunk: self._evaluate_chunk(chunk, masked_locals, out, column_index, casting_rule, n_threads)
+
+            if isinstance(column_index, ndarray): utilities[:, column_index] = out  # Boolean masks make a copy
+
+    def _evaluate_numba(self, expressions: Union[ExpressionGroup, ExpressionSubGroup], shared_locals: Dict[str, object],
+                        utilities: ndarray, n_threads: int, logger: Logger) -> list:
+        # Adds the expressions which can be translated to a generated Numba kernel, and returns the others for NumExpr
+        builder, fallback = KernelBuilder(), []
+        for position, expr in enumerate(expressions):
+            column_index = self._make_column_mask(expr.filter_)
+            if column_index is not None and not isinstance(column_index, (int, np.integer)):
+                fallback.append(expr)  # Filters of partial nested names select several columns
+                continue
+
+            # Each expression's own variables (e.g. dict literals) are renamed, as in the 'fused' engine
+            suffix = f"_{position}"
+            expr_locals = self._expression_locals(expr, {}, utilities.dtype)
+            own_locals = {name + suffix: val for name, val in expr_locals.items()}
+            values = ChainMap(own_locals, shared_locals)
+            if builder.add(expr._fused_source(suffix, False), values, column_index):
+                if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}' with Numba")
+            else:
+                fallback.append(expr)
+
+        if len(builder) > 0:
+            with ExecutionContext(n_threads):
+                if not builder.run(utilities): return list(expressions)
+        return fallback
+
+    def _evaluate_chunk(self, chunk: list, masked_locals: Dict[str, object], out: ndarray, column_index,
+                        casting_rule: str, n_threads: int):
+        # Adds several expressions to the utility table in a single NumExpr program. Each expression's own variables
+        # are renamed with a suffix, since the same names (e.g. of dict literals) are re-used between expressions.
+        single_precision = out.dtype == np.float32
+        local_dict = masked_locals.copy()
+        sources = []
+        for position, expr in enumerate(chunk):
+            suffix = f"_{position}"
+            own_locals = self._expression_locals(expr, {}, out.dtype)
+            if single_precision: expr._prepare_single_precision(own_locals)
+            if column_index is not None: self._mask_columns(own_locals, column_index)
+            for name, val in own_locals.items(): local_dict[name + suffix] = val
+            sources.append(expr._fused_source(suffix, single_precision))
+        local_dict[OUT_STR] = out
+
+        source = OUT_STR + ''.join(f" + ({expr_source})" for expr_source in sources)
+        try:
+            # NumExpr checks the number of inputs when the program runs (before anything is written to `out`)
+            run_program(compile_program(self._programs, source, local_dict), out, casting_rule, n_threads)
+        except ValueError:
+            # The program needs too many inputs or registers for NumExpr, so it gets split in half
+            if len(chunk) == 1: raise
+            half = len(chunk) // 2
+            self._evaluate_chunk(chunk[:half], masked_locals, out, column_index, casting_rule, n_threads)
+            self._evaluate_chunk(chunk[half:], masked_locals, out, column_index, casting_rule, n_threads)
+
+    def _evaluate_utilities_incremental(self, expressions: Union[ExpressionGroup, ExpressionSubGroup], n_threads: int,
+                                        logger: Logger, allow_casting: bool) -> DataFrame:
+        row_index, col_index = self.decision_units, self.choices
+        dtype = np.dtype(f"f{self._precision}")
+        shape = len(row_index), len(col_index)
+        store = self._contributions
+        if store is None or store.shape != shape or store.dtype != dtype:
+            self._reset_contributions()
+            store = self._contributions = ContributionStore(shape, dtype, **self._incremental)
+
+        # Find the stored expressions which use symbols assigned since the last update. Those which aren't being
+        # evaluated now are dropped, along with any expressions which have been removed from the model.
+        changed = [name for name, version in self._symbol_versions.items() if version > store.version]
+        stale = store.stale(changed)
+        store.discard(stale - {id(expr) for expr in expressions})
+        store.prune(self._expressions)
+
+        shared_locals = self._shared_locals(expressions, dtype)
+        casting_rule = 'same_kind' if allow_casting else 'safe'
+        store.n_evaluated = 0
+        evaluated = set()  # Duplicate expressions are the same object, so each is only evaluated once
+        for expr in expressions:
+            if (expr in store and id(expr) not in stale) or id(expr) in evaluated: continue
+            if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}'")
+
+            column_index, values = self._evaluate_contribution(expr, shared_locals, dtype, casting_rule, n_threads)
+            store.put(expr, column_index, values)
+            evaluated.add(id(expr))
+            store.n_evaluated += 1
+        store.version = self._n_assignments
+
+        utilities = store.total(expressions).copy()
+        if self._cached_utils is not None: utilities += self._cached_utils.values
+        self._evaluate_tables(expressions, shared_locals, utilities, casting_rule, n_threads, logger)
+
+        n_nans = np.isnan(utilities).sum()
+        if n_nans > 0:
+            raise UtilityBoundsError(f"Found {n_nans} cells in utility table with NaN")
+
+        return DataFrame(utilities, index=row_index, columns=col_index)
+
+    def _evaluate_contribution(self, expr: Expression, shared_locals: Dict[str, object], dtype: np.dtype,
+                               casting_rule: str, n_threads: int) -> Tuple[object, ndarray]:
+        # Evaluates one expression on its own, at the shape its symbols broadcast to (after applying its filter)
+        local_dict = self._expression_locals(expr, shared_locals, dtype)
+        transformed = expr._prepare_single_precision(local_dict) if dtype == np.float32 else expr.transformed
+        column_index = self._make_column_mask(expr.filter_)
+        if column_index is not None: self._mask_columns(local_dict, column_index)
+
+        names = expr.symbols | expr._local_names
+        arrays = [local_dict[name] for name in names if name in local_dict]
+        shape = np.broadcast(*arrays).shape if arrays else ()  # np.broadcast_shapes() needs NumPy 1.20
+        values = np.zeros(shape if shape else (1,), dtype=dtype)
+        local_dict[OUT_STR] = values
+        evaluate_program(expr._programs, f"{OUT_STR} + ({transformed})", local_dict, values, casting_rule, n_threads)
+        return column_index, values
+
+    def _evaluate_utilities_long(self, expressions: Union[ExpressionGroup, ExpressionSubGroup],
+                                 n_threads: int = None, logger: Logger = None, allow_casting=True) -> ndarray:
+        """
+        Evaluates utility expressions for the available choices only (see set_availability()), returning a flat array
+        of utilities in the same order as the choice sets. Each symbol is gathered at the available cells before
+        evaluation, so no table of all decision units by all choices is allocated.
+        """
+        if self._decision_units is None:
+            raise ModelNotReadyError("Decision units must be set before evaluating utility expressions")
+        if n_threads is None:
+            n_threads = cpu_count()
+        col_index = self.choices
+        indptr, cols = self._choice_sets
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+        if self.debug_id:
+            debug_label = self._decision_units.get_loc(self.debug_id)
+            debug_cells = slice(indptr[debug_label], indptr[debug_label + 1])
+            debug_expr = []
+            debug_results = []
+
+        dtype = np.dtype(f"f{self._precision}")
+        if self._cached_utils is not None:
+            utilities = self._cached_utils.values[rows, cols]
+        else:
+            utilities = np.zeros(len(cols), dtype=dtype)
+        if self._sampling_correction is not None:
+            utilities += self._sampling_correction.astype(dtype)
+        shared_locals = self._shared_locals(expressions, dtype)
+
+        casting_rule = 'same_kind' if allow_casting else 'safe'
+        gathered: Dict[str, object] = {}  # Shared symbols at all available cells, gathered when first used
+        if any(True for _ in expressions.itertables()):
+            self._evaluate_tables_long(expressions, shared_locals, gathered, rows, cols, utilities, casting_rule,
+                                       n_threads, logger)
+            if self.debug_id:
+                debug_row = np.full(len(col_index), NEG_INF_VAL, dtype=dtype)
+                debug_row[cols[debug_cells]] = utilities[debug_cells]
+                debug_expr.append('(coefficient tables)')
+                debug_results.append(debug_row)
+
+        for expr in expressions:
+            if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}'")
+
+            cells = self._filter_cells(expr.filter_, cols)
+            local_dict, transformed = self._cell_locals(expr, shared_locals, gathered, rows, cols, cells, dtype)
+            out = utilities if cells is None else utilities[cells]
+            local_dict[OUT_STR] = out
+            evaluate_program(expr._programs, f"{OUT_STR} + ({transformed})", local_dict, out, casting_rule, n_threads)
+            if cells is not None: utilities[cells] = out
+
+            if self.debug_id:
+                debug_row = np.full(len(col_index), NEG_INF_VAL, dtype=dtype)
+                debug_row[cols[debug_cells]] = utilities[debug_cells]
+                debug_expr.append(expr.raw)
+                debug_results.append(debug_row)
+
+        n_nans = np.isnan(utilities).sum()
+        if n_nans > 0:
+            raise UtilityBoundsError(f"Found {n_nans} cells in utility table with NaN")
+
+        if self.debug_id:
+            self.debug_results = DataFrame(debug_results, index=debug_expr, columns=col_index)
+
+        return utilities
+
+    def _evaluate_tables_long(self, expressions: Union[ExpressionGroup, ExpressionSubGroup],
+                              shared_locals: Dict[str, object], gathered: Dict[str, object], rows: ndarray,
+                              cols: ndarray, utilities: ndarray, casting_rule: str, n_threads: int, logger: Logger):
+        # Adds the terms of coefficient tables to the utilities of the available cells, as _evaluate_tables() does for
+        # the full table. The product of the design matrix and the coefficients is only taken at the available cells,
+        # one expression at a time, so neither the product nor the gathered design matrix is allocated.
+        dtype = utilities.dtype
+        for table in expressions.itertables():
+            coefficients = self._coefficient_matrix(table, dtype)
+            column_sum = np.zeros(coefficients.shape[1], dtype=dtype)
+
+            for i, expr in enumerate(table.expressions):
+                if logger is not None: logger.debug(f"Evaluating coefficient table expression '{expr.raw}'")
+                orientation = self._expression_orientation(expr, shared_locals)
+
+                if orientation is None:
+                    # Varies by decision unit and choice, so it's evaluated at the available cells of its filtered
+                    # choices, as it can be undefined for the others
+                    cells = self._filter_cells(expr.filter_, cols)
+                    local_dict, transformed = self._cell_locals(expr, shared_locals, gathered, rows, cols, cells,
+                                                                dtype)
+                    local_dict[COEFFICIENTS_STR] = coefficients[i][cols if cells is None else cols[cells]]
+                    out = utilities if cells is None else utilities[cells]
+                    local_dict[OUT_STR] = out
+                    evaluate_program(expr._programs, f"{OUT_STR} + ({transformed}) * {COEFFICIENTS_STR}", local_dict,
+                                     out, casting_rule, n_threads)
+                    if cells is not None: utilities[cells] = out
+                    continue
+
+                local_dict = self._expression_locals(expr, shared_locals, dtype)
+                transformed = expr._prepare_single_precision(local_dict) if dtype == np.float32 else expr.transformed
+                values = evaluate_program(expr._programs, transformed, local_dict, None, casting_rule, n_threads)
+                values = np.reshape(values, -1)
+                cells = self._filter_cells(expr.filter_, cols)
+                if cells is not None:
+                    # Only the cells of the filtered choices are added to, as in _evaluate_tables()
+                    cell_values = values[rows[cells]] if orientation == 0 else \
+                        np.broadcast_to(values, [len(column_sum)])[cols[cells]]
+                    utilities[cells] += cell_values * coefficients[i][cols[cells]]
+                elif orientation == 0: utilities += values[rows] * coefficients[i][cols]
+                else: column_sum += values * coefficients[i]
+
+            utilities += column_sum[cols]
+
+    def _filter_cells(self, filter_: Optional[str], cols: ndarray) -> Optional[ndarray]:
+        # The positions of the available cells in the filtered choices, or None if there is no filter
+        choice_mask = self._make_column_mask(filter_)
+        if choice_mask is None: return None
+        return np.flatnonzero(np.isin(cols, np.arange(len(self.choices))[choice_mask]))
+
+    def _cell_locals(self, expr: Expression, shared_locals: Dict[str, object], gathered: Dict[str, object],
+                     rows: ndarray, cols: ndarray, cells: Optional[ndarray], dtype: np.dtype) -> Tuple[dict, str]:
+        # The locals of an expression at the available cells (or at the subset `cells` of them), and its transformed
+        # source. Only the expression's own variables (dict literals, chained symbols, and constants) are gathered for
+        # it; shared symbols are gathered into `gathered` when first used.
+        local_dict = self._expression_locals(expr, {}, dtype)
+        transformed = expr._prepare_single_precision(local_dict) if dtype == np.float32 else expr.transformed
+
+        expr_rows, expr_cols = (rows, cols) if cells is None else (rows[cells], cols[cells])
+        for key, val in local_dict.items():
+            local_dict[key] = self._gather_cells(val, expr_rows, expr_cols)
+        for name in expr.symbols | {NAN_STR, NEG_INF_STR}:
+            if name not in shared_locals: continue
+            if name not in gathered: gathered[name] = self._gather_cells(shared_locals[name], rows, cols)
+            value = gathered[name]
+            local_dict[name] = value if cells is None or np.ndim(value) == 0 else value[cells]
+        return local_dict, transformed
+
+    @staticmethod
+    def _gather_cells(val, rows: ndarray, cols: ndarray):
+        # Selects the values of a symbol at the given cells, following the same broadcasting rules as NumExpr
+        if not (hasattr(val, 'shape') and len(val.shape) == 2): return val  # Scalars, including NumPy scalars
+        n_rows, n_cols = val.shape
+        if n_rows == 1 and n_cols == 1: return val[0, 0]
+        if n_cols == 1: return val[rows, 0]
+        if n_rows == 1: return val[0, cols]
+        return val[rows, cols]
+
     @staticmethod
     def _kernel_eval(transformed_expr: str, local_dict: Dict[str, np.ndarray], out: np.ndarray, column_index,
-                     casting_rule='same_kind'):
+                     casting_rule='same_kind', n_threads: int = 1, programs: Dict[str, tuple] = None):
+        # If given, `programs` keeps the compiled NumExpr programs for re-use (usually those of an Expression)
         if column_index is not None:
-            for key, val in local_dict.items():
-                if hasattr(val, 'shape'):
-                    if val.shape[1] > 1:
-                        local_dict[key] = val[:, column_index]
-                    elif val.shape[1] == 1:
-                        local_dict[key] = val[:, 0]
+            ChoiceModel._mask_columns(local_dict, column_index)
             out = out[:, column_index]
 
         expr_to_run = f"{OUT_STR} + ({transformed_expr})"
-        ne.evaluate(expr_to_run, local_dict=local_dict, out=out, casting=casting_rule)
+        if programs is None: evaluate_numexpr(expr_to_run, local_dict, out, casting_rule, n_threads)
+        else: evaluate_program(programs, expr_to_run, local_dict, out, casting_rule, n_threads)
+
+    @staticmethod
+    def _mask_columns(local_dict: Dict[str, np.ndarray], column_index):
+        # Selects the filtered columns of each matrix and row vector, and flattens column vectors
+        for key, val in local_dict.items():
+            if hasattr(val, 'shape') and len(val.shape) == 2:  # Skip scalars, including NumPy scalars
+                if val.shape[1] > 1:
+                    local_dict[key] = val[:, column_index]
+                elif val.shape[1] == 1:
+                    local_dict[key] = val[:, 0]
+
+    def _convert_choice_set(self, raw_result: ndarray, log_q: ndarray, logsum: ndarray, astype, squeeze: bool,
+                            result_name: str) -> Tuple[Union[DataFrame, Series], Series, Union[DataFrame, Series]]:
+        # The results of sampling without replacement
+        compact_dtype = np.min_scalar_type(-len(self.choices))  # Signed, to allow for -1
+        result = self._convert_result(raw_result.astype(compact_dtype), astype, squeeze, result_name)
+        n_draws = raw_result.shape[1]
+        log_q = DataFrame(log_q, index=self.decision_units, columns=pd.RangeIndex(n_draws, name=result_name))
+        if n_draws == 1 and squeeze:
+            log_q = log_q.iloc[:, 0]
+        return result, Series(logsum, index=self.decision_units), log_q
 
     def _convert_result(self, raw_result: ndarray, astype, squeeze: bool, result_name: str) -> Union[Series, DataFrame]:
         n_draws = raw_result.shape[1]
@@ -520,7 +1614,9 @@ class ChoiceModel(object):
         retval = []
         for col in range(n_draws):
             indices = raw_result[:, col]
-            retval.append(Series(lookup_table.take(indices), index=record_index))
+            converted = Series(lookup_table.take(np.maximum(indices, 0)), index=record_index)
+            if indices.min() < 0: converted = converted.where(indices >= 0)  # Index -1 means no choice was made
+            retval.append(converted)
         retval = pd.concat(retval, axis=1)
         retval.columns = column_index
 
@@ -529,15 +1625,18 @@ class ChoiceModel(object):
             retval.name = result_name
         return retval
 
-    def run_stochastic(self, n_threads: int = 1, clear_scope: bool = True, logger: Logger = None,
-                       group: str = None, scale_utilities=True) -> Tuple[DataFrame, Series]:
+    def run_stochastic(self, n_threads: int = None, clear_scope: bool = True, logger: Logger = None,
+                       group: str = None, scale_utilities=True, kernel: str = 'row', block_size: int = None,
+                       memory_limit: int = None, out: ndarray = None) -> Tuple[Union[DataFrame, Series], Series]:
         """
         For each record, compute the probability distribution of the logit model. A DataFrame will be returned whose
         columns match the sorted list of node names (alternatives) in the model. Probabilities over all alternatives for
         each record will sum to 1.0.
 
         Args:
-            n_threads: The number of threads to be used in the computation. Must be >= 1.
+            n_threads: The number of threads to be used in the computation. Must be >= 1. If None, the number is taken
+                from this model's `execution` setting or the active ExecutionContext; otherwise Numba's own setting
+                is kept, with 1 NumExpr thread.
             clear_scope: If True data stored in the scope for utility computation will be released, freeing up memory.
                 Turning this off is of limited use.
             logger: Optional Logger instance which reports expressions being evaluated
@@ -545,6 +1644,18 @@ class ChoiceModel(object):
             scale_utilities: For a nested model, if True then lower-level utilities will be divided by the logsum scale
                 of the parent nest. If False, no scaling is performed. This is entirely dependant on the reported form
                 of estimated model parameters.
+            kernel: The probability kernel. 'row' processes one decision unit at a time. 'batched' processes blocks of
+                decision units together, which allows the CPU to vectorize the computation across rows, and gives the
+                same results as 'row'. 'fastmath' is 'batched' with relaxed floating-point rules, which can be faster
+                still but results can differ in the last few bits. Only 'row' is supported with choice sets.
+            block_size: If given, the decision units are evaluated in consecutive blocks of this many rows (see
+                iter_blocks()), so that only one block of utilities and probabilities is held in memory at a time, on
+                top of the result. Results are the same as an unblocked run.
+            memory_limit: If `block_size` is not given, the number of bytes to allow for each block (see
+                iter_blocks()).
+            out: For a run in blocks, an optional array to write the probabilities into, e.g. a memory-mapped file
+                (np.memmap). Its shape must be (number of decision units, number of elemental choices), and the
+                returned DataFrame uses it as its data. Not supported with choice sets.
 
         Returns:
             Tuple[DataFrame, Series]: The first item returned is always the results of the model evaluation,
@@ -553,29 +1664,400 @@ class ChoiceModel(object):
                 string index. Nested logit models, however, will have a MultiIndex columns, with a number of levels
                 equal to the max depth of nesting. The second item is the top-level logsum term from the logit model,
                 for each decision unit.
+
+                If choice sets have been set (see set_availability()), the probabilities are instead returned in long
+                format: a Series of the available (elemental) choices only, indexed by the decision unit and the choice
+                levels.
         """
         self.validate()
+        assert kernel in {'row', 'batched', 'fastmath'}, f"Unknown kernel '{kernel}'"
 
         # Utility computations
         expressions = self._expressions if group is None else self._expressions.get_group(group)
-        utility_table = self._evaluate_utilities(expressions, n_threads=n_threads, logger=logger).values
+        context = self._execution_context(n_threads, default=1)
+
+        if self._choice_sets is not None:
+            assert kernel == 'row', "Only the 'row' kernel is supported with choice sets"
+        if block_size is not None or memory_limit is not None:
+            return self._run_stochastic_blocks(block_size, memory_limit, out, n_threads, clear_scope, logger, group,
+                                               scale_utilities, kernel)
+        assert out is None, "An output array can only be given for a run in blocks"
+        if self._choice_sets is not None:
+            return self._run_stochastic_sparse(expressions, context, clear_scope, logger, scale_utilities)
+
+        utility_table = self._evaluate_utilities(expressions, n_threads=context.numexpr_threads, logger=logger).values
         if clear_scope: self.clear_scope()
 
         # Compute probabilities
-        nb.config.NUMBA_NUM_THREADS = n_threads  # Set the number of threads for parallel execution
-        nested = self.depth > 1
-        if nested:
-            hierarchy, levels, logsum_scales, bottom_flags = self._flatten()
-            raw_result, logsum = worker_nested_probabilities(utility_table, hierarchy, levels, logsum_scales,
-                                                             bottom_flags, scale_utilities=scale_utilities)
-            result_frame = self._build_nested_stochastic_frame(raw_result)
+        if kernel == 'batched':
+            nested_worker, mnl_worker = worker_nested_probabilities_batched, worker_multinomial_probabilities_batched
+        elif kernel == 'fastmath':
+            nested_worker, mnl_worker = worker_nested_probabilities_fastmath, worker_multinomial_probabilities_fastmath
         else:
-            raw_result, logsum = worker_multinomial_probabilities(utility_table)
-            result_frame = DataFrame(raw_result, index=self.decision_units, columns=self.choices)
+            nested_worker, mnl_worker = worker_nested_probabilities, worker_multinomial_probabilities
+
+        nested = self.depth > 1
+        with context:
+            if nested:
+                raw_result, logsum = nested_worker(utility_table, *self._flatten(), scale_utilities)
+                result_frame = self._build_nested_stochastic_frame(raw_result)
+            else:
+                raw_result, logsum = mnl_worker(utility_table)
+                result_frame = DataFrame(raw_result, index=self.decision_units, columns=self.choices)
         logsum = Series(logsum, index=self.decision_units)
 
         return result_frame, logsum
 
+    def _run_stochastic_sparse(self, expressions: Union[ExpressionGroup, ExpressionSubGroup],
+                               context: ExecutionContext, clear_scope: bool, logger: Logger, scale_utilities: bool
+                               ) -> Tuple[Series, Series]:
+        # run_stochastic() for models with choice sets, returning probabilities in long format
+        utilities = self._evaluate_utilities_long(expressions, n_threads=context.numexpr_threads, logger=logger)
+        if clear_scope: self.clear_scope()
+
+        indptr, indices = self._choice_sets
+        with context:
+            if self.depth > 1:
+                raw_result, logsum = worker_nested_probabilities_sparse(indptr, indices, utilities, *self._flatten(),
+                                                                        scale_utilities)
+                positions = np.flatnonzero(self._flatten()[4][indices])  # Elemental choices only
+                result = Series(raw_result[positions], index=self._long_index(positions))
+            else:
+                raw_result, logsum = worker_multinomial_probabilities_sparse(indptr, utilities)
+                result = Series(raw_result, index=self._long_index())
+        logsum = Series(logsum, index=self.decision_units)
+
+        return result, logsum
+
+    def _run_stochastic_blocks(self, block_size: Optional[int], memory_limit: Optional[int], out: Optional[ndarray],
+                               n_threads: Optional[int], clear_scope: bool, logger: Logger, group: Optional[str],
+                               scale_utilities: bool, kernel: str) -> Tuple[Union[DataFrame, Series], Series]:
+        # run_stochastic() over blocks of decision units. Dense probabilities are written into one array as each block
+        # is computed, rather than concatenated at the end, which would need twice the memory.
+        if self._choice_sets is not None:
+            assert out is None, "An output array is not supported with choice sets"
+            results = [block.run_stochastic(n_threads, True, logger, group, scale_utilities, kernel)
+                       for _, block in self._iter_blocks(block_size, memory_limit)]
+            if clear_scope: self.clear_scope()
+            return tuple(pd.concat(items) for items in zip(*results))
+
+        n_rows = len(self.decision_units)
+        logsum, columns = None, None
+        for rows, block in self._iter_blocks(block_size, memory_limit):
+            result, block_logsum = block.run_stochastic(n_threads, True, logger, group, scale_utilities, kernel)
+            if columns is None:
+                columns = result.columns
+                if out is None: out = np.empty([n_rows, len(columns)], dtype=result.values.dtype)
+                assert out.shape == (n_rows, len(columns)), "Output array does not match the decision units and choices"
+                logsum = np.empty(n_rows, dtype=block_logsum.dtype)
+            out[rows] = result.values
+            logsum[rows] = block_logsum.values
+        if clear_scope: self.clear_scope()
+
+        return DataFrame(out, index=self.decision_units, columns=columns), Series(logsum, index=self.decision_units)
+
+    def run_logsums(self, n_threads: int = None, clear_scope: bool = True, logger: Logger = None, group: str = None,
+                    scale_utilities=True, nests=False, block_size: int = None, memory_limit: int = None
+                    ) -> Union[Series, Tuple[Series, DataFrame]]:
+        """
+        For each decision unit, compute only the top-level logsum of the logit model, e.g. for accessibility measures.
+        This is faster than run_stochastic(), as no probabilities (or random draws) are computed.
+
+        Unlike the logsums returned by run_stochastic() and run_discrete(), which are the sums of exponentiated
+        utilities, these are the natural logarithms of those sums. Decision units without any available choices get a
+        logsum of -inf.
+
+        Args:
+            n_threads: The number of threads to be used in the computation. Must be >= 1. If None, the number is taken
+                from this model's `execution` setting or the active ExecutionContext; otherwise Numba's own setting
+                is kept, with 1 NumExpr thread.
+            clear_scope: If True data stored in the scope for utility computation will be released, freeing up memory.
+            logger: Optional Logger instance which reports expressions being evaluated
+            group: Evaluate only the specified utility group. Raises KeyError if the group name is not defined.
+            scale_utilities: For a nested model, if True then lower-level utilities will be divided by the logsum scale
+                of the parent nest.
+            nests: For a nested model, if True then also return the logsum of every nest.
+            block_size: If given, the decision units are evaluated in consecutive blocks of this many rows (see
+                iter_blocks()), so that only one block of utilities is held in memory at a time. Results are the same as
+                an unblocked run.
+            memory_limit: If `block_size` is not given, the number of bytes to allow for each block (see
+                iter_blocks()).
+
+        Returns:
+            Series, or Tuple[Series, DataFrame] if `nests` is True: The top-level logsum of each decision unit, and the
+                logsum of each nest (columns) for each decision unit (rows).
+        """
+        self.validate()
+        expressions = self._expressions if group is None else self._expressions.get_group(group)
+        context = self._execution_context(n_threads, default=1)
+        nested = self.depth > 1
+        assert nested or not nests, "Nest logsums are only available for nested models"
+
+        if block_size is not None or memory_limit is not None:
+            results = [block.run_logsums(n_threads, True, logger, group, scale_utilities, nests)
+                       for _, block in self._iter_blocks(block_size, memory_limit)]
+            if clear_scope: self.clear_scope()
+            return pd.concat(results) if not nests else tuple(pd.concat(items) for items in zip(*results))
+
+        if self._choice_sets is not None:
+            utilities = self._evaluate_utilities_long(expressions, n_threads=context.numexpr_threads, logger=logger)
+            if clear_scope: self.clear_scope()
+            indptr, indices = self._choice_sets
+            with context:
+                if nested:
+                    logsum, nest_logsums = worker_nested_logsums_sparse(indptr, indices, utilities, *self._flatten(),
+                                                                        scale_utilities, nests)
+                else:
+                    logsum = worker_multinomial_logsums_sparse(indptr, utilities)
+        else:
+            utilities = self._evaluate_utilities(expressions, n_threads=context.numexpr_threads, logger=logger).values
+            if clear_scope: self.clear_scope()
+            with context:
+                if nested:
+                    logsum, nest_logsums = worker_nested_logsums(utilities, *self._flatten(), scale_utilities, nests)
+                else:
+                    logsum = worker_multinomial_logsums(utilities)
+
+        logsum = Series(logsum, index=self.decision_units)
+        if not nests: return logsum
+
+        nest_flags = ~self._flatten()[4]
+        return logsum, DataFrame(nest_logsums[:, nest_flags], index=self.decision_units,
+                                 columns=self.choices[nest_flags])
+
+    def run_aggregate(self, weights: Union[Series, ndarray] = None, by: Union[Series, ndarray] = None, *,
+                      n_threads: int = None, clear_scope: bool = True, logger: Logger = None, group: str = None,
+                      scale_utilities=True) -> Union[DataFrame, Series]:
+        """
+        Computes the probability distribution of the logit model (as in run_stochastic()), and sums the probabilities of
+        each choice over groups of decision units, optionally weighted (e.g. by expansion factors). The sums are
+        accumulated as the probabilities are computed, so the table of probabilities for all decision units is never
+        allocated. This is equivalent to ``probabilities.mul(weights, axis=0).groupby(by).sum()``.
+
+        Args:
+            weights: Weight of each decision unit. Series are aligned to the decision units. Defaults to 1.
+            by: Group label of each decision unit (e.g. zone or segment). Series are aligned to the decision units. If
+                None, the probabilities are summed over all decision units.
+            n_threads: The number of threads to be used in the computation. Must be >= 1. If None, the number is taken
+                from this model's `execution` setting or the active ExecutionContext; otherwise Numba's own setting
+                is kept, with 1 NumExpr thread.
+            clear_scope: If True data stored in the scope for utility computation will be released, freeing up memory.
+            logger: Optional Logger instance which reports expressions being evaluated
+            group: Evaluate only the specified utility group. Raises KeyError if the group name is not defined.
+            scale_utilities: For a nested model, if True then lower-level utilities will be divided by the logsum scale
+                of the parent nest.
+
+        Returns:
+            DataFrame or Series: The weighted sum of probabilities, with one row per group (sorted by label) and one
+                column per (elemental) choice. If `by` is None, a Series with one value per choice.
+        """
+        self.validate()
+        n_rows = len(self.decision_units)
+
+        if weights is None:
+            weights = np.ones(n_rows, dtype=np.float64)
+        else:
+            if isinstance(weights, Series): weights = weights.reindex(self.decision_units).values
+            weights = np.asarray(weights, dtype=np.float64)
+            assert len(weights) == n_rows, "Weights do not match the decision units"
+            if np.isnan(weights).any(): raise ValueError("Weights cannot contain NaN")
+
+        if by is None:
+            group_codes, group_labels = np.zeros(n_rows, dtype=np.int64), None
+        else:
+            if isinstance(by, Series): by = by.reindex(self.decision_units)
+            assert len(by) == n_rows, "Group labels do not match the decision units"
+            group_codes, group_labels = pd.factorize(by, sort=True)
+            if np.any(group_codes < 0): raise ValueError("Group labels cannot be missing")
+            group_codes = group_codes.astype(np.int64)
+        n_groups = 1 if group_labels is None else len(group_labels)
+
+        expressions = self._expressions if group is None else self._expressions.get_group(group)
+        context = self._execution_context(n_threads, default=1)
+        nested = self.depth > 1
+
+        if self._choice_sets is not None:
+            utilities = self._evaluate_utilities_long(expressions, n_threads=context.numexpr_threads, logger=logger)
+            if clear_scope: self.clear_scope()
+            indptr, indices = self._choice_sets
+            with context:
+                if nested:
+                    totals = worker_nested_aggregate_sparse(indptr, indices, utilities, *self._flatten(), weights,
+                                                            group_codes, n_groups, get_num_threads(), scale_utilities)
+                else:
+                    totals = worker_multinomial_aggregate_sparse(indptr, indices, utilities, len(self.choices),
+                                                                 weights, group_codes, n_groups, get_num_threads())
+        else:
+            utilities = self._evaluate_utilities(expressions, n_threads=context.numexpr_threads, logger=logger).values
+            if clear_scope: self.clear_scope()
+            with context:
+                if nested:
+                    totals = worker_nested_aggregate(utilities, *self._flatten(), weights, group_codes, n_groups,
+                                                     get_num_threads(), scale_utilities)
+                else:
+                    totals = worker_multinomial_aggregate(utilities, weights, group_codes, n_groups,
+                                                          get_num_threads())
+
+        choices = self.choices
+        if nested:
+            elemental = choices.isin(self.elemental_choices)
+            totals, choices = totals[:, elemental], choices[elemental]
+
+        if group_labels is None: return Series(totals[0], index=choices)
+        return DataFrame(totals, index=Index(group_labels, name=getattr(by, 'name', None)), columns=choices)
+
+    def run_scenarios(self, scenarios: DataFrame, n_threads: int = None, clear_scope: bool = True,
+                      logger: Logger = None, group: str = None, scale_utilities=True) -> Tuple[DataFrame, Series]:
+        """
+        Computes the probability distribution of the logit model (as in run_stochastic()) under several scenarios, where
+        each scenario assigns different values to some number symbols (e.g. coefficients), over the same decision units
+        and data.
+
+        Each expression is split into a sum of terms, where possible: a coefficient depending only on the scenario
+        symbols, times a data term which doesn't depend on them. Each distinct data term is evaluated once, into a
+        single table of decision units by choices which is re-used for every term, and then added to the utilities of
+        each scenario times its coefficient, in one NumExpr pass per scenario. This takes more passes over the
+        utilities than a single matrix product of the coefficients by all data terms would, but only one data term is
+        held in memory at a time, rather than a table of all of them. Expressions which cannot be split (e.g.
+        ``exp(b * x)`` where `b` is a scenario symbol) are evaluated once per scenario. The probabilities of all
+        scenarios are then computed in a single parallel pass.
+
+        Args:
+            scenarios: Table with one row per scenario, and one column per scenario symbol. Each column must be a
+                declared number symbol; these don't need to be assigned. The index labels the scenarios.
+            n_threads: The number of threads to be used in the computation. Must be >= 1. If None, the number is taken
+                from this model's `execution` setting or the active ExecutionContext; otherwise Numba's own setting
+                is kept, with 1 NumExpr thread.
+            clear_scope: If True data stored in the scope for utility computation will be released, freeing up memory.
+            logger: Optional Logger instance which reports expressions being evaluated
+            group: Evaluate only the specified utility group. Raises KeyError if the group name is not defined.
+            scale_utilities: For a nested model, if True then lower-level utilities will be divided by the logsum scale
+                of the parent nest.
+
+        Returns:
+            Tuple[DataFrame, Series]: The probabilities and the top-level logsums, as in run_stochastic(), for all
+                scenarios. Both are indexed by the scenario label and the decision unit.
+        """
+        self.validate(group=group, assignment=False)
+        if self._choice_sets is not None: raise NotImplementedError("Scenarios are not supported with choice sets")
+        parameters = set(scenarios.columns)
+        for name in parameters:
+            if not isinstance(self._scope.get(name), NumberSymbol):
+                raise KeyError(f"Scenario symbol '{name}' is not a declared number symbol")
+
+        expressions = self._expressions if group is None else self._expressions.get_group(group)
+        for name in iter_chain(expressions.itersimple(), expressions.iterchained()):
+            if name in parameters or name in RESERVED_WORDS: continue
+            if not self._scope[name].filled: raise ModelNotReadyError(f"Symbol '{name}' is declared but never assigned")
+
+        context = self._execution_context(n_threads, default=1)
+        numexpr_threads = context.numexpr_threads
+        n_scenarios, n_rows, n_cols = len(scenarios), len(self.decision_units), len(self.choices)
+        dtype = np.dtype(f"f{self._precision}")
+        shared_locals = self._shared_locals(expressions, dtype, exclude=parameters)
+        scenario_values = {name: scenarios[name].values.astype(np.float64) for name in parameters}
+
+        # Split the expressions into data terms shared by all scenarios, and expressions evaluated for each scenario.
+        # The utilities of the first scenario hold the terms without a scenario coefficient, until they are copied.
+        utilities = np.zeros((n_scenarios, n_rows, n_cols), dtype=dtype)
+        base = utilities[0]
+        if self._cached_utils is not None: base += self._cached_utils.values
+        for table in expressions.itertables():
+            if table.symbols & parameters:
+                raise NotImplementedError("Scenario symbols cannot be used in coefficient tables")
+        self._evaluate_tables(expressions, shared_locals, base, 'same_kind', numexpr_threads, logger)
+        data_terms: Dict[tuple, int] = {}
+        term_sources, coefficients, per_scenario = [], [], []
+        for expr in expressions:
+            if logger is not None: logger.debug(f"Evaluating expression '{expr.raw}'")
+            terms = expr._linear_terms(parameters) if expr.symbols & parameters else [(None, expr.transformed)]
+            if terms is None:
+                per_scenario.append(expr)
+                continue
+
+            local_dict = None
+            substitutions = expr._local_names
+            for coefficient, data in terms:
+                if coefficient is None:
+                    if local_dict is None: local_dict = self._expression_locals(expr, shared_locals, dtype)
+                    self._evaluate_source(expr, data, local_dict, base, numexpr_threads)
+                    continue
+
+                # Substitution names are only unique within each expression
+                key = (data, expr.filter_, id(expr) if data is not None and substitutions else None)
+                if key not in data_terms:
+                    data_terms[key] = len(term_sources)
+                    term_sources.append((expr, data))
+                    coefficients.append(np.zeros(n_scenarios, dtype=np.float64))
+                column = np.zeros(n_scenarios, dtype=np.float64)
+                self._kernel_eval(coefficient, dict(scenario_values, **{OUT_STR: column}), column, None,
+                                  n_threads=numexpr_threads)
+                coefficients[data_terms[key]] += column
+
+        utilities[1:] = base
+
+        # Evaluate each data term once, into a table which is re-used for every term, and add it to each scenario with
+        # its coefficient. Constant terms are added directly to their columns.
+        scalar_type = dtype.type
+        scratch = None
+        for (expr, data), weights in zip(term_sources, coefficients):
+            if data is None:
+                columns = self._column_positions(expr.filter_)
+                for s in range(n_scenarios): utilities[s][:, columns] += scalar_type(weights[s])
+                continue
+
+            if scratch is None: scratch = np.zeros((n_rows, n_cols), dtype=dtype)
+            else: scratch.fill(0)
+            local_dict = self._expression_locals(expr, shared_locals, dtype)
+            self._evaluate_source(expr, data, local_dict, scratch, numexpr_threads)
+            for s in range(n_scenarios):
+                local_dict = {OUT_STR: utilities[s], '__weight': scalar_type(weights[s]), '__term': scratch}
+                evaluate_numexpr(f"{OUT_STR} + __weight * __term", local_dict, utilities[s], 'same_kind',
+                                 numexpr_threads)
+        del scratch
+
+        for expr in per_scenario:
+            local_dict = self._expression_locals(expr, shared_locals, dtype)
+            for s in range(n_scenarios):
+                scenario_dict = local_dict.copy()
+                for name, values in scenario_values.items(): scenario_dict[name] = scalar_type(values[s])
+                self._evaluate_source(expr, expr.transformed, scenario_dict, utilities[s], numexpr_threads)
+
+        n_nans = np.isnan(utilities).sum()
+        if n_nans > 0:
+            raise UtilityBoundsError(f"Found {n_nans} cells in utility table with NaN")
+        if clear_scope: self.clear_scope()
+
+        # All scenarios are stacked into one table of (n_scenarios * n_rows) rows
+        utilities = utilities.reshape(n_scenarios * n_rows, n_cols)
+        row_index = MultiIndex.from_product([scenarios.index, self.decision_units],
+                                            names=[scenarios.index.name, self.decision_units.name])
+        with context:
+            if self.depth > 1:
+                raw_result, logsum = worker_nested_probabilities(utilities, *self._flatten(), scale_utilities)
+                filter_array = self.choices.isin(self.elemental_choices)
+                result_frame = DataFrame(raw_result[:, filter_array], index=row_index,
+                                         columns=self.choices[filter_array])
+            else:
+                raw_result, logsum = worker_multinomial_probabilities(utilities)
+                result_frame = DataFrame(raw_result, index=row_index, columns=self.choices)
+
+        return result_frame, Series(logsum, index=row_index)
+
+    def _evaluate_source(self, expr: Expression, source: str, local_dict: Dict[str, object], out: ndarray,
+                         n_threads: int):
+        # Adds all or part of an expression to a table of utilities, applying its filter
+        local_dict = local_dict.copy()
+        if out.dtype == np.float32:
+            source = expr._prepare_single_precision(local_dict, source=None if source == expr.transformed else source)
+        local_dict[OUT_STR] = out
+        self._kernel_eval(source, local_dict, out, self._make_column_mask(expr.filter_), n_threads=n_threads,
+                          programs=expr._programs)
+
+    def _column_positions(self, filter_: Optional[str]) -> Union[slice, int, ndarray]:
+        choice_mask = self._make_column_mask(filter_)
+        return slice(None) if choice_mask is None else choice_mask
+
     def _build_nested_stochastic_frame(self, raw_result: ndarray) -> DataFrame:
         elemental_index = self.elemental_choices
         choice_index = self.choices
@@ -603,7 +2085,8 @@ class ChoiceModel(object):
 
         Args:
             group: The name of the group to pre-compute.
-            n_threads: Number of threads to use to evaluate the expressions
+            n_threads: Number of threads to use to evaluate the expressions. If None, the number is taken from this
+                model's `execution` setting or the active ExecutionContext; otherwise the number of CPUs.
             logger: Optional logger for debugging
             drop_group: If True, the selected group will be "popped" from the set of groups, to avoid re-computing.
             cleanup_scope: If True, symbols unique to this group will be dropped from the scope. This can clean up
@@ -612,7 +2095,8 @@ class ChoiceModel(object):
         """
         self.validate(group=group)
         subgroup = self._expressions.get_group(group)
-        utilities = self._evaluate_utilities(subgroup, n_threads=n_threads, logger=logger)
+        context = self._execution_context(n_threads, default=cpu_count())
+        utilities = self._evaluate_utilities(subgroup, n_threads=context.numexpr_threads, logger=logger)
         self._cached_utils = utilities
 
         if cleanup_scope:
@@ -647,12 +2131,17 @@ class ChoiceModel(object):
         """
 
         new = ChoiceModel(precision=self.precision, debug_id=self.debug_id)
+        new.execution = self.execution
+        new._incremental = self._incremental
+        new._engine, new._programs = self._engine, self._programs
+        new._optimize, new._plans = self._optimize, self._plans
         new._max_level = self._max_level
 
         # ChoiceNode refs will be the same, but that's ok because users shouldn't be changing these at this point
         new._top_nodes = self._top_nodes.copy()
         new._all_nodes = self._all_nodes.copy()
         new._cached_cols = self._cached_cols
+        new._cached_tree = self._cached_tree
 
         # Force the DU to be copied if the assigned scope is also being copied
         if scope_assigned: decision_units = True
@@ -663,6 +2152,8 @@ class ChoiceModel(object):
 
         if self._decision_units is not None and decision_units:
             new._decision_units = self._decision_units
+            new._choice_sets = self._choice_sets
+            new._sampling_correction = self._sampling_correction
 
         if expressions:
             # A new ExpressionGroup instance is important to allow copies to drop expressions and groups
@@ -681,6 +2172,7 @@ class ChoiceModel(object):
          - Decision units Index
          - Partial utilities computed through .preval()
          - Assigned vector, table, or matrix symbols (masked along the 0 axis)
+         - Choice sets, if set
 
         This should be a relatively fast operation.
 
@@ -696,6 +2188,10 @@ class ChoiceModel(object):
         subset_index = self.decision_units[mask]
 
         new = ChoiceModel(precision=self.precision, debug_id=self.debug_id)
+        new.execution = self.execution
+        new._incremental = self._incremental
+        new._engine, new._programs = self._engine, self._programs
+        new._optimize, new._plans = self._optimize, self._plans
         new._max_level = self._max_level
 
         # ChoiceNode refs will be the same, but that's ok because users shouldn't be changing these at this point
@@ -703,6 +2199,7 @@ class ChoiceModel(object):
         new._all_nodes = self._all_nodes.copy()
 
         new._cached_cols = self._cached_cols
+        new._cached_tree = self._cached_tree
 
         new.decision_units = subset_index
 
@@ -713,16 +2210,89 @@ class ChoiceModel(object):
         if self._cached_utils is not None:
             new._cached_utils = self._cached_utils.loc[mask].copy(deep=True)
 
+        if self._choice_sets is not None:
+            indptr, indices = self._choice_sets
+            widths = np.diff(indptr)[mask.values]
+            new_indptr = np.zeros(len(widths) + 1, dtype=np.int64)
+            np.cumsum(widths, out=new_indptr[1:])
+            cell_mask = np.repeat(mask.values, np.diff(indptr))
+            new._choice_sets = new_indptr, indices[cell_mask]
+            if self._sampling_correction is not None:
+                new._sampling_correction = self._sampling_correction[cell_mask]
+
         return new
 
+    def iter_blocks(self, block_size: int = None, *, memory_limit: int = None) -> Iterator['ChoiceModel']:
+        """
+        Splits the decision units into consecutive blocks, and yields a copy of this model for each block (see
+        copy_subset()). Running each block gives the same results as running this model, but only needs the memory for
+        one block of utilities at a time, so results can be streamed (e.g. written to disk) for very large models. The
+        run_stochastic(), run_discrete() and run_logsums() methods can also run in blocks directly.
+
+        If `debug_id` is set, it is kept by the block which contains it, and that block's `debug_results` are copied
+        to this model after it has been run. Blocks don't use incremental evaluation.
+
+        Args:
+            block_size: The number of decision units in each block. The last block can be smaller.
+            memory_limit: If `block_size` is not given, the number of bytes to allow for each block, which is used to
+                estimate a block size from the utilities and probabilities of each decision unit and their share of
+                the assigned vectors, tables, and matrices.
+
+        Yields:
+            ChoiceModel: A copy of this model with the decision units of one block.
+        """
+        for _, block in self._iter_blocks(block_size, memory_limit):
+            yield block
+
+    def _iter_blocks(self, block_size: Optional[int], memory_limit: Optional[int]
+                     ) -> Iterator[Tuple[slice, 'ChoiceModel']]:
+        # Yields the rows of each block and its copy of this model
+        if block_size is None:
+            assert memory_limit is not None, "Either the block size or the memory limit must be given"
+            block_size = self._block_size(memory_limit)
+        assert block_size >= 1
+
+        n_rows = len(self.decision_units)
+        for start in range(0, n_rows, block_size):
+            rows = slice(start, min(start + block_size, n_rows))
+            mask = np.zeros(n_rows, dtype=np.bool_)
+            mask[rows] = True
+
+            block = self.copy_subset(Series(mask, index=self.decision_units))
+            block._incremental = None
+            if self.debug_id and self.debug_id not in block.decision_units: block.debug_id = None
+
+            yield rows, block
+            if block.debug_id: self.debug_results = block.debug_results
+
+    def _block_size(self, memory_limit: int) -> int:
+        # The number of decision units whose utilities, probabilities, and share of the assigned symbols fit in the
+        # memory limit
+        n_rows, n_choices = len(self.decision_units), len(self.choices)
+        row_bytes = n_choices * (self._precision + 8)
+        for symbol in self._scope.values():
+            if not symbol.filled: continue
+            if isinstance(symbol, MatrixSymbol):
+                row_bytes += symbol._matrix.itemsize * symbol._matrix.shape[1]
+            elif isinstance(symbol, VectorSymbol) and symbol._orientation == 0:
+                row_bytes += symbol._raw_array.itemsize
+            elif isinstance(symbol, TableSymbol) and symbol._orientation == 0:
+                row_bytes += int(symbol._table.memory_usage(index=False).sum()) // max(n_rows, 1)
+        return max(1, memory_limit // row_bytes)
+
     def add_partial_utilities(self, table: DataFrame, reindex_rows=False, reindex_columns=True):
         """
         Optimized function for adding partial utilities to the cached table from an external source. Faster than
         declaring a matrix symbol.
 
+        Sparse tables are added without being converted to dense arrays. These can be DataFrames with sparse columns
+        (where the fill value must be 0), or sparse matrices in COO or CSR format (e.g. from SciPy). Sparse matrices
+        don't have labels, so their shape must match the decision units and choices.
+
         Args:
             table: Partial utilities to be added. The index must align with the decision units, and the columns with the
-                choices, or be a subset of them. The dtype MUST be np.float32 or np.float64
+                choices, or be a subset of them. The dtype MUST be np.float32 or np.float64. Duplicate labels in the
+                index or columns are allowed when reindexing, in which case their values get summed.
             reindex_rows: Allows expanding the table to cover all decision units, if its index is a subset. Missing
                 values get filled with 0.
             reindex_columns: Allows expanding the table to cover all choices, if its index is a subset. Missing values
@@ -730,6 +2300,18 @@ class ChoiceModel(object):
 
         """
         self.validate(expressions=False, assignment=False)
+        target_table = self._partial_utilities.values
+
+        if not isinstance(table, DataFrame) and hasattr(table, 'tocoo'):
+            if table.shape != target_table.shape:
+                raise ValueError(f"Sparse partial utilities of shape {table.shape} do not match the model shape "
+                                 f"{target_table.shape}")
+            if getattr(table, 'format', None) == 'csr':
+                csr_indexed_add(target_table, table.indptr, table.indices, table.data)
+            else:
+                coo = table.tocoo()
+                sparse_indexed_add(target_table, coo.data, coo.row, coo.col)
+            return
 
         row_indexer = None
         if not self.decision_units.equals(table.index):
@@ -743,7 +2325,30 @@ class ChoiceModel(object):
                 raise KeyError("Partial utility table columns must match model choices when reindex_columns=False")
             col_indexer = self.choices.get_indexer(table.columns)
 
-        target_table = self._partial_utilities.values
-        fast_indexed_add(target_table, table.values, row_indexer, col_indexer)
+        sparse_columns = [hasattr(table.iloc[:, i].values, 'sp_index') for i in range(table.shape[1])]
+        if not any(sparse_columns):
+            fast_indexed_add(target_table, table.values, row_indexer, col_indexer)
+            return
+
+        if col_indexer is None: col_indexer = np.arange(table.shape[1])
+        sparse_columns = np.array(sparse_columns)
+        if not sparse_columns.all():
+            dense_part = table.iloc[:, ~sparse_columns].values
+            fast_indexed_add(target_table, dense_part, row_indexer, col_indexer[~sparse_columns])
+        data, rows, cols = self._sparse_coordinates(table, np.flatnonzero(sparse_columns))
+        sparse_indexed_add(target_table, data, rows, cols, row_indexer, col_indexer)
+
+    @staticmethod
+    def _sparse_coordinates(table: DataFrame, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Gathers the stored values of sparse columns into coordinate (COO) format
+        all_data, all_rows, all_cols = [], [], []
+        for position in positions:
+            array = table.iloc[:, position].values
+            if array.fill_value != 0:
+                raise ValueError("Sparse partial utilities must have a fill value of 0")
+            all_data.append(np.asarray(array.sp_values))
+            all_rows.append(array.sp_index.to_int_index().indices.astype(np.int64))
+            all_cols.append(np.full(len(all_rows[-1]), position, dtype=np.int64))
+        return np.concatenate(all_data), np.concatenate(all_rows), np.concatenate(all_cols)
 
     # endregion
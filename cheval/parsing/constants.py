@@ -5,5 +5,6 @@ NAN_VAL = _np.nan
 OUT_STR = "OUT"
 NEG_INF_STR = "NEG_INF"
 NEG_INF_VAL = -_np.inf
+COEFFICIENTS_STR = "__coefficients"  # Row of a coefficient table, when evaluating its expressions
 
 RESERVED_WORDS = {NAN_STR, OUT_STR, NEG_INF_STR}
@@ -1,11 +1,15 @@
-from typing import Dict, Set, Tuple, Optional, List, Union
+from typing import Dict, Set, Tuple, Optional, List, Union, Iterator, Hashable, NamedTuple
 import ast
+from collections import OrderedDict
+from threading import Lock
+import pickle
 
 import attr
 import pandas as pd
 import numpy as np
 import astor
 
+from .._version import __version__
 from .expr_items import ChainedSymbol
 from .ast_transformer import ExpressionParser
 from .exceptions import UnsupportedSyntaxError
@@ -20,19 +24,119 @@ def _split_filter(e: str) -> Tuple[str, Optional[str]]:
     raise UnsupportedSyntaxError("Only one '@' symbol is allowed in expressions")
 
 
-@attr.s
+class _FloatLiteralReplacer(ast.NodeTransformer):
+    """Replaces float literals with named substitutions, for evaluating expressions in single precision"""
+
+    def __init__(self):
+        self.constants: Dict[str, float] = {}
+
+    def _replace(self, node, value):
+        if type(value) is not float: return node
+        substitution = '__flt%s' % len(self.constants)
+        self.constants[substitution] = value
+        return ast.Name(substitution, ast.Load())
+
+    def visit_Num(self, node): return self._replace(node, node.n)  # Python < 3.8
+
+    def visit_Constant(self, node): return self._replace(node, node.value)
+
+
+def _single_precision_source(source: str) -> Tuple[str, Dict[str, float]]:
+    replacer = _FloatLiteralReplacer()
+    tree = replacer.visit(ast.parse(source, mode='eval'))
+    return astor.to_source(tree.body).strip(), replacer.constants
+
+
+class _NameReplacer(ast.NodeTransformer):
+
+    def __init__(self, mapping: Dict[str, str]):
+        self.mapping = mapping
+
+    def visit_Name(self, node):
+        if node.id in self.mapping: node.id = self.mapping[node.id]
+        return node
+
+
+def _rename_source(source: str, mapping: Dict[str, str]) -> str:
+    tree = _NameReplacer(mapping).visit(ast.parse(source, mode='eval'))
+    return astor.to_source(tree.body).strip()
+
+
+def _names(node: ast.AST) -> Set[str]:
+    # Names of the variables used in an AST, excluding function names
+    functions = {id(child.func) for child in ast.walk(node) if isinstance(child, ast.Call)}
+    return {child.id for child in ast.walk(node) if isinstance(child, ast.Name) and id(child) not in functions}
+
+
+def _additive_terms(node: ast.AST, negative=False) -> Iterator[Tuple[bool, ast.AST]]:
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+        yield from _additive_terms(node.left, negative)
+        yield from _additive_terms(node.right, negative ^ isinstance(node.op, ast.Sub))
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        yield from _additive_terms(node.operand, negative ^ isinstance(node.op, ast.USub))
+    else:
+        yield negative, node
+
+
+def _factors(node: ast.AST, parameters: Set[str]) -> Iterator[ast.AST]:
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+        yield from _factors(node.left, parameters)
+        yield from _factors(node.right, parameters)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div) and _names(node) & parameters:
+        yield from _factors(node.left, parameters)
+        yield ast.BinOp(left=ast.Constant(1.0), op=ast.Div(), right=node.right)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        yield ast.Constant(-1.0)
+        yield from _factors(node.operand, parameters)
+    else:
+        yield node
+
+
+def _product_source(factors: List[ast.AST]) -> Optional[str]:
+    if not factors: return None
+    return ' * '.join('(%s)' % astor.to_source(factor).strip() for factor in factors)
+
+
+@attr.s(frozen=True)
 class Expression(object):
-    """Simple data class for utility expressions"""
+    """
+    Simple data class for utility expressions. Instances are immutable (apart from internal caches), so they are shared
+    between models through the parse cache (see ExpressionCache).
+    """
 
     raw: str = attr.ib()
     transformed: str = attr.ib()
     chains: Dict[str, ChainedSymbol] = attr.ib()
     dict_literals: Dict[str, dict] = attr.ib()
     filter_: Optional[str] = attr.ib()
-    symbols: Set[str] = attr.ib()
+    symbols: Set[str] = attr.ib(converter=frozenset)
+    _single_precision: Optional[Tuple[str, Dict[str, float]]] = attr.ib(default=None, init=False, repr=False,
+                                                                         eq=False)
+    _programs: Dict[str, tuple] = attr.ib(factory=dict, init=False, repr=False, eq=False)  # See evaluate_program()
+    _fused_sources: Dict[Tuple[str, bool], str] = attr.ib(factory=dict, init=False, repr=False, eq=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_programs'] = {}  # Compiled NumExpr programs can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
 
     @staticmethod
-    def parse(e: str, prior_simple: Set[str] = None, prior_chained: Set[str] = None, mode='cheval') -> 'Expression':
+    def parse(e: str, prior_simple: Set[str] = None, prior_chained: Set[str] = None, mode='cheval',
+              cache=True) -> 'Expression':
+        """
+        Parses an expression. Symbols are checked for consistent usage (simple or chained) against the optional sets of
+        symbols used in prior expressions, which are then updated in-place.
+
+        Parsed expressions are kept in the process-wide `expression_cache`, unless `cache` is False.
+        """
+        new_e = expression_cache.get(e, mode) if cache else None
+        if new_e is not None:
+            new_e._check_usage(prior_simple, prior_chained)
+            return new_e
+
         split_e, filter_ = _split_filter(e)
 
         tree = ast.parse(split_e, mode='eval').body
@@ -41,22 +145,104 @@ class Expression(object):
 
         new_e = Expression(e, astor.to_source(new_tree), transformer.chained_symbols, transformer.dict_literals,
                            filter_, transformer.visited_simple)
+        if cache: expression_cache.put(new_e, mode)
         return new_e
 
+    def _check_usage(self, prior_simple: Optional[Set[str]], prior_chained: Optional[Set[str]]):
+        # Applies the same consistency rules as ExpressionParser, for an expression that has already been parsed
+        if prior_chained is not None:
+            for name in sorted(self.symbols & prior_chained):
+                raise UnsupportedSyntaxError("Inconsistent use for symbol '%s'" % name)
+        if prior_simple is not None:
+            for name in sorted(prior_simple.intersection(self.chains)):
+                raise UnsupportedSyntaxError("Inconsistent usage of symbol '%s'" % name)
+
+        if prior_simple is not None: prior_simple |= self.symbols
+        if prior_chained is not None: prior_chained.update(self.chains)
+
     @property
     def all_symbols(self) -> Set[str]:
         return self.symbols | set(self.chains.keys())
 
-    def _prepare_dict_literals(self, choice_index: pd.Index, local_dict: dict):
+    def _prepare_dict_literals(self, choice_index: pd.Index, local_dict: dict, dtype='f8'):
         # Prepares dict literals for use in evaluation, applying rules for special key names
         for substitution, raw_literal in self.dict_literals.items():
-            new_array = np.zeros((1, len(choice_index)), dtype='f8')
+            new_array = np.zeros((1, len(choice_index)), dtype=dtype)
 
             for key, val in raw_literal.items():
                 self._insert_dict_val(key, choice_index, val, new_array)
 
             local_dict[substitution] = new_array
 
+    def _prepare_single_precision(self, local_dict: dict, source: str = None) -> str:
+        # NumExpr treats float literals as doubles, which upcasts any single-precision arrays they touch. So the
+        # literals get replaced with named float32 constants, and the modified expression is returned. Parts of the
+        # expression (e.g. from _linear_terms()) can be given as the `source`, which doesn't get cached.
+        if source is not None:
+            transformed, constants = _single_precision_source(source)
+        else:
+            if self._single_precision is None:
+                object.__setattr__(self, '_single_precision', _single_precision_source(self.transformed))
+            transformed, constants = self._single_precision
+
+        for substitution, val in constants.items():
+            local_dict[substitution] = np.float32(val)
+        return transformed
+
+    @property
+    def _local_names(self) -> Set[str]:
+        # Names of the variables which are specific to this expression: dict literals and chained symbols
+        return set(self.dict_literals) | {sub for usages in self.chains.values() for sub, _ in usages.items()}
+
+    def _fused_source(self, suffix: str, single_precision: bool) -> str:
+        # The transformed expression, with the names of its own variables (including single-precision constants) given
+        # a suffix, so that it can be combined with other expressions into one program
+        key = suffix, single_precision
+        source = self._fused_sources.get(key)
+        if source is None:
+            transformed, constants = self.transformed, {}
+            if single_precision:
+                transformed = self._prepare_single_precision(constants)
+            names = self._local_names | set(constants)
+            source = self._fused_sources[key] = _rename_source(transformed, {name: name + suffix for name in names})
+        return source
+
+    def _linear_terms(self, parameters: Set[str]) -> Optional[List[Tuple[Optional[str], Optional[str]]]]:
+        """
+        Decomposes the (transformed) expression into a sum of terms, each of which is a coefficient that only depends
+        on the given parameters (e.g. number symbols), times a "data" part that doesn't depend on them. This allows the
+        data parts to be evaluated once for many sets of parameter values.
+
+        Returns:
+            A list of (coefficient, data) source strings, where either can be None: a coefficient of None means that the
+            term doesn't depend on the parameters, and data of None means that the term is a constant. Returns None if
+            the expression cannot be decomposed, e.g. when parameters appear inside a function call with other symbols.
+        """
+        tree = ast.parse(self.transformed, mode='eval').body
+
+        terms = []
+        for negative, term in _additive_terms(tree):
+            if not (_names(term) & parameters):
+                source = astor.to_source(term).strip()
+                terms.append((None, '-(%s)' % source if negative else source))
+                continue
+
+            coefficient_factors, data_factors = [], []
+            for factor in _factors(term, parameters):
+                names = _names(factor)
+                if not names & parameters: data_factors.append(factor)
+                elif names <= parameters: coefficient_factors.append(factor)
+                else: return None  # Parameters are mixed with other symbols
+
+            # Constant factors are moved into the coefficient, which is cheaper to evaluate
+            constants = [factor for factor in data_factors if not _names(factor)]
+            data_factors = [factor for factor in data_factors if _names(factor)]
+            coefficient_factors += constants
+            if negative: coefficient_factors.append(ast.Constant(-1.0))
+
+            terms.append((_product_source(coefficient_factors), _product_source(data_factors)))
+        return terms
+
     @staticmethod
     def _insert_dict_val(key: tuple, choice_index: pd.Index, val, new_array):
         max_levels = choice_index.nlevels
@@ -101,3 +287,101 @@ class Expression(object):
             else:
                 loc = choice_index.get_loc(tuple(new_key + delta))
                 new_array[0, loc] = val
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    max_size: int
+    size: int
+
+
+class ExpressionCache(object):
+    """
+    Bounded, thread-safe LRU cache of parsed expressions, keyed by the raw expression string and the parsing mode. It's
+    shared by all models in the process, so re-building a model (or building many models from the same specification)
+    only parses each distinct expression once. Consistent usage of symbols is checked against the model's other
+    expressions whenever a cached expression is re-used.
+
+    The cache can be saved to a file and loaded again in a later run. Loading uses pickle, so only load files from a
+    trusted source.
+    """
+
+    def __init__(self, max_size: int = 10_000):
+        assert max_size >= 0, "max_size must be >= 0"
+        self._max_size = max_size
+        self._entries: 'OrderedDict[Tuple[str, Hashable], Expression]' = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def max_size(self) -> int:
+        """The maximum number of expressions kept. Setting this to 0 turns off caching."""
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, value: int):
+        assert value >= 0, "max_size must be >= 0"
+        with self._lock:
+            self._max_size = value
+            self._evict()
+
+    def info(self) -> CacheInfo:
+        """Statistics of the cache, similar to functools.lru_cache"""
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._max_size, len(self._entries))
+
+    def get(self, raw: str, mode: Hashable) -> Optional[Expression]:
+        key = raw, mode
+        with self._lock:
+            expr = self._entries.get(key)
+            if expr is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return expr
+
+    def put(self, expr: Expression, mode: Hashable):
+        with self._lock:
+            self._entries[(expr.raw, mode)] = expr
+            self._entries.move_to_end((expr.raw, mode))
+            self._evict()
+
+    def clear(self):
+        """Removes all expressions and resets the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = 0
+
+    def save(self, path: str):
+        """Saves the cached expressions to a file"""
+        with self._lock:
+            entries = list(self._entries.items())
+        with open(path, 'wb') as writer:
+            pickle.dump({'version': __version__, 'entries': entries}, writer, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path: str) -> int:
+        """
+        Adds the expressions saved to a file by save(), and returns the number added. Files saved by a different
+        version of cheval are ignored, since the parsing rules may have changed.
+        """
+        with open(path, 'rb') as reader:
+            saved = pickle.load(reader)
+        if saved.get('version') != __version__: return 0
+
+        n_added = 0
+        with self._lock:
+            for key, expr in saved['entries']:
+                if key in self._entries: continue
+                self._entries[key] = expr
+                n_added += 1
+            self._evict()
+        return n_added
+
+    def _evict(self):
+        while len(self._entries) > self._max_size: self._entries.popitem(last=False)
+
+
+expression_cache = ExpressionCache()
@@ -0,0 +1,301 @@
+"""
+Optimization of a model's utility expressions as a whole: merging terms which apply the same data to the same choices,
+folding constants, and computing subexpressions that are shared between expressions only once.
+"""
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import ast
+from copy import deepcopy
+import operator
+
+import attr
+import astor
+
+from .expressions import Expression, _additive_terms, _factors, _names, _NameReplacer
+
+_FOLDABLE_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                       ast.Pow: operator.pow}
+
+
+def _constant(node: ast.AST):
+    # The value of a numeric literal, or None
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float): return node.value
+    if isinstance(node, ast.Num) and type(node.n) in (int, float): return node.n  # Python < 3.8
+    return None
+
+
+def _source(node: ast.AST) -> str:
+    return astor.to_source(node).strip()
+
+
+class _ConstantFolder(ast.NodeTransformer):
+    """Replaces arithmetic on numeric literals with the result"""
+
+    def __init__(self):
+        self.n_folded = 0
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left, right = _constant(node.left), _constant(node.right)
+        function = _FOLDABLE_OPERATORS.get(type(node.op))
+        if left is None or right is None or function is None: return node
+        if isinstance(node.op, (ast.Div, ast.Pow)) and isinstance(left, int) and isinstance(right, int):
+            return node  # NumExpr uses integer division, and integer powers can overflow
+        try:
+            value = function(left, right)
+        except (ArithmeticError, ValueError):
+            return node
+        if type(value) not in (int, float): return node  # e.g. complex powers of negative numbers
+        self.n_folded += 1
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        value = _constant(node.operand)
+        if value is None or not isinstance(node.op, ast.USub): return node
+        return ast.copy_location(ast.Constant(-value), node)
+
+
+@attr.s
+class OptimizationReport(object):
+    """What was changed by optimizing a set of expressions. Its string form lists the changes for reading."""
+
+    n_expressions: int = attr.ib()
+    n_terms: int = attr.ib()  # Additive terms of the original expressions
+    n_folded: int = attr.ib()  # Operations on constants that were replaced by their result
+    terms: List[str] = attr.ib()  # The optimized terms
+    merged: List[Tuple[str, int]] = attr.ib()  # Optimized terms which replace several original terms, and the number
+    dropped: List[str] = attr.ib()  # Original terms with a coefficient of zero
+    shared: List[Tuple[str, str, int]] = attr.ib()  # Name, source and number of uses of each shared subexpression
+
+    def __str__(self):
+        lines = [f"{self.n_expressions} expressions with {self.n_terms} terms optimized to {len(self.terms)} terms, "
+                 f"with {len(self.shared)} shared subexpressions and {self.n_folded} constant operations folded"]
+        if self.merged:
+            lines.append("Merged terms:")
+            lines += [f"    {term}  [from {n} terms]" for term, n in self.merged]
+        if self.dropped:
+            lines.append("Dropped terms with zero coefficients:")
+            lines += [f"    {term}" for term in self.dropped]
+        if self.shared:
+            lines.append("Shared subexpressions:")
+            lines += [f"    {name} = {source}  [used {n} times]" for name, source, n in self.shared]
+        return '\n'.join(lines)
+
+
+@attr.s
+class ExpressionPlan(object):
+    """The result of optimize(): how to evaluate a set of expressions"""
+
+    locals: Dict[str, Tuple[Expression, str]] = attr.ib()  # Variable -> original expression, and its name there
+    temporaries: List[Tuple[str, Expression]] = attr.ib()  # Shared subexpressions, to be evaluated in order
+    terms: List[Expression] = attr.ib()  # Terms to add to the utility table, using the variables and temporaries
+    report: OptimizationReport = attr.ib()
+
+
+class _Node(object):
+    # A distinct subexpression, in the graph of all subexpressions of the optimized terms
+
+    def __init__(self, tree: ast.AST, axes: Set[int]):
+        self.tree = tree
+        self.axes = axes
+        self.parents: Set[str] = set()
+        self.n_roots = 0  # Number of terms which are this subexpression
+        self.n_unfiltered_roots = 0
+        self.n_evaluations = 0
+        self.n_unfiltered_evaluations = 0
+        self.shared = False
+        self.temporary: Optional[str] = None  # Name of the shared subexpression
+
+
+class _TemporaryReplacer(ast.NodeTransformer):
+
+    def __init__(self, temporaries: Dict[str, str]):
+        self.temporaries = temporaries
+
+    def generic_visit(self, node):
+        name = self.temporaries.get(getattr(node, '_cse_key', None))
+        if name is not None: return ast.copy_location(ast.Name(name, ast.Load()), node)
+        return super().generic_visit(node)
+
+
+def optimize(expressions: List[Expression], symbol_axes: Callable[[str], Set[int]]) -> ExpressionPlan:
+    """
+    Optimizes a set of utility expressions, in three steps:
+
+    1. Operations on constants are folded, and the additive terms of all expressions are merged when they apply the same
+       data to the same choices (i.e. they only differ by a constant or number-symbol coefficient). Terms whose
+       coefficients add up to zero are dropped, even where their data is NaN.
+    2. The merged terms are combined into a graph of distinct subexpressions, in which chained symbols and dict literals
+       are identified by their content rather than their names.
+    3. Subexpressions which would be evaluated more than once become "temporaries", evaluated before the terms at the
+       shape of their own inputs. Those which vary over both decision units and choices are only shared when they're
+       used at least twice over all choices, since computing them for the whole table would cost more than re-computing
+       them for a few filtered choices.
+
+    Args:
+        expressions: The expressions to optimize.
+        symbol_axes: Function giving the axes which a symbol varies over (0 for decision units and 1 for choices), by
+            name. Chained symbols are given by the name of the symbol.
+
+    Returns:
+        ExpressionPlan: The plan to evaluate the expressions. Evaluating its terms gives the same result as evaluating
+            the original expressions, apart from rounding.
+    """
+    expressions = list(expressions)
+    variables, display, axes = {}, {}, {}  # Keyed by canonical name
+    variable_names: Dict[tuple, str] = {}
+    folder = _ConstantFolder()
+
+    def variable(key: tuple, prefix: str, expr: Expression, original: str, text: str, variable_axes: Set[int]) -> str:
+        name = variable_names.get(key)
+        if name is None:
+            name = variable_names[key] = f"{prefix}{len(variable_names)}"
+            variables[name], display[name], axes[name] = (expr, original), text, variable_axes
+        return name
+
+    def names_axes(node: ast.AST) -> Set[int]:
+        retval = set()
+        for name in _names(node): retval |= axes.get(name, set())
+        return retval
+
+    # Step 1: Fold constants and merge terms
+    merged: Dict[tuple, dict] = {}
+    dropped, n_terms = [], 0
+    for expr in expressions:
+        mapping = {}
+        for symbol_name, usages in expr.chains.items():
+            for substitution, chain_info in usages.items():
+                key = 'chain', symbol_name, tuple(chain_info.chain), chain_info.func, chain_info.args
+                text = '.'.join([symbol_name] + list(chain_info.chain))
+                if chain_info.withfunc: text += f".{chain_info.func}({chain_info.args.strip()})"
+                mapping[substitution] = variable(key, '__cse_sub', expr, substitution, text, symbol_axes(symbol_name))
+        for substitution, literal in expr.dict_literals.items():
+            key = 'dict', frozenset(literal.items())
+            text = '{' + ', '.join(f"{'.'.join(map(str, k))}: {v:g}" for k, v in literal.items()) + '}'
+            mapping[substitution] = variable(key, '__cse_dict', expr, substitution, text, {1})
+        for name in expr.symbols: axes.setdefault(name, symbol_axes(name))
+
+        tree = _NameReplacer(mapping).visit(ast.parse(expr.transformed, mode='eval').body)
+        tree = folder.visit(tree)
+
+        for negative, term in _additive_terms(tree):
+            n_terms += 1
+            coefficient, scalar_factors, data_factors = -1 if negative else 1, [], []
+            for factor in _factors(term, set()):
+                value = _constant(factor)
+                if value is not None: coefficient *= value
+                elif _names(factor) and not names_axes(factor): scalar_factors.append(_source(factor))
+                else: data_factors.append(_source(factor))
+
+            key = expr.filter_, tuple(sorted(data_factors))
+            entry = merged.setdefault(key, {'coefficients': {}, 'sources': []})
+            scalar_key = tuple(sorted(scalar_factors))
+            entry['coefficients'][scalar_key] = entry['coefficients'].get(scalar_key, 0) + coefficient
+            entry['sources'].append(_display_source(_source(term), display, expr.filter_, negative))
+
+    terms: List[Tuple[Optional[str], str, List[str]]] = []
+    for (filter_, data_factors), entry in merged.items():
+        source = _term_source(entry['coefficients'], data_factors)
+        if source is None: dropped += entry['sources']
+        else: terms.append((filter_, source, entry['sources']))
+
+    # Step 2: Build the graph of subexpressions, with the nodes in the order that they're first found. Since a node is
+    # always found before any node which contains it, this is also a topological order.
+    nodes: Dict[str, _Node] = {}
+
+    def add_node(tree: ast.AST) -> str:
+        key = tree._cse_key = _source(tree)
+        for child in ast.iter_child_nodes(tree):
+            if isinstance(child, ast.expr) and not _is_function_name(tree, child):
+                nodes[add_node(child)].parents.add(key)
+        if key not in nodes: nodes[key] = _Node(tree, names_axes(tree))
+        return key
+
+    term_trees = []
+    for filter_, source, _ in terms:
+        tree = ast.parse(source, mode='eval').body
+        node = nodes[add_node(tree)]
+        node.n_roots += 1
+        if filter_ is None: node.n_unfiltered_roots += 1
+        term_trees.append(tree)
+
+    # Step 3: Choose the temporaries, visiting each node after all of the nodes which contain it
+    for node in reversed(list(nodes.values())):
+        node.n_evaluations, node.n_unfiltered_evaluations = node.n_roots, node.n_unfiltered_roots
+        for parent_key in node.parents:
+            parent = nodes[parent_key]
+            if parent.shared:
+                node.n_evaluations += 1
+                node.n_unfiltered_evaluations += 1
+            else:
+                node.n_evaluations += parent.n_evaluations
+                node.n_unfiltered_evaluations += parent.n_unfiltered_evaluations
+
+        if isinstance(node.tree, (ast.Name, ast.Constant, ast.Num)) or not _names(node.tree): continue
+        n_evaluations = node.n_unfiltered_evaluations if node.axes == {0, 1} else node.n_evaluations
+        node.shared = n_evaluations >= 2
+
+    for i, node in enumerate(node for node in nodes.values() if node.shared): node.temporary = f"__cse{i}"
+    replacements = {key: node.temporary for key, node in nodes.items() if node.temporary is not None}
+    temporaries, shared = [], []
+    for key, node in nodes.items():
+        if node.temporary is None: continue
+        source = _replace_temporaries(node.tree, replacements, skip_root=True)
+        temporaries.append((node.temporary, _make_expression(source, None, display)))
+        shared.append((node.temporary, _display_source(source, display), node.n_evaluations))
+
+    optimized_terms, report_terms, report_merged = [], [], []
+    for (filter_, _, sources), tree in zip(terms, term_trees):
+        source = _replace_temporaries(tree, replacements)
+        expr = _make_expression(source, filter_, display)
+        optimized_terms.append(expr)
+        report_terms.append(expr.raw)
+        if len(sources) > 1: report_merged.append((expr.raw, len(sources)))
+
+    report = OptimizationReport(len(expressions), n_terms, folder.n_folded, report_terms, report_merged, dropped,
+                                shared)
+    return ExpressionPlan(variables, temporaries, optimized_terms, report)
+
+
+def _is_function_name(parent: ast.AST, child: ast.AST) -> bool:
+    return isinstance(parent, ast.Call) and child is parent.func
+
+
+def _term_source(coefficients: Dict[tuple, float], data_factors: Tuple[str, ...]) -> Optional[str]:
+    # The source of a merged term, or None if all of its coefficients are zero
+    coefficients = {scalar_factors: value for scalar_factors, value in coefficients.items() if value != 0}
+    if not coefficients: return None
+    if data_factors and coefficients == {(): 1}: return ' * '.join(f"({factor})" for factor in data_factors)
+
+    parts = []
+    for scalar_factors, value in coefficients.items():
+        product = ' * '.join(f"({factor})" for factor in scalar_factors)
+        if not scalar_factors: parts.append(repr(value))
+        elif value == 1: parts.append(product)
+        else: parts.append(f"{value!r} * {product}")
+
+    data = ' * '.join(f"({factor})" for factor in data_factors)
+    if not data: return ' + '.join(parts)
+    return f"({' + '.join(parts)}) * {data}"
+
+
+def _replace_temporaries(tree: ast.AST, replacements: Dict[str, str], skip_root=False) -> str:
+    tree = deepcopy(tree)
+    replacer = _TemporaryReplacer(replacements)
+    tree = super(_TemporaryReplacer, replacer).generic_visit(tree) if skip_root else replacer.visit(tree)
+    return _source(tree)
+
+
+def _display_source(source: str, display: Dict[str, str], filter_: str = None, negative=False) -> str:
+    # The source with chained symbols and dict literals written out, for reporting
+    tree = _NameReplacer(display).visit(ast.parse(source, mode='eval').body)
+    text = _source(tree)
+    if negative: text = f"-({text})"
+    return text if filter_ is None else f"{text} @ {filter_}"
+
+
+def _make_expression(source: str, filter_: Optional[str], display: Dict[str, str]) -> Expression:
+    # Optimized terms and temporaries are expressions without chained symbols or dict literals of their own: those of
+    # the original expressions become shared variables of the plan
+    tree = ast.parse(source, mode='eval').body
+    return Expression(_display_source(source, display, filter_), source, {}, {}, filter_, _names(tree))
@@ -1,17 +1,40 @@
 import unittest
 from bisect import bisect_right
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
 
 import numpy as np
+import pandas as pd
 from numpy.testing import assert_allclose
 
-from core import (
-    MIN_RANDOM_VALUE, sample_once, sample_multi, logarithmic_search,
-    simple_probabilities, simple_sample, simple_multisample, worker_weighted_sample,
+from cheval.core import (
+    ALIAS_THRESHOLD, MIN_RANDOM_VALUE, sample_once, sample_multi, logarithmic_search, build_alias_table, alias_draw,
+    sample_multi_alias, simple_probabilities, simple_sample, simple_multisample, worker_weighted_sample,
     multinomial_probabilities, multinomial_sample, multinomial_multisample, worker_multinomial_sample,
-    worker_multinomial_probabilities,
-    nested_probabilities, nested_sample, nested_multisample, worker_nested_sample, worker_nested_probabilities
+    worker_multinomial_probabilities, multinomial_probabilities_inplace,
+    nested_probabilities, nested_probabilities_inplace, nested_sample, nested_multisample, worker_nested_sample,
+    worker_nested_probabilities,
+    philox4x32, counter_uniform, worker_counter_uniforms, worker_multinomial_sample_counter,
+    worker_sequential_uniforms, worker_multinomial_sample_fused, worker_nested_sample_fused, worker_nested_sample_draws,
+    worker_multinomial_probabilities_batched, worker_multinomial_sample_batched,
+    worker_multinomial_probabilities_fastmath,
+    worker_nested_probabilities_batched, worker_nested_sample_batched, worker_nested_probabilities_fastmath,
+    gumbel_top_k, worker_multinomial_sample_without_replacement, warmup, fast_indexed_add, sparse_indexed_add,
+    csr_indexed_add, worker_multinomial_probabilities_sparse, worker_multinomial_sample_sparse,
+    worker_nested_probabilities_sparse, worker_nested_sample_sparse, worker_multinomial_aggregate,
+    worker_nested_aggregate, worker_multinomial_aggregate_sparse, worker_multinomial_logsums, worker_nested_logsums,
+    worker_nested_logsums_sparse, worker_nested_sample_without_replacement, UtilityBoundsError,
+    worker_multinomial_sample_sparse_without_replacement, worker_nested_sample_sparse_without_replacement
 )
-from cheval.model import ChoiceModel
+from cheval.api import ExpressionGroup
+from cheval.codegen import KernelBuilder
+from cheval.model import ChoiceModel, MAX_FUSED_EXPRESSIONS
+from cheval.parsing.exceptions import UnsupportedSyntaxError
+from cheval.parsing.expressions import Expression, ExpressionCache
+from cheval.parsing.optimizer import optimize
 
 
 def _cp_midpoints(p_array):
@@ -33,6 +56,72 @@ def _randomize(n, seed):
     return randomizer.uniform(MIN_RANDOM_VALUE, 1.0, n)
 
 
+def _to_choice_sets(utilities):
+    # Converts a dense table of utilities to CSR format, dropping cells of -inf
+    rows, cols = np.nonzero(utilities > -np.inf)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=utilities.shape[0]))])
+    return indptr, cols, utilities[rows, cols]
+
+
+def _build_utility_model(precision: int = 8, decision_units: pd.Index = pd.RangeIndex(50)) -> ChoiceModel:
+    # A multinomial model with symbols of every orientation, for comparing ways of evaluating utility expressions
+    randomizer = np.random.RandomState(12345)
+    n_rows = len(decision_units)
+    model = ChoiceModel(precision=precision)
+    model.add_choices(list('abcd'))
+    model.decision_units = decision_units
+    model.declare_number('beta')
+    model.declare_vector('income', 0)
+    model.declare_vector('size', 1)
+    model.declare_matrix('cost')
+    model.declare_table('households', 0)
+    model['beta'].assign(-0.5)
+    model['income'].assign(randomizer.uniform(0, 2, n_rows))
+    model['size'].assign(randomizer.uniform(1, 2, 4))
+    model['cost'].assign(pd.DataFrame(randomizer.uniform(size=(n_rows, 4)), index=model.decision_units,
+                                      columns=model.choices))
+    model['households'].assign(pd.DataFrame({'size': randomizer.randint(1, 5, n_rows)}, index=model.decision_units))
+    return model
+
+
+def _build_travel_model(nested: bool, availability: np.ndarray = None) -> ChoiceModel:
+    # A multinomial or nested model of 4 columns. If `availability` is given, unavailable choices get a utility of -inf,
+    # which is equivalent to using it as choice sets.
+    randomizer = np.random.RandomState(12345)
+    model = ChoiceModel(precision=8)
+    if nested:
+        auto = model.add_choice('auto', logsum_scale=0.7)
+        auto.add_choice('drive')
+        auto.add_choice('passenger')
+        model.add_choice('transit')
+    else:
+        model.add_choices(list('abcd'))
+    model.decision_units = pd.RangeIndex(1, 51)
+    model.declare_vector('income', 0)
+    model.declare_matrix('cost')
+    model['income'].assign(randomizer.uniform(0, 2, 50))
+    model['cost'].assign(pd.DataFrame(randomizer.uniform(size=(50, 4)), index=model.decision_units,
+                                      columns=model.choices))
+    model.expressions = ['income * cost', '-2 * cost', 'log(income + 1) @ ' + ('transit' if nested else 'c')]
+    if availability is not None:
+        availability = availability.copy()
+        if nested: availability[:, 0] = True  # The auto nest is available through its choices
+        model.declare_matrix('penalty')
+        model['penalty'].assign(pd.DataFrame(np.where(availability, 0, -np.inf), index=model.decision_units,
+                                             columns=model.choices))
+        model.expressions.append('penalty')
+    return model
+
+
+def _random_availability(nested: bool) -> np.ndarray:
+    # Every decision unit has at least one choice. The auto nest (the first column) gets added to the choice sets with
+    # its available choices.
+    availability = np.random.RandomState(7).uniform(size=(50, 4)) < 0.6
+    availability[::2, 3] = availability[1::2, 1] = True
+    if nested: availability[:, 0] = False
+    return availability
+
+
 class TestSharedCore(unittest.TestCase):
 
     def test_sample_once(self):
@@ -69,6 +158,55 @@ class TestSharedCore(unittest.TestCase):
 
         assert np.all(test_result == expected_result)
 
+    def test_alias_table(self):
+        p = np.float64([0, 0, .25, .05, 0, .5, .2])
+        n = len(p)
+        table_prob, table_alias, stack = np.zeros(n), np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+
+        build_alias_table(p, table_prob, table_alias, stack)
+
+        # Each cell is picked with probability 1/n, then either kept or replaced with its alias
+        implied = table_prob / n
+        np.add.at(implied, table_alias, (1.0 - table_prob) / n)
+        assert_allclose(implied, p, atol=1e-12)
+
+        for r in [MIN_RANDOM_VALUE, 0.1, 0.3, 0.5, 0.7, 0.9, 1.0]:
+            assert p[alias_draw(table_prob, table_alias, r)] > 0
+
+    def test_sample_multi_alias(self):
+        p = np.float64([0, 0, .25, .25, 0, .5, 0])
+        n_cols, n = len(p), 100000
+        table_prob, table_alias, stack = np.zeros(n_cols), np.zeros(n_cols, dtype=np.int64), np.zeros(n_cols, np.int64)
+
+        test_result = sample_multi_alias(p, n, 12345, np.zeros(n, dtype=np.int64), table_prob, table_alias, stack)
+
+        frequencies = np.bincount(test_result, minlength=n_cols) / n
+        assert_allclose(frequencies, p, atol=0.01)
+
+    def test_gumbel_top_k(self):
+        p_array = np.array([0.5, 0.0, 0.3, 0.2])
+        uniforms = _randomize(4, seed=11)
+        heap_index, heap_keys = np.zeros(4, dtype=np.int64), np.zeros(4, dtype=np.float64)
+
+        out, log_q = np.zeros(2, dtype=np.int64), np.zeros(2, dtype=np.float64)
+        gumbel_top_k(p_array, uniforms, out, log_q, heap_index, heap_keys)
+        with np.errstate(divide='ignore'):
+            keys = np.log(p_array) - np.log(-np.log(uniforms))
+        assert np.all(out == np.argsort(-keys)[:2])
+        assert np.all(log_q < 0)
+
+        # Only 3 choices are available, so they all get sampled with certainty
+        out, log_q = np.zeros(3, dtype=np.int64), np.zeros(3, dtype=np.float64)
+        gumbel_top_k(p_array, uniforms, out, log_q, heap_index, heap_keys)
+        assert sorted(out) == [0, 2, 3]
+        assert_allclose(log_q, 0)
+
+        out, log_q = np.zeros(4, dtype=np.int64), np.zeros(4, dtype=np.float64)
+        heap_index, heap_keys = np.zeros(5, dtype=np.int64), np.zeros(5, dtype=np.float64)
+        gumbel_top_k(p_array, uniforms, out, log_q, heap_index, heap_keys)
+        assert out[3] == -1
+        assert np.isnan(log_q[3])
+
     def test_logarithmic_search(self):
         cumsums = np.array([0, 0, 0.25, 0.25, 0.25, 0.25, 0.25, 0.5, 0.75, 1.0, 1.0, 1.0], dtype=np.float64)
 
@@ -89,6 +227,44 @@ class TestSharedCore(unittest.TestCase):
             assert test_result == standard_result
 
 
+class TestCounterRandom(unittest.TestCase):
+
+    def test_philox(self):
+        # Known-answer tests from the Random123 library
+        full = 0xFFFFFFFF
+        tests = [
+            ((0, 0, 0, 0, 0, 0), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+            ((full, full, full, full, full, full), (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+            ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344, 0xa4093822, 0x299f31d0),
+             (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1))
+        ]
+
+        for args, expected_result in tests:
+            test_result = philox4x32(*[np.uint64(a) for a in args])
+            assert tuple(int(x) for x in test_result) == expected_result
+
+    def test_counter_uniforms(self):
+        seed, n = np.uint64(12345), 4
+        hashes = np.arange(10000, dtype=np.uint64) * np.uint64(2654435761)
+
+        test_result = worker_counter_uniforms(seed, hashes, n)
+
+        assert np.all(test_result > 0) and np.all(test_result < 1)
+        assert abs(test_result.mean() - 0.5) < 0.01
+        assert test_result[5, 2] == counter_uniform(seed, hashes[5], np.uint64(2))
+
+    def test_order_independence(self):
+        n_rows, n_cols, seed = 500, 6, np.uint64(3)
+        utilities = -_randomize((n_rows, n_cols), seed=4)
+        hashes = np.arange(n_rows, dtype=np.uint64) * np.uint64(2654435761)
+        order = np.random.RandomState(5).permutation(n_rows)
+
+        for use_alias in [False, True]:
+            expected_result, _ = worker_multinomial_sample_counter(utilities, 3, seed, hashes, use_alias)
+            test_result, _ = worker_multinomial_sample_counter(utilities[order], 3, seed, hashes[order], use_alias)
+            assert np.all(test_result == expected_result[order])
+
+
 class TestWeighredSampling(unittest.TestCase):
 
     def test_simple_probabilities(self):
@@ -116,6 +292,37 @@ class TestWeighredSampling(unittest.TestCase):
             test_result = simple_sample(weights, r)
             assert expected_index == test_result, f"Test={i} Expected={expected_index} Actual={test_result}"
 
+    def test_worker_weighted_sample(self):
+        weights = np.float64([2, 4, 0, 2])
+        n_rows, n_draws = 500, 40
+
+        result = worker_weighted_sample(np.broadcast_to(weights, (n_rows, 4)), n_draws, 12345)
+        assert result.shape == (n_rows, n_draws)
+        frequencies = np.bincount(result.ravel(), minlength=4) / result.size
+        assert_allclose(frequencies, weights / weights.sum(), atol=0.01)
+
+    def test_sample_alternatives(self):
+        n_rows, n_cols = 200, 50
+        utilities = np.log(_randomize((n_rows, n_cols), seed=21))
+
+        model = ChoiceModel()
+        model.add_choices([f"zone{i}" for i in range(n_cols)])
+        model.decision_units = pd.RangeIndex(n_rows)
+        model._partial_utilities.values[:] = utilities
+        _, expected_ls = model.copy().run_stochastic()
+
+        # The logsum term returned by run_stochastic() is the sum of exponentiated utilities, and its sampled estimate
+        # is unbiased (unlike its log)
+        estimates = []
+        for seed in range(20):
+            sampled = model.copy()
+            sampled.sample_alternatives(np.ones(n_cols), 20, random_seed=seed)
+            probabilities, ls = sampled.run_stochastic()
+            assert len(probabilities) <= n_rows * 20
+            assert_allclose(probabilities.groupby(level=0).sum(), 1.0)
+            estimates.append(ls.values)
+        assert_allclose(np.mean(estimates) / expected_ls.mean(), 1.0, atol=0.02)
+
 
 class TestMultinomialCore(unittest.TestCase):
 
@@ -132,6 +339,16 @@ class TestMultinomialCore(unittest.TestCase):
         assert_allclose(test_result, expected_result, rtol=0.000001)
         assert abs(expected_ls - test_ls) < 0.000001
 
+    def test_probabilities_large_utilities(self):
+        utilities = np.float64([1.678, 1.689, 1.348, 0.903, 1.845, 0.877, 0.704, 0.482])
+        expected_result, _ = multinomial_probabilities(utilities)
+
+        test_result = np.full(len(utilities), np.nan)
+        multinomial_probabilities_inplace(utilities + 1000.0, test_result)
+
+        assert np.all(np.isfinite(test_result))
+        assert_allclose(test_result, expected_result, rtol=0.000001)
+
     def test_sample_once(self):
         utilities = np.float64([1.678, 1.689, 1.348, 0.903, 1.845, 0.877, 0.704, 0.482])
         probabilities, _ = multinomial_probabilities(utilities)
@@ -169,6 +386,19 @@ class TestMultinomialCore(unittest.TestCase):
 
             assert test_results[row] == expected_result
 
+    def test_worker_sampling_fused(self):
+        n_rows, n_cols, util_seed, sample_seed = 50, 6, 7, 8
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        utilities[:, 2] = -np.inf
+
+        for n in [1, 5]:
+            expected_results, expected_ls = worker_multinomial_sample(utilities, n, sample_seed, False)
+            draws = worker_sequential_uniforms(sample_seed, n_rows, n)
+            test_results, test_ls = worker_multinomial_sample_fused(utilities, draws)
+
+            assert np.all(test_results == expected_results)
+            assert_allclose(test_ls, expected_ls)
+
     def test_worker_probabilities(self):
         n_rows, n_cols, util_seed = 5, 6, 7
         utilities = -_randomize((n_rows, n_cols), seed=util_seed)
@@ -180,6 +410,124 @@ class TestMultinomialCore(unittest.TestCase):
             expected_result, _ = multinomial_probabilities(util_row)
             assert_allclose(test_results[row], expected_result)
 
+    def test_worker_sampling_without_replacement(self):
+        n_rows, k, sample_seed = 20000, 2, 12
+        p_array = np.array([0.5, 0.2, 0.1, 0.1, 0.05, 0.05])
+        utilities = np.tile(np.log(p_array), (n_rows, 1))
+
+        results, log_q, _ = worker_multinomial_sample_without_replacement(utilities, k, sample_seed,
+                                                                          np.zeros(0, dtype=np.uint64), False)
+
+        assert np.all(results[:, 0] != results[:, 1])
+        assert_allclose(np.bincount(results[:, 0], minlength=6) / n_rows, p_array, atol=0.01)
+
+        # The inclusion probabilities give unbiased (Horvitz-Thompson) estimates of the number of choices
+        estimates = np.zeros(len(p_array))
+        for col in range(k):
+            np.add.at(estimates, results[:, col], 1.0 / np.exp(log_q[:, col]))
+        assert_allclose(estimates / n_rows, 1.0, atol=0.05)
+
+    def test_worker_probabilities_single_precision(self):
+        n_rows, n_cols, util_seed = 50, 6, 7
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+
+        expected_results, expected_ls = worker_multinomial_probabilities(utilities)
+        for worker in [worker_multinomial_probabilities, worker_multinomial_probabilities_batched]:
+            test_results, test_ls = worker(utilities.astype(np.float32))
+
+            assert test_results.dtype == np.float32
+            assert test_ls.dtype == np.float64
+            assert_allclose(test_results, expected_results, rtol=1e-6)
+            assert_allclose(test_ls, expected_ls, rtol=1e-6)
+
+    def test_worker_probabilities_single_precision_overflow(self):
+        utilities = np.full((3, 4), 100.0, dtype=np.float32)  # exp(100) overflows single precision
+
+        for worker in [worker_multinomial_probabilities, worker_multinomial_probabilities_batched]:
+            test_results, test_ls = worker(utilities)
+
+            assert np.all(np.isfinite(test_ls))
+            assert_allclose(np.log(test_ls), 100.0 + np.log(4.0))
+            assert_allclose(test_results, 0.25)
+
+    def test_worker_batched(self):
+        n_rows, n_cols, util_seed, sample_seed = 50, 6, 7, 8  # Not a multiple of the batch size
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        utilities[:, 2] = -np.inf
+
+        expected_results, expected_ls = worker_multinomial_probabilities(utilities)
+        test_results, test_ls = worker_multinomial_probabilities_batched(utilities)
+        assert np.all(test_results == expected_results)
+        assert np.all(test_ls == expected_ls)
+
+        test_results, test_ls = worker_multinomial_probabilities_fastmath(utilities)
+        assert_allclose(test_results, expected_results)
+        assert_allclose(test_ls, expected_ls)
+
+        draws = worker_sequential_uniforms(sample_seed, n_rows, 5)
+        expected_results, _ = worker_multinomial_sample_fused(utilities, draws)
+        test_results, _ = worker_multinomial_sample_batched(utilities, draws)
+        assert np.all(test_results == expected_results)
+
+    def test_worker_sparse(self):
+        n_rows, n_cols, util_seed, sample_seed = 300, 8, 11, 12
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        utilities[_randomize((n_rows, n_cols), seed=util_seed + 1) < 0.5] = -np.inf
+        utilities[:, 3] = -1.0
+        indptr, indices, long_utilities = _to_choice_sets(utilities)
+
+        expected_results, expected_ls = worker_multinomial_probabilities(utilities)
+        test_results, test_ls = worker_multinomial_probabilities_sparse(indptr, long_utilities)
+        assert_allclose(test_results, expected_results[utilities > -np.inf])
+        assert_allclose(test_ls, expected_ls)
+
+        draws = worker_sequential_uniforms(sample_seed, n_rows, 5)
+        expected_results, _ = worker_multinomial_sample_fused(utilities, draws)
+        test_results, _ = worker_multinomial_sample_sparse(indptr, indices, long_utilities, draws, False)
+        assert np.all(test_results == expected_results)
+
+        test_results, _ = worker_multinomial_sample_sparse(indptr, indices, long_utilities, draws, True)
+        assert np.all(utilities[np.arange(n_rows)[:, np.newaxis], test_results] > -np.inf)
+
+        hashes = np.arange(n_rows, dtype=np.uint64)
+        for use_counter in [False, True]:
+            expected_results, expected_log_q, _ = worker_multinomial_sample_without_replacement(
+                utilities, 3, sample_seed, hashes, use_counter)
+            test_results, test_log_q, _ = worker_multinomial_sample_sparse_without_replacement(
+                indptr, indices, long_utilities, 3, sample_seed, hashes, use_counter)
+            assert np.all(test_results == expected_results)
+            assert_allclose(test_log_q, expected_log_q)
+
+    def test_worker_aggregate(self):
+        n_rows, n_cols, n_groups = 300, 6, 4
+        utilities = -_randomize((n_rows, n_cols), seed=15)
+        utilities[::3, 2] = -np.inf
+        weights = _randomize(n_rows, seed=16) * 10
+        group_codes = np.arange(n_rows) % n_groups
+
+        probabilities, _ = worker_multinomial_probabilities(utilities)
+        expected = np.zeros((n_groups, n_cols))
+        np.add.at(expected, group_codes, probabilities * weights[:, np.newaxis])
+
+        for n_chunks in [1, 3, 1000]:
+            test_result = worker_multinomial_aggregate(utilities, weights, group_codes, n_groups, n_chunks)
+            assert_allclose(test_result, expected)
+
+        indptr, indices, long_utilities = _to_choice_sets(utilities)
+        test_result = worker_multinomial_aggregate_sparse(indptr, indices, long_utilities, n_cols, weights, group_codes,
+                                                          n_groups, 3)
+        assert_allclose(test_result, expected)
+
+    def test_worker_logsums(self):
+        utilities = -_randomize((100, 6), seed=19) * 500  # Large enough for the sum of exponentials to underflow
+        utilities[::4, 1] = -np.inf
+
+        expected = np.log(np.exp(utilities - utilities.max(axis=1, keepdims=True)).sum(axis=1)) + utilities.max(axis=1)
+        assert_allclose(worker_multinomial_logsums(utilities), expected)
+
+        utilities[0, :] = -np.inf
+        assert worker_multinomial_logsums(utilities)[0] == -np.inf
+
 
 class TestNestedCore(unittest.TestCase):
 
@@ -212,6 +560,38 @@ class TestNestedCore(unittest.TestCase):
         assert_allclose(test_result, expected_result, rtol=0.00001)
         assert abs(expected_ls - test_ls) < 0.000001
 
+    def test_copied_logsum_scale(self):
+        model = ChoiceModel()
+        auto = model.add_choice('auto', logsum_scale=0.7)
+        auto.add_choice('carpool')
+        auto.add_choice('drive')
+        model.add_choice('transit')
+        model._flatten()
+
+        # Copies share the nodes, so changing a logsum scale through either model applies to both
+        copied = model.copy()
+        copied._flatten()
+        auto.logsum_scale = 0.2
+        logsum_scales = copied._flatten()[3]
+        assert 0.2 in logsum_scales and 0.7 not in logsum_scales
+
+    def test_probabilities_large_utilities(self):
+        utilities = np.float64([-0.001, -1.5, -0.5, -0.005, -1, -0.075, -0.3, -0.9])
+        tree_info = self._build_nested_tree()
+        expected_result, _ = nested_probabilities(utilities, *tree_info)
+
+        # Shifting all elemental (bottom) utilities by the same amount does not change the probabilities
+        bottom_flags = tree_info[-1]
+        shifted = utilities.copy()
+        shifted[bottom_flags] += 1000.0
+
+        test_result = np.full(len(utilities), np.nan)
+        scratch = np.empty(len(utilities))
+        nested_probabilities_inplace(shifted, test_result, scratch, *tree_info, True)
+
+        assert np.all(np.isfinite(test_result))
+        assert_allclose(test_result, expected_result, rtol=0.00001)
+
     def test_sample_once(self):
         utilities = np.float64([-0.001, -1.5, -0.5, -0.005, -1, -0.075, -0.3, -0.9])
         tree_info = self._build_nested_tree()
@@ -253,6 +633,39 @@ class TestNestedCore(unittest.TestCase):
 
             assert test_results[row] == expected_result
 
+    def test_worker_sampling_draws(self):
+        n_rows, n_cols, util_seed, sample_seed = 50, 8, 9, 10
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        tree_info = self._build_nested_tree()
+
+        for n in [1, 5]:
+            expected_results, expected_ls = worker_nested_sample(utilities, *tree_info, n, sample_seed, True, False)
+            draws = worker_sequential_uniforms(sample_seed, n_rows, n)
+            test_results, test_ls = worker_nested_sample_draws(utilities, *tree_info, draws, True)
+
+            assert np.all(test_results == expected_results)
+            assert_allclose(test_ls, expected_ls)
+
+    def test_worker_sampling_fused(self):
+        n_rows, n_cols, util_seed, sample_seed = 20000, 8, 9, 10
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        utilities[:, 6] = -np.inf  # Train-drive
+        tree_info = self._build_nested_tree()
+
+        expected_p, expected_ls = worker_nested_probabilities(utilities, *tree_info)
+        draws = worker_sequential_uniforms(sample_seed, n_rows, 2)
+        test_results, test_ls = worker_nested_sample_fused(utilities, *tree_info, draws, True)
+
+        assert_allclose(test_ls, expected_ls)
+        assert np.all(tree_info[4][test_results]) and not np.any(test_results == 6)
+        for col in range(2):
+            frequencies = np.bincount(test_results[:, col], minlength=n_cols) / n_rows
+            assert_allclose(frequencies, expected_p.mean(axis=0), atol=0.01)
+
+        utilities[:, [1, 2, 4, 7]] = -np.inf
+        with self.assertRaises(UtilityBoundsError):
+            worker_nested_sample_fused(utilities, *tree_info, draws, True)
+
     def test_worker_probabilities(self):
         n_rows, n_cols, util_seed = 7, 8, 9
         utilities = -_randomize((n_rows, n_cols), seed=util_seed)
@@ -264,3 +677,758 @@ class TestNestedCore(unittest.TestCase):
             util_row = utilities[row]
             expected_result, _ = nested_probabilities(util_row, *tree_info)
             assert_allclose(test_results[row], expected_result)
+
+    def test_worker_probabilities_single_precision_overflow(self):
+        utilities = np.full((3, 8), 100.0, dtype=np.float32)  # exp(100) overflows single precision
+        tree_info = self._build_nested_tree()
+
+        expected_results, expected_ls = worker_nested_probabilities(utilities.astype(np.float64), *tree_info)
+        for worker in [worker_nested_probabilities, worker_nested_probabilities_batched]:
+            test_results, test_ls = worker(utilities, *tree_info)
+
+            assert np.all(np.isfinite(test_ls))
+            assert_allclose(test_ls, expected_ls, rtol=1e-6)
+            assert_allclose(test_results, expected_results, rtol=1e-6, atol=1e-7)
+
+    def test_worker_batched(self):
+        n_rows, n_cols, util_seed, sample_seed = 50, 8, 9, 10  # Not a multiple of the batch size
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        tree_info = self._build_nested_tree()
+
+        expected_results, expected_ls = worker_nested_probabilities(utilities, *tree_info, True)
+        test_results, test_ls = worker_nested_probabilities_batched(utilities, *tree_info, True)
+        assert np.all(test_results == expected_results)
+        assert np.all(test_ls == expected_ls)
+
+        test_results, test_ls = worker_nested_probabilities_fastmath(utilities, *tree_info, True)
+        assert_allclose(test_results, expected_results)
+        assert_allclose(test_ls, expected_ls)
+
+        draws = worker_sequential_uniforms(sample_seed, n_rows, 5)
+        expected_results, _ = worker_nested_sample_draws(utilities, *tree_info, draws, True)
+        test_results, _ = worker_nested_sample_batched(utilities, *tree_info, draws, True)
+        assert np.all(test_results == expected_results)
+
+    def test_worker_sparse(self):
+        n_rows, n_cols, util_seed, sample_seed = 300, 8, 13, 14
+        utilities = -_randomize((n_rows, n_cols), seed=util_seed)
+        tree_info = self._build_nested_tree()
+        bottom_flags = tree_info[4]
+
+        # Disable some elemental choices, keeping all nests and one choice per row
+        unavailable = (_randomize((n_rows, n_cols), seed=util_seed + 1) < 0.5) & bottom_flags
+        unavailable[:, 1] = False
+        utilities[unavailable] = -np.inf
+        indptr, indices, long_utilities = _to_choice_sets(utilities)
+
+        expected_results, expected_ls = worker_nested_probabilities(utilities, *tree_info, True)
+        test_results, test_ls = worker_nested_probabilities_sparse(indptr, indices, long_utilities, *tree_info, True)
+        assert_allclose(test_results, expected_results[utilities > -np.inf])
+        assert_allclose(test_ls, expected_ls)
+
+        draws = worker_sequential_uniforms(sample_seed, n_rows, 5)
+        expected_results, _ = worker_nested_sample_draws(utilities, *tree_info, draws, True)
+        test_results, _ = worker_nested_sample_sparse(indptr, indices, long_utilities, *tree_info, draws, True, False)
+        assert np.all(test_results == expected_results)
+
+        hashes = np.arange(n_rows, dtype=np.uint64)
+        for use_counter in [False, True]:
+            expected_results, expected_log_q, _ = worker_nested_sample_without_replacement(
+                utilities, *tree_info, 3, sample_seed, hashes, use_counter, True)
+            test_results, test_log_q, _ = worker_nested_sample_sparse_without_replacement(
+                indptr, indices, long_utilities, *tree_info, 3, sample_seed, hashes, use_counter, True)
+            assert np.all(test_results == expected_results)
+            assert_allclose(test_log_q, expected_log_q)
+
+    def test_worker_aggregate(self):
+        n_rows, n_cols, n_groups = 300, 8, 3
+        utilities = -_randomize((n_rows, n_cols), seed=17)
+        tree_info = self._build_nested_tree()
+        weights = _randomize(n_rows, seed=18) * 10
+        group_codes = np.arange(n_rows) % n_groups
+
+        probabilities, _ = worker_nested_probabilities(utilities, *tree_info, True)
+        expected = np.zeros((n_groups, n_cols))
+        np.add.at(expected, group_codes, probabilities * weights[:, np.newaxis])
+
+        test_result = worker_nested_aggregate(utilities, *tree_info, weights, group_codes, n_groups, 4, True)
+        assert_allclose(test_result, expected)
+
+    def test_worker_logsums(self):
+        n_rows, n_cols = 300, 8
+        utilities = -_randomize((n_rows, n_cols), seed=19)
+        tree_info = self._build_nested_tree()
+        nest_flags = ~tree_info[4]
+
+        _, expected_ls = worker_nested_probabilities(utilities, *tree_info, True)
+        test_ls, test_nests = worker_nested_logsums(utilities, *tree_info, True, True)
+        assert_allclose(test_ls, np.log(expected_ls))
+        assert test_nests.shape == (n_rows, n_cols)
+        assert np.all(np.isfinite(test_nests[:, nest_flags])) and np.all(np.isnan(test_nests[:, ~nest_flags]))
+
+        # The logsum of the 'train' nest, with scaled utilities of its children
+        train_ls = np.log(np.exp(utilities[:, 6] / 0.3) + np.exp(utilities[:, 7] / 0.3))
+        assert_allclose(test_nests[:, 5], train_ls)
+
+        indptr, indices, long_utilities = _to_choice_sets(utilities)
+        test_ls, _ = worker_nested_logsums_sparse(indptr, indices, long_utilities, *tree_info, True, False)
+        assert_allclose(test_ls, np.log(expected_ls))
+
+
+class TestIndexedAdd(unittest.TestCase):
+
+    def setUp(self):
+        randomizer = np.random.RandomState(12345)
+        self.addition = randomizer.uniform(size=(600, 5))
+        self.row_index = randomizer.randint(0, 400, size=600)  # Includes repeated rows
+        self.col_index = np.array([3, 0, 3, 7, 1])  # Includes a repeated column
+
+    def _expected(self):
+        expected = np.ones((400, 8))
+        rows, cols = np.meshgrid(self.row_index, self.col_index, indexing='ij')
+        np.add.at(expected, (rows, cols), self.addition)
+        return expected
+
+    def test_dense(self):
+        out = np.ones((600, 5))
+        fast_indexed_add(out, self.addition)
+        assert_allclose(out, self.addition + 1)
+
+        out = np.ones((400, 8))
+        fast_indexed_add(out, self.addition, self.row_index, self.col_index)
+        assert_allclose(out, self._expected())
+
+    def test_sparse(self):
+        rows, cols = np.nonzero(self.addition > 0.8)
+        data = self.addition[rows, cols]
+        self.addition[self.addition <= 0.8] = 0
+
+        out = np.ones((400, 8))
+        sparse_indexed_add(out, data, rows, cols, self.row_index, self.col_index)
+        assert_allclose(out, self._expected())
+
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=600))])
+        out = np.ones((400, 8))
+        csr_indexed_add(out, indptr, cols, data, self.row_index, self.col_index)
+        assert_allclose(out, self._expected())
+
+    def test_partial_utilities(self):
+        model = ChoiceModel()
+        model.add_choices(list('abcdefgh'))
+        model.decision_units = pd.RangeIndex(400)
+        model._partial_utilities.values[:] = 1
+
+        self.addition[self.addition <= 0.8] = 0
+        table = pd.DataFrame(self.addition, index=self.row_index, columns=model.choices[self.col_index])
+        table = table.astype(pd.SparseDtype(np.float64, 0))
+        model.add_partial_utilities(table, reindex_rows=True)
+        assert_allclose(model._partial_utilities.values, self._expected())
+
+
+class TestChoiceSets(unittest.TestCase):
+
+    def _check_stochastic(self, nested: bool):
+        availability = _random_availability(nested)
+        expected, expected_logsum = _build_travel_model(nested, availability).run_stochastic()
+
+        model = _build_travel_model(nested)
+        model.set_availability(availability)
+        if nested:
+            indptr, cols = model.choice_sets
+            assert np.array_equal(np.diff(indptr), availability.sum(axis=1) + availability[:, 1: 3].any(axis=1))
+        result, logsum = model.run_stochastic()
+
+        rows, cols = np.nonzero(availability[:, model.choices.isin(model.elemental_choices)])
+        assert_allclose(result.values, expected.values[rows, cols], atol=1e-12)
+        assert list(result.index.get_level_values(0)) == list(expected.index[rows])
+        assert_allclose(result.groupby(level=0).sum(), 1.0)
+        assert_allclose(logsum.values, expected_logsum.values)
+
+    def test_stochastic(self):
+        self._check_stochastic(False)
+
+    def test_stochastic_nested(self):
+        self._check_stochastic(True)
+
+    def test_choice_sets(self):
+        availability = _random_availability(False)
+        model = _build_travel_model(False)
+        model.set_availability(availability)
+        expected, expected_logsum = model.run_stochastic()
+
+        # Unsorted and repeated positions
+        rows, cols = np.nonzero(availability[:, ::-1])
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=50) + 1)])
+        indices = np.concatenate([np.append(3 - cols[rows == i], 3 - cols[rows == i][0]) for i in range(50)])
+        model = _build_travel_model(False)
+        model.set_choice_sets(indptr, indices)
+        result, logsum = model.run_stochastic()
+        assert result.equals(expected) and logsum.equals(expected_logsum)
+
+    def test_discrete(self):
+        for nested in [False, True]:
+            availability = _random_availability(nested)
+            for options in [dict(n_draws=3, sampler='search'), dict(n_draws=3, rng='counter', sampler='search'),
+                            dict(n_draws=2, replace=False)]:
+                expected_model = _build_travel_model(nested, availability)
+                expected = expected_model.run_discrete(random_seed=42, astype='index', **options)
+                model = _build_travel_model(nested)
+                model.set_availability(availability)
+                result = model.run_discrete(random_seed=42, astype='index', **options)
+                for item, expected_item in zip(result, expected):
+                    assert_allclose(item.values, expected_item.values), (nested, options)
+
+    def test_empty_choice_set(self):
+        # Decision units without any available choices raise an error, rather than giving results for other units
+        for nested in [False, True]:
+            availability = _random_availability(nested)
+            availability[2, :] = False
+            for run in [lambda model: model.run_stochastic(), lambda model: model.run_discrete(random_seed=42),
+                        lambda model: model.run_discrete(random_seed=42, n_draws=2, replace=False)]:
+                model = _build_travel_model(nested)
+                model.set_availability(availability)
+                with self.assertRaises(UtilityBoundsError):
+                    run(model)
+
+            model = _build_travel_model(nested)
+            model.set_availability(availability)
+            logsums = model.run_logsums()
+            assert logsums.iloc[2] == -np.inf and np.isfinite(logsums.drop(logsums.index[2])).all()
+
+
+class TestAggregate(unittest.TestCase):
+
+    def _check(self, nested: bool, choice_sets: bool):
+        availability = _random_availability(nested)
+        probabilities, _ = _build_travel_model(nested, availability if choice_sets else None).run_stochastic()
+
+        # Weights and groups are aligned to the decision units
+        randomizer = np.random.RandomState(3)
+        order = randomizer.permutation(probabilities.index)
+        weights = pd.Series(randomizer.uniform(1, 10, 50), index=probabilities.index).reindex(order)
+        by = pd.Series(randomizer.choice(['x', 'y', 'z'], 50), index=probabilities.index, name='zone').reindex(order)
+
+        model = _build_travel_model(nested)
+        if choice_sets: model.set_availability(availability)
+        result = model.copy().run_aggregate(weights, by)
+        expected = probabilities.mul(weights, axis=0).groupby(by).sum()
+        assert list(result.index) == ['x', 'y', 'z'] and result.index.name == 'zone'
+        assert result.columns.equals(expected.columns)
+        assert_allclose(result.values, expected.values, rtol=1e-12)
+
+        total = model.copy().run_aggregate()
+        assert isinstance(total, pd.Series)
+        assert_allclose(total.values, probabilities.sum().values, rtol=1e-12)
+
+    def test_multinomial(self):
+        self._check(False, False)
+
+    def test_nested(self):
+        self._check(True, False)
+
+    def test_choice_sets(self):
+        self._check(False, True)
+        self._check(True, True)
+
+
+class TestScenarios(unittest.TestCase):
+
+    def _build_model(self) -> ChoiceModel:
+        randomizer = np.random.RandomState(12345)
+        model = ChoiceModel()
+        model.add_choices(list('abcd'))
+        model.decision_units = pd.RangeIndex(50)
+        model.declare_number('beta')
+        model.declare_number('scale')
+        model.declare_vector('income', 0)
+        model.declare_matrix('cost')
+        model.declare_table('households', 0)
+        model.expressions = ['beta * income * cost', '-2 * beta * cost', 'cost / scale', 'scale @ b',
+                             'exp(beta * income) @ c', '0.5 * cost', 'beta * {a: 1.5, d: -1}',
+                             'beta * households.size @ a', 'households.size * cost / scale']
+        model['income'].assign(randomizer.uniform(0, 2, 50))
+        model['cost'].assign(pd.DataFrame(randomizer.uniform(size=(50, 4)), index=model.decision_units,
+                                          columns=model.choices))
+        model['households'].assign(pd.DataFrame({'size': randomizer.randint(1, 5, 50)}, index=model.decision_units))
+        return model
+
+    def test_linear_terms(self):
+        parameters = {'beta'}
+        [(coefficient, data)] = Expression.parse('-2 * beta * cost / beta')._linear_terms(parameters)
+        assert data.strip() == '(cost)'
+        assert eval(coefficient, {'beta': 4.0}) == -2.0
+
+        assert Expression.parse('exp(beta * cost)')._linear_terms(parameters) is None
+        [(_, data), (coefficient, constant)] = Expression.parse('cost + beta')._linear_terms(parameters)
+        assert data.strip() == 'cost' and coefficient.strip() == '(beta)' and constant is None
+
+    def test_run_scenarios(self):
+        scenarios = pd.DataFrame({'beta': [-0.5, 0.2, 1.0], 'scale': [1.0, 2.0, -3.0]},
+                                 index=pd.Index(['low', 'mid', 'high'], name='scenario'))
+        model = self._build_model()
+        probabilities, logsums = model.run_scenarios(scenarios)
+        assert probabilities.shape == (150, 4)
+        assert probabilities.index.names == ['scenario', None]
+
+        for label, (beta, scale) in scenarios.iterrows():
+            model = self._build_model()
+            model['beta'].assign(beta)
+            model['scale'].assign(scale)
+            expected_probabilities, expected_logsums = model.run_stochastic()
+            assert_allclose(probabilities.loc[label].values, expected_probabilities.values)
+            assert_allclose(logsums.loc[label].values, expected_logsums.values)
+
+
+class TestFusedEngine(unittest.TestCase):
+
+    def _check(self, precision):
+        model = _build_utility_model(precision)
+
+        # Dict literals and chained symbols are named '__dict0' and '__sub_...' in each expression, so they get renamed
+        # within fused programs
+        expressions = ['beta * income * cost', '{a: 1.5, d: -1}', 'log(income + 1) @ b', '0.5 * cost',
+                       'beta * {b: 2, c: 0.5}', 'where(cost > 0.5, 1, 0) @ b', 'income @ c', 'households.size * cost',
+                       'households.size * 0.25 @ d']
+        expressions += [f"{0.1 * i} * cost" for i in range(MAX_FUSED_EXPRESSIONS + 5)]
+        model.expressions = expressions
+
+        # Setting debug_id evaluates each expression over the whole table in turn, with the 'numexpr' engine
+        debug_model = model.copy()
+        debug_model.debug_id = 1
+        expected = model.copy()._evaluate_utilities(model.expressions).values
+        assert_allclose(expected, debug_model._evaluate_utilities(debug_model.expressions).values,
+                        atol=1e-4 if precision == 4 else 1e-10)
+
+        fused = model.copy()
+        fused.engine = 'fused'
+        test_result = fused._evaluate_utilities(fused.expressions).values
+        assert_allclose(test_result, expected, atol=1e-4 if precision == 4 else 1e-10)
+        assert test_result.dtype == expected.dtype
+
+    def test_double_precision(self):
+        self._check(8)
+
+    def test_single_precision(self):
+        self._check(4)
+
+
+class TestHoisting(unittest.TestCase):
+
+    def _build_model(self) -> ChoiceModel:
+        return _build_utility_model(decision_units=pd.RangeIndex(1, 51))
+
+    def test_orientation(self):
+        model = self._build_model()
+        for e, expected in [('beta * income', 0), ('log(size) + {a: 1}', 1), ('beta', 1), ('income * size', None),
+                            ('cost', None), ('income @ b', 0)]:
+            assert model._expression_orientation(Expression.parse(e)) == expected, e
+
+    def test_evaluation(self):
+        model = self._build_model()
+        model.expressions = ['beta * income', 'log(size)', '{a: 1.5, d: -1}', 'income @ b', 'beta * income @ b',
+                             'size * 2 @ c', 'where(income > 1, 2, 0) @ d', 'beta * income * cost', '0.5']
+
+        # Setting debug_id evaluates each expression over the whole table in turn
+        expected_model = model.copy()
+        expected_model.debug_id = 1
+        expected = expected_model._evaluate_utilities(expected_model.expressions).values
+
+        test_result = model.copy()._evaluate_utilities(model.expressions).values
+        assert_allclose(test_result, expected, atol=1e-10)
+
+
+class TestOptimization(unittest.TestCase):
+
+    def test_optimize(self):
+        axes = {'beta': set(), 'income': {0}, 'size': {1}, 'cost': {0, 1}}
+        expressions = [Expression.parse(e, cache=False) for e in [
+            '0.5 * cost + 2 * 3 * income', '0.2 * cost', '-0.7 * cost', 'beta * cost', 'log(size + 1) * 2 @ a',
+            'log(size + 1) @ b', '{a: 1, b: 2} * exp(cost * 2)', 'exp(cost * 2) @ a', 'exp(cost * 2) * income',
+            '{a: 1, b: 2} * income', 'income * 7 / 2', 'size * 0'
+        ]]
+        plan = optimize(expressions, lambda name: axes[name])
+        report = plan.report
+
+        assert report.n_expressions == 12 and report.n_terms == 13 and report.n_folded == 1
+        assert ('(beta * cost)', 4) in report.merged  # The constant coefficients add up to zero
+        assert report.dropped == ['(size * 0)']
+        assert [source for _, source, _ in report.shared] == ['log(size + 1)', 'exp(cost * 2)']
+        assert '(6 * income)' in report.terms
+        assert '(income * 7 / 2)' in report.terms  # Integer division isn't folded
+
+        # Dict literals are shared by content, and exp(cost * 2) is used twice over all choices
+        assert len(plan.locals) == 1
+        assert str(report).startswith("12 expressions with 13 terms optimized to 9 terms")
+
+    def test_evaluation(self):
+        for precision in [4, 8]:
+            model = _build_utility_model(precision)
+            model.expressions = ['0.5 * cost + 2 * 3 * income', '0.2 * cost', 'beta * cost', 'log(size + 1) * 2 @ a',
+                                 'log(size + 1) @ b', '{a: 1, b: 2} * exp(cost * 2)', 'exp(cost * 2) @ a',
+                                 'exp(cost * 2) * income', 'where(income > 1, 1, 0) * {c: 3} * cost', 'cost * 0']
+
+            expected = model.copy()._evaluate_utilities(model.expressions).values
+            optimized = model.copy()
+            optimized.set_optimization()
+            test_result = optimized._evaluate_utilities(optimized.expressions).values
+            assert_allclose(test_result, expected, rtol=1e-5 if precision == 4 else 1e-12)
+            assert test_result.dtype == expected.dtype
+
+
+class TestCoefficientTable(unittest.TestCase):
+
+    def _build_model(self) -> ChoiceModel:
+        randomizer = np.random.RandomState(12345)
+        model = ChoiceModel(precision=8)
+        auto = model.add_choice('auto')
+        auto.add_choice('drive')
+        auto.add_choice('passenger')
+        model.add_choice('transit')
+        model.decision_units = pd.RangeIndex(50)
+        model.declare_number('beta')
+        model.declare_vector('income', 0)
+        model.declare_matrix('time')
+        model['beta'].assign(-0.5)
+        model['income'].assign(randomizer.uniform(0, 2, 50))
+        model['time'].assign(pd.DataFrame(randomizer.uniform(size=(50, 4)), index=model.decision_units,
+                                          columns=model.choices))
+        return model
+
+    def test_load(self):
+        model = self._build_model()
+        csv = "expression,auto.drive,auto.passenger,transit,auto\n" \
+              "income,0.5,,-1.25,\n" \
+              "time,-0.25,-0.25,-0.5,\n" \
+              "log(income + 1),,2,,1\n" \
+              "beta * income @ transit,1,,1,\n" \
+              "income,0.25,,,\n"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'coefficients.csv')
+            with open(path, 'w') as writer: writer.write(csv)
+            model.load_coefficients(path)
+
+        table = next(model.expressions.itertables())
+        assert len(table.expressions) == 4  # Rows of the same expression are added together
+        assert set(model.expressions.itersimple()) == {'beta', 'income', 'time'}
+
+        expected_model = self._build_model()
+        expected_model.expressions = [
+            'income * {auto.drive: 0.75, transit: -1.25}', 'time * {auto.drive: -0.25, auto.passenger: -0.25, '
+            'transit: -0.5}', 'log(income + 1) * {auto.passenger: 2, auto: 1}', 'beta * income @ transit'
+        ]
+        expected = expected_model._evaluate_utilities(expected_model.expressions).values
+        assert_allclose(model.copy()._evaluate_utilities(model.expressions).values, expected, atol=1e-12)
+
+        debug_model = model.copy()
+        debug_model.debug_id = 3
+        assert_allclose(debug_model._evaluate_utilities(debug_model.expressions).values, expected, atol=1e-12)
+        assert list(debug_model.debug_results.index) == ['(coefficient tables)']
+
+    def test_filtered_expression(self):
+        model = self._build_model()
+        distance = np.zeros([50, 4])
+        distance[:, 3] = np.linspace(1, 2, 50)
+        model.declare_matrix('distance')
+        model['distance'].assign(pd.DataFrame(distance, index=model.decision_units, columns=model.choices))
+
+        model.declare_vector('frequency', 1)
+        model['frequency'].assign(pd.Series([0, 0, 0, 4.0], index=model.choices))
+        model.declare_vector('parking', 0)
+        model['parking'].assign(np.where(np.arange(50) % 3 == 0, 0, 2.0))
+        expected_model = model.copy()
+
+        # The logs are -inf outside of the filtered choices, which mustn't be multiplied by a zero coefficient. This
+        # goes for expressions which vary by decision unit and choice, by decision unit only, and by choice only.
+        model.load_coefficients(pd.DataFrame({'transit': [0.5, np.nan, 1.5], 'auto.drive': [np.nan, -1.0, np.nan]},
+                                             index=['log(distance) @ transit', 'log(parking) @ auto.drive',
+                                                    'log(frequency) @ transit']))
+        expected_model.expressions = ['0.5 * log(distance) @ transit', '-1.0 * log(parking) @ auto.drive',
+                                      '1.5 * log(frequency) @ transit']
+        expected = expected_model.copy()._evaluate_utilities(expected_model.expressions).values
+        assert_allclose(model.copy()._evaluate_utilities(model.expressions).values, expected, atol=1e-12)
+
+        availability = np.ones([50, 4], dtype=bool)
+        availability[::4, 3] = False
+        model.set_availability(availability)
+        indptr, cols = model._choice_sets
+        rows = np.repeat(np.arange(50), np.diff(indptr))
+        assert_allclose(model._evaluate_utilities_long(model.expressions), expected[rows, cols], atol=1e-12)
+
+    def test_unknown_choice(self):
+        model = self._build_model()
+        with self.assertRaises(KeyError):
+            model.load_coefficients(pd.DataFrame({'walk': [1.0]}, index=['income']))
+
+    def test_choice_sets(self):
+        model = self._build_model()
+        model.load_coefficients(pd.DataFrame({'auto.drive': [0.5, -0.25, np.nan], 'transit': [-1.25, -0.5, 1.0],
+                                              'auto': [np.nan, np.nan, 0.3]},
+                                             index=['income', 'time', 'beta * log(time) @ transit']))
+        model.expressions = ['time * {auto.passenger: -0.75}']
+        availability = np.random.RandomState(7).uniform(size=(50, 4)) < 0.7
+        availability[:, [0, 1]] = True  # The auto nest and one of its choices
+        availability[::5, 3] = False
+        dense = model.copy()._evaluate_utilities(model.expressions).values
+
+        model.set_availability(availability)
+        indptr, cols = model._choice_sets
+        rows = np.repeat(np.arange(50), np.diff(indptr))
+        assert_allclose(model._evaluate_utilities_long(model.expressions), dense[rows, cols], atol=1e-12)
+
+        model.debug_id = 3
+        model._evaluate_utilities_long(model.expressions)
+        assert list(model.debug_results.index) == ['(coefficient tables)', 'time * {auto.passenger: -0.75}']
+
+
+class TestNumbaEngine(unittest.TestCase):
+
+    def test_engine(self):
+        model = _build_utility_model()
+        model.expressions = ['beta * income * cost', '{a: 1.5, d: -1}', 'log(income + 1) @ b', 'log(size)',
+                             'beta * {b: 2, c: 0.5}', 'where(cost > 0.5, 1, 0) @ b', 'income @ c',
+                             'where(not (cost < 0.5) or (income > 1), income, cost)', '(income > 1) * 3',
+                             'households.size * cost', 'households.size * size @ d']
+
+        expected = model.copy()._evaluate_utilities(model.expressions).values
+        numba_model = model.copy()
+        numba_model.engine = 'numba'
+        assert_allclose(numba_model._evaluate_utilities(numba_model.expressions).values, expected, atol=1e-10)
+
+    def test_untranslatable(self):
+        builder = KernelBuilder()
+        assert builder.add('x * 2', {'x': np.ones([3, 1])}, None)
+        assert not builder.add('y + z', {'y': np.ones([3, 1]), 'z': np.array([['text']] * 3)}, None)
+        assert not builder.add('sum(x)', {'x': np.ones([3, 1])}, 1)
+        assert len(builder) == 1 and len(builder.args) == 1  # The arguments of 'y + z' are rolled back
+
+        out = np.zeros([3, 2])
+        assert builder.run(out)
+        assert_allclose(out, 2)
+
+
+class TestBlocks(unittest.TestCase):
+
+    def _build_model(self, nested: bool = True) -> ChoiceModel:
+        randomizer = np.random.RandomState(12345)
+        model = ChoiceModel(precision=8)
+        if nested:
+            auto = model.add_choice('auto', logsum_scale=0.7)
+            auto.add_choice('drive')
+            auto.add_choice('passenger')
+            model.add_choice('transit')
+        else:
+            model.add_choices(['drive', 'passenger', 'transit', 'walk'])
+        model.decision_units = pd.RangeIndex(1, 51)
+        model.declare_number('beta')
+        model.declare_vector('income', 0)
+        model.declare_matrix('time')
+        model['beta'].assign(-0.5)
+        model['income'].assign(randomizer.uniform(0, 2, 50))
+        model['time'].assign(pd.DataFrame(randomizer.uniform(size=(50, 4)), index=model.decision_units,
+                                          columns=model.choices))
+        model.expressions = ['beta * income @ transit', 'time * -1.5',
+                             'log(income + 1) @ ' + ('auto.drive' if nested else 'drive')]
+        return model
+
+    def test_stochastic(self):
+        expected, expected_logsum = self._build_model().run_stochastic()
+
+        result, logsum = self._build_model().run_stochastic(block_size=7)  # The last block has one decision unit
+        assert result.equals(expected) and logsum.equals(expected_logsum)
+
+        with tempfile.TemporaryDirectory() as directory:
+            out = np.lib.format.open_memmap(os.path.join(directory, 'probabilities.npy'), mode='w+',
+                                            shape=expected.shape)
+            result, _ = self._build_model().run_stochastic(memory_limit=1000, out=out)
+            assert np.shares_memory(result.values, out)
+            assert result.equals(expected)
+            del result, out
+
+    def test_discrete(self):
+        all_options = [dict(), dict(n_draws=3), dict(n_draws=3, kernel='batched'), dict(n_draws=3, rng='counter'),
+                       dict(n_draws=3, rng='counter', replace=False, return_log_q=True), dict(n_draws=ALIAS_THRESHOLD),
+                       dict(n_draws=3, sampler='alias'), dict(n_draws=3, sampler='fused'),
+                       dict(n_draws=3, replace=False, return_log_q=True)]
+        for nested, options in itertools.product([True, False], all_options):
+            expected = self._build_model(nested).run_discrete(random_seed=42, astype='index', **options)
+            result = self._build_model(nested).run_discrete(random_seed=42, astype='index', block_size=7, **options)
+            for item, expected_item in zip(result, expected): assert item.equals(expected_item), (nested, options)
+            assert len(result) == (3 if options.get('return_log_q') else 2), options
+
+    def test_logsums(self):
+        expected, expected_nests = self._build_model().run_logsums(nests=True)
+        logsum, nest_logsums = self._build_model().run_logsums(nests=True, block_size=7)
+        assert logsum.equals(expected) and nest_logsums.equals(expected_nests)
+
+    def test_debug(self):
+        expected_model = self._build_model()
+        expected_model.debug_id = 30
+        expected_model.run_logsums()
+
+        model = self._build_model()
+        model.debug_id = 30
+        model.run_logsums(block_size=7)
+        assert model.debug_results.equals(expected_model.debug_results)
+
+
+class TestExpressionCache(unittest.TestCase):
+
+    def test_reuse(self):
+        cache = ExpressionCache(max_size=2)
+        first = Expression.parse('a + b.c')
+        cache.put(first, 'cheval')
+        assert cache.get('a + b.c', 'cheval') is first
+        assert cache.get('a + b.c', 'other') is None
+
+        cache.put(Expression.parse('x'), 'cheval')
+        cache.put(Expression.parse('y'), 'cheval')
+        assert cache.info() == (1, 1, 2, 2)
+        assert cache.get('a + b.c', 'cheval') is None  # Evicted
+
+    def test_usage_checks(self):
+        group = ExpressionGroup()
+        group.append('a + b.c')
+        expr = next(iter(group))
+
+        other = ExpressionGroup()
+        other.append('a + b.c')
+        assert next(iter(other)) is expr  # Shared between groups
+        assert set(other.itersimple()) == {'a'} and set(other.iterchained()) == {'b'}
+
+        inconsistent = ExpressionGroup()
+        inconsistent.append('b * 2')
+        with self.assertRaises(UnsupportedSyntaxError):
+            inconsistent.append('a + b.c')
+
+    def test_save(self):
+        cache = ExpressionCache()
+        cache.put(Expression.parse('a + b.c'), 'cheval')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'expressions.pkl')
+            cache.save(path)
+
+            loaded = ExpressionCache()
+            assert loaded.load(path) == 1
+            assert loaded.get('a + b.c', 'cheval').transformed == cache.get('a + b.c', 'cheval').transformed
+
+
+class TestIncremental(unittest.TestCase):
+
+    def _assign_cost(self, model: ChoiceModel, seed: int):
+        randomizer = np.random.RandomState(seed)
+        model['cost'].assign(pd.DataFrame(randomizer.uniform(size=(50, 4)), index=model.decision_units,
+                                          columns=model.choices))
+
+    def _check(self, memory_limit):
+        model = ChoiceModel()
+        model.add_choices(list('abcd'))
+        model.decision_units = pd.RangeIndex(50)
+        model.declare_number('beta')
+        model.declare_vector('income', 0)
+        model.declare_matrix('cost')
+        model.expressions = ['beta * income * cost', 'log(income + 1) @ b', '0.5 * cost', 'beta']
+        model['beta'].assign(-0.5)
+        model['income'].assign(np.linspace(0, 2, 50))
+        self._assign_cost(model, 1)
+        model.set_incremental(memory_limit=memory_limit)
+
+        for seed, n_evaluated in [(1, 4), (2, 2), (3, 2)]:
+            if seed > 1: self._assign_cost(model, seed)
+            probabilities, _ = model.run_stochastic(clear_scope=False)
+            assert model._contributions.n_evaluated == n_evaluated
+
+            full = model.copy()
+            full.set_incremental(False)
+            expected_probabilities, _ = full.run_stochastic(clear_scope=False)
+            assert_allclose(probabilities.values, expected_probabilities.values)
+
+        # Contributions are stored at the shape of their symbols
+        shapes = sorted(c.values.shape for c in model._contributions._contributions.values())
+        assert shapes == [(1,), (50,), (50, 4), (50, 4)]
+
+        model['beta'].assign(-0.5)  # The same value, so nothing changes
+        model.run_stochastic(clear_scope=False)
+        assert model._contributions.n_evaluated == 0
+
+    def test_in_memory(self):
+        self._check(None)
+
+    def test_spilled(self):
+        self._check(0)
+
+    def _check_updates(self, model: ChoiceModel, updates):
+        # Runs the model incrementally after each update, checking the utilities against a full evaluation
+        model.set_incremental()
+        for update in updates:
+            update(model)
+            utilities = model._evaluate_utilities(model.expressions).values
+            full = model.copy()
+            full.set_incremental(False)
+            assert_allclose(utilities, full._evaluate_utilities(full.expressions).values)
+
+    def test_chained_symbols(self):
+        model = ChoiceModel()
+        model.add_choices(list('abcd'))
+        model.decision_units = pd.RangeIndex(50)
+        model.declare_table('households', 0)
+        model.declare_matrix('cost')
+        model.expressions = ['households.size * cost', 'log(households.size) @ b']
+        self._assign_cost(model, 1)
+
+        def assign_households(seed):
+            sizes = np.random.RandomState(seed).randint(1, 5, 50)
+            return lambda m: m['households'].assign(pd.DataFrame({'size': sizes}, index=m.decision_units))
+
+        self._check_updates(model, [assign_households(1), assign_households(2), lambda m: self._assign_cost(m, 2)])
+
+    def test_unavailable_choices(self):
+        model = ChoiceModel()
+        model.add_choices(list('abcd'))
+        model.decision_units = pd.RangeIndex(50)
+        model.declare_vector('available', 0)
+        model.declare_matrix('cost')
+        model.expressions = ['cost', 'where(available > 0, 0, NEG_INF) @ a']
+        self._assign_cost(model, 1)
+
+        def assign_available(seed):
+            return lambda m: m['available'].assign(np.random.RandomState(seed).randint(0, 2, 50))
+
+        # Contributions with -inf can't be subtracted from the total when they change
+        self._check_updates(model, [assign_available(1), assign_available(2), lambda m: self._assign_cost(m, 2)])
+
+    def test_duplicate_expressions(self):
+        model = ChoiceModel()
+        model.add_choices(list('abcd'))
+        model.decision_units = pd.RangeIndex(50)
+        model.declare_number('beta')
+        model.declare_matrix('cost')
+        model.expressions = ['cost', 'beta', 'cost']  # Both copies of 'cost' are the same parsed expression
+        model['beta'].assign(0.5)
+
+        self._check_updates(model, [lambda m: self._assign_cost(m, 1), lambda m: self._assign_cost(m, 2),
+                                    lambda m: m['beta'].assign(2.0)])
+        assert model._contributions.n_evaluated == 1
+
+
+class TestCompilation(unittest.TestCase):
+
+    def test_import_time(self):
+        # Kernels are compiled on first use, so importing cheval shouldn't compile anything
+        script = (
+            "from time import perf_counter\n"
+            "start = perf_counter()\n"
+            "import cheval\n"
+            "elapsed = perf_counter() - start\n"
+            "import cheval.core as core\n"
+            "compiled = [name for name, obj in vars(core).items() if getattr(obj, 'signatures', None)]\n"
+            "print(elapsed, len(compiled))\n"
+        )
+        output = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, check=True).stdout
+        elapsed, n_compiled = output.decode().split()[-2:]
+
+        assert int(n_compiled) == 0
+        assert float(elapsed) < 10.0, f"Importing cheval took {elapsed}s"
+
+    def test_warmup(self):
+        warmup(precisions=(8,))
+        assert worker_multinomial_probabilities(np.zeros((2, 3)))[0].shape == (2, 3)
@@ -0,0 +1,106 @@
+import unittest
+from unittest import mock
+from threading import Thread
+
+import numba as nb
+import numexpr as ne
+import numpy as np
+import pandas as pd
+
+from cheval import ChoiceModel, ExecutionContext, program_cache_info
+from cheval.execution import _numexpr_lock, evaluate_numexpr
+
+
+class TestExecutionContext(unittest.TestCase):
+
+    def test_restores_threads(self):
+        initial = nb.get_num_threads()
+
+        with ExecutionContext(n_threads=1) as outer:
+            assert nb.get_num_threads() == 1
+            assert ExecutionContext.current() is outer
+
+            with ExecutionContext(numexpr_threads=2) as inner:
+                assert nb.get_num_threads() == 1  # Inherited from the outer context
+                assert ExecutionContext.current() is inner
+                assert ExecutionContext.resolve_threads(None, default=8) == 1
+                assert ExecutionContext.resolve_numexpr_threads(1) == 2
+
+        assert nb.get_num_threads() == initial
+        assert ExecutionContext.current() is None
+        assert ExecutionContext.resolve_threads(None, default=8) == 8
+
+    def test_model_setting(self):
+        model = ChoiceModel()
+        model.add_choices(['a', 'b'])
+        model.decision_units = pd.RangeIndex(10)
+        model.declare_vector('x', 0)
+        model.expressions = ['x @ a']
+        model['x'].assign(np.arange(10, dtype=np.float64))
+
+        # Without any settings, Numba kernels keep Numba's own thread count
+        context = model._execution_context(None, default=4)
+        assert context.n_threads is None and context.numexpr_threads == 4
+
+        model.execution = ExecutionContext(n_threads=1, numexpr_threads=1)
+        with ExecutionContext(n_threads=2):
+            context = model._execution_context(None, default=4)
+            assert context.n_threads == 1
+            assert context.numexpr_threads == 1
+
+            assert model._execution_context(3, default=4).n_threads == 3
+
+        probabilities, _ = model.run_stochastic(clear_scope=False)
+        assert np.allclose(probabilities.sum(axis=1), 1.0)
+        assert model.copy().execution is model.execution
+
+    def test_program_cache(self):
+        model = ChoiceModel()
+        model.add_choices(['a', 'b'])
+        model.decision_units = pd.RangeIndex(10)
+        model.declare_vector('x', 0)
+        model.expressions = ['0.25 * x @ a', 'x + 3 @ b']  # Not used by other tests
+        model['x'].assign(np.arange(10, dtype=np.float64))
+
+        program_cache_info(reset=True)
+        expected, _ = model.copy().run_stochastic()
+        assert program_cache_info() == (0, 2)
+
+        # The copy shares the same Expression objects, which keep their compiled programs
+        probabilities, _ = model.copy().run_stochastic()
+        assert program_cache_info(reset=True) == (2, 2)
+        assert np.allclose(probabilities.values, expected.values)
+
+    def test_program_fallback(self):
+        # Without NumExpr's (private) compiler, expressions are evaluated with numexpr.evaluate()
+        model = ChoiceModel()
+        model.add_choices(['a', 'b'])
+        model.decision_units = pd.RangeIndex(10)
+        model.declare_vector('x', 0)
+        model.expressions = ['0.5 * x @ a', 'x - 2 @ b', '{a: 1, b: -1}']
+        model['x'].assign(np.arange(10, dtype=np.float64))
+        expected, _ = model.copy().run_stochastic()
+
+        for engine in ['numexpr', 'fused']:
+            fallback = model.copy()
+            fallback.engine = engine
+            program_cache_info(reset=True)
+            with mock.patch('cheval.execution.NumExpr', None):
+                probabilities, _ = fallback.run_stochastic()
+            assert program_cache_info() == (0, 0)
+            assert np.allclose(probabilities.values, expected.values)
+
+    def test_numexpr_lock(self):
+        # Evaluations which keep NumExpr's current thread count don't wait for other threads to change it
+        out = np.zeros(4)
+        with _numexpr_lock:
+            worker = Thread(target=evaluate_numexpr, args=('x + 1', {'x': np.arange(4.0)}, out, 'safe',
+                                                           ne.get_num_threads()))
+            worker.start()
+            worker.join(timeout=10)
+            assert not worker.is_alive()
+        assert np.allclose(out, np.arange(1.0, 5.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,7 +22,7 @@ setup(
         'pandas>= 0.22, <0.24',
         'numpy>=1.14',
         'astor',
-        'numba==0.45',
+        'numba>=0.49',
         'numexpr',
         'deprecated',
         'attrs>=19.3'